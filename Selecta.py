@@ -1,6 +1,7 @@
 import sys
 import multiprocessing
 
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QApplication
 from app.MainWindow import MainWindow
 from selecta.logger import generate_logger
@@ -11,10 +12,13 @@ multiprocessing.set_start_method("spawn", force=True)
 logger = generate_logger()
 
 
-def run_app():
+def run_app(prewarm_analysis: bool = True):
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
+    if prewarm_analysis:
+        # Once the window is up, load the analysis modules in the background
+        QTimer.singleShot(0, window.songs_panel.prewarm_analysis)
     sys.exit(app.exec())
 
 
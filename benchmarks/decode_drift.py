@@ -0,0 +1,135 @@
+"""
+Compares the "fast" decode mode against the "standard" one on a set of audio files.
+
+For every file both decode modes are timed, and the difference in waveforms and YAMNet embeddings is measured. The
+similarity matrices built from each set of embeddings are then compared, which is what a playlist actually depends on.
+
+Usage:
+    uv run python benchmarks/decode_drift.py ~/Music --limit 100
+    uv run python benchmarks/decode_drift.py song1.mp3 song2.mp3 --no-embeddings
+"""
+
+import time
+import argparse
+import numpy as np
+
+from pathlib import Path
+
+from selecta.Song import Song
+from selecta.SimilarityEngine import SimilarityEngine
+
+AUDIO_SUFFIXES = {".mp3", ".wav", ".flac", ".ogg", ".m4a"}
+NEAREST_NEIGHBOURS = 10
+
+
+def find_audio_files(paths: list, limit: int = None) -> list:
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(sorted(p for p in path.rglob("*") if p.suffix.lower() in AUDIO_SUFFIXES))
+        else:
+            files.append(path)
+    return files[:limit]
+
+
+def timed_load(path: Path, decode_mode: str) -> tuple:
+    start = time.perf_counter()
+    waveform = Song.load_audio(path, decode_mode=decode_mode)
+    return waveform, time.perf_counter() - start
+
+
+def waveform_snr_db(reference: np.ndarray, other: np.ndarray) -> float:
+    """Signal-to-noise ratio of `other` against `reference`, over their common length"""
+    n = min(len(reference), len(other))
+    error = np.sum((reference[:n].astype(np.float64) - other[:n]) ** 2)
+    if error == 0:
+        return np.inf
+    return 10 * np.log10(np.sum(reference[:n].astype(np.float64) ** 2) / error)
+
+
+def embedding_drift(reference: np.ndarray, other: np.ndarray) -> float:
+    """Mean cosine distance between corresponding collapsed embeddings"""
+    n = min(len(reference), len(other))
+    reference, other = reference[:n], other[:n]
+    cosine = np.sum(reference * other, axis=1) / (np.linalg.norm(reference, axis=1) * np.linalg.norm(other, axis=1))
+    return float(np.mean(1 - cosine))
+
+
+def neighbour_overlap(reference: np.ndarray, other: np.ndarray, n: int) -> float:
+    """Mean fraction of each song's n nearest neighbours which both matrices agree on"""
+    overlaps = []
+    for reference_row, other_row in zip(reference, other):
+        reference_nearest = set(np.argsort(reference_row, kind="stable")[:n])
+        other_nearest = set(np.argsort(other_row, kind="stable")[:n])
+        overlaps.append(len(reference_nearest & other_nearest) / n)
+    return float(np.mean(overlaps))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="Audio files, or directories to search for them")
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of files to compare")
+    parser.add_argument("--no-embeddings", action="store_true", help="Only compare decode times and waveforms")
+    args = parser.parse_args()
+
+    files = find_audio_files(args.paths, args.limit)
+    if not files:
+        parser.error("No audio files found")
+
+    inference = None
+    if not args.no_embeddings:
+        from selecta.yamnet_model import load_yamnet_model
+        from selecta.YamnetInference import YamnetInference
+
+        inference = YamnetInference(load_yamnet_model())
+        inference.warm_up()
+
+    standard_seconds, fast_seconds, snrs, drifts = [], [], [], []
+    standard_embeddings, fast_embeddings = [], []
+    print(f"{'file':<50} {'standard s':>10} {'fast s':>8} {'speed-up':>8} {'SNR dB':>8} {'drift':>9}")
+    for path in files:
+        # Read the file once up front, so that neither mode pays for reading it from disk
+        path.read_bytes()
+        standard, standard_time = timed_load(path, "standard")
+        fast, fast_time = timed_load(path, "fast")
+        if standard is None or fast is None:
+            print(f"{path.name[:50]:<50} could not be decoded")
+            continue
+        standard_seconds.append(standard_time)
+        fast_seconds.append(fast_time)
+        snrs.append(waveform_snr_db(standard, fast))
+
+        drift = np.nan
+        if inference is not None:
+            standard_embeddings.append(Song.collapse_matrix(inference.embed([standard])[0]))
+            fast_embeddings.append(Song.collapse_matrix(inference.embed([fast])[0]))
+            drift = embedding_drift(standard_embeddings[-1], fast_embeddings[-1])
+            drifts.append(drift)
+
+        print(
+            f"{path.name[:50]:<50} {standard_time:>10.3f} {fast_time:>8.3f} {standard_time / fast_time:>7.1f}x "
+            f"{snrs[-1]:>8.1f} {drift:>9.2e}"
+        )
+
+    if not standard_seconds:
+        return
+    print()
+    print(f"Files compared:            {len(standard_seconds)}")
+    print(
+        f"Total decode time:         {sum(standard_seconds):.2f}s standard, {sum(fast_seconds):.2f}s fast "
+        f"({sum(standard_seconds) / sum(fast_seconds):.1f}x speed-up)"
+    )
+    print(f"Median waveform SNR:       {np.median(snrs):.1f} dB")
+    if drifts:
+        print(f"Embedding drift:           {np.mean(drifts):.2e} mean, {np.max(drifts):.2e} max cosine distance")
+    if len(standard_embeddings) > 1:
+        standard_matrix = SimilarityEngine(standard_embeddings).compute()
+        fast_matrix = SimilarityEngine(fast_embeddings).compute()
+        difference = np.abs(standard_matrix - fast_matrix)
+        print(f"Similarity matrix drift:   {np.nanmean(difference):.2e} mean, {np.nanmax(difference):.2e} max")
+        n = min(NEAREST_NEIGHBOURS, len(standard_embeddings) - 1)
+        print(f"Top-{n} neighbour overlap:  {100 * neighbour_overlap(standard_matrix, fast_matrix, n):.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Compares each embedding compression against uncompressed float32 embeddings.
+
+For every mode in COMPRESSION_MODES a synthetic library is written to an embedding store and compressed, then the similarity
+matrix is built from the compressed store. It reports the size of the store's files, the time taken to compress it and
+to build the matrix, and how closely the matrix matches the one built from float32 embeddings: the fraction of each
+song's nearest neighbours both agree on, and the mean difference in distances.
+
+The synthetic embeddings spread their noise evenly over all 1024 dimensions, which is the worst case for a projection
+onto fewer of them. Pass --store to compare on the songs of an analysed library instead.
+
+Usage:
+    uv run python benchmarks/embedding_compression.py --songs 5000
+    uv run python benchmarks/embedding_compression.py --songs 2000 --pca-dims 64 --neighbours 20
+    uv run python benchmarks/embedding_compression.py --store <app data directory>/cache/embeddings --songs 20000
+"""
+
+import time
+import tempfile
+import argparse
+import numpy as np
+
+from pathlib import Path
+from types import SimpleNamespace
+
+from synthetic import synthetic_embeddings
+from decode_drift import neighbour_overlap
+from selecta.EmbeddingCodec import COMPRESSION_MODES, DEFAULT_PCA_DIMS, DEFAULT_PQ_SUBVECTORS
+from selecta.EmbeddingStore import EmbeddingStore
+from selecta.SimilarityEngine import SimilarityEngine, DEFAULT_MEMORY_BUDGET_MB
+
+NEAREST_NEIGHBOURS = 10
+
+
+def write_store(directory: Path, embeddings: list) -> EmbeddingStore:
+    """An uncompressed embedding store holding the library, with stand-ins for analysed songs"""
+    store = EmbeddingStore(directory)
+    store.append(
+        [
+            SimpleNamespace(key=f"{i:032x}", name=f"{i}.mp3", path=Path(f"{i}.mp3"), simplified_yamnet_embeddings=e)
+            for i, e in enumerate(embeddings)
+        ]
+    )
+    return store
+
+
+def store_megabytes(directory: Path) -> float:
+    return sum(path.stat().st_size for path in directory.iterdir()) / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--songs", type=int, default=5000, help="Songs in the library, at most")
+    parser.add_argument("--store", type=Path, default=None, help="Embedding store of a library to use instead")
+    parser.add_argument("--pca-dims", type=int, default=DEFAULT_PCA_DIMS)
+    parser.add_argument("--pq-subvectors", type=int, default=DEFAULT_PQ_SUBVECTORS)
+    parser.add_argument("--neighbours", type=int, default=NEAREST_NEIGHBOURS, help="Neighbours compared per song")
+    parser.add_argument("--memory-budget-mb", type=float, default=DEFAULT_MEMORY_BUDGET_MB)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.store is None:
+        embeddings = synthetic_embeddings(args.songs, seed=args.seed)
+    else:
+        store = EmbeddingStore(args.store)
+        if not store.exists():
+            parser.error(f"No embedding store at {args.store}")
+        # Taken as stored, so the comparison is against the store's own compression if it has one
+        embeddings = [None if e is None else store.codec.reconstruct(e) for e in store.all_embeddings()[: args.songs]]
+    with tempfile.TemporaryDirectory(prefix="selecta-compression-") as workdir:
+        results = {}
+        for mode in COMPRESSION_MODES:
+            directory = Path(workdir) / mode
+            store = write_store(directory, embeddings)
+            start = time.perf_counter()
+            if mode != "none":
+                store = store.compress(mode, pca_dims=args.pca_dims, pq_subvectors=args.pq_subvectors)
+            compress_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            engine = SimilarityEngine(store.all_embeddings(), memory_budget_mb=args.memory_budget_mb, codec=store.codec)
+            matrix = engine.compute()
+            build_seconds = time.perf_counter() - start
+            results[mode] = (store_megabytes(directory), store.header["dim"], compress_seconds, build_seconds, matrix)
+
+    baseline_megabytes, _, _, baseline_seconds, baseline = results["none"]
+    print(f"{len(embeddings)} songs, top-{args.neighbours} neighbours compared against uncompressed float32 embeddings")
+    print(
+        f"{'mode':<8} {'dims':>5} {'store MB':>9} {'ratio':>6} {'compress s':>10} {'build s':>8} {'speed-up':>8} "
+        f"{'recall':>7} {'mean drift':>10}"
+    )
+    for mode, (megabytes, dims, compress_seconds, build_seconds, matrix) in results.items():
+        recall = neighbour_overlap(baseline, matrix, args.neighbours)
+        drift = np.nanmean(np.abs(matrix - baseline))
+        print(
+            f"{mode:<8} {dims:>5} {megabytes:>9.2f} {baseline_megabytes / megabytes:>5.1f}x {compress_seconds:>10.2f} "
+            f"{build_seconds:>8.2f} {baseline_seconds / build_seconds:>7.1f}x {100 * recall:>6.1f}% {drift:>10.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
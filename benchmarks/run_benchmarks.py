@@ -0,0 +1,295 @@
+"""
+Benchmarks Selecta's analysis and similarity stages on synthetic libraries of increasing size.
+
+Runs offline, with synthetic audio and embeddings and a stand-in for the YAMNet model (see synthetic.py), so no
+TensorFlow weights or music are needed. Results are saved as JSON, tagged with the git commit, and can be compared
+against an earlier run to catch regressions:
+
+    uv run python benchmarks/run_benchmarks.py --sizes 1000 10000
+    uv run python benchmarks/run_benchmarks.py --sizes 1000 10000 --compare benchmarks/results/<earlier run>.json
+
+Benchmarks:
+    scan              finding the library's .mp3 files, then computing content keys cold and with a warm cache
+    decode            decoding .wav files to 16kHz mono in both decode modes (a fixed sample of songs)
+    embed             batched inference with the stand-in model (a fixed sample of songs)
+    collapse          collapsing per-patch embeddings into segments
+    similarity_dense  building the dense similarity matrix, up to --dense-limit songs (the file grows quadratically)
+    similarity_topk   building the top-k neighbour graph
+    playlist_*        generating a batch of playlists from the dense matrix and the neighbour graph, from single root
+                      songs and from several seed songs each
+    delete_dense      deleting a few songs from the dense matrix, which only logs them
+    compact_dense     rewriting the dense matrix without its deleted songs
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import platform
+import argparse
+import subprocess
+import numpy as np
+
+from pathlib import Path
+
+from synthetic import (
+    StandInModel,
+    synthetic_embeddings,
+    synthetic_library,
+    synthetic_wav_files,
+    synthetic_waveform,
+)
+from selecta.ContentKeyIndex import ContentKeyIndex
+from selecta.LibraryScanner import LibraryScanner, RACY_MTIME_NS
+from selecta.NeighbourGraph import NeighbourGraph, DEFAULT_NEIGHBOURS
+from selecta.PlaylistGenerator import PlaylistGenerator
+from selecta.SimilarityEngine import SimilarityEngine
+from selecta.SimilarityMatrix import SimilarityMatrix
+from selecta.Song import Song
+from selecta.YamnetInference import YamnetInference, DEFAULT_INFERENCE_BATCH_SIZE
+
+RESULTS_DIR = Path(__file__).parent / "results"
+DEFAULT_SIZES = [1000, 10000, 50000]
+DEFAULT_DENSE_LIMIT = 10000
+# Per-song stages are timed on a fixed sample, as they scale linearly with the number of songs
+DEFAULT_SAMPLE_SONGS = 200
+SONG_SECONDS = 120
+PATCHES_PER_SONG = 250
+N_PLAYLISTS = 100
+PLAYLIST_LENGTH = 50
+SEEDS_PER_PLAYLIST = 4
+DELETED_SONGS = 10
+REGRESSION_THRESHOLD = 0.10
+
+
+def timed(function, *args, repeat: int = 1, **kwargs) -> tuple:
+    """Best wall time of `repeat` calls, and the result of the last one"""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_scan(size: int, workdir: Path, args) -> list:
+    library = workdir / "library"
+    synthetic_library(library, size)
+    # Backdate the freshly written directories, whose listings would otherwise be too recent to cache
+    backdated_ns = time.time_ns() - 2 * RACY_MTIME_NS
+    for directory, _, _ in os.walk(library):
+        os.utime(directory, ns=(backdated_ns, backdated_ns))
+
+    scan_cache_path = workdir / "scan_cache.pickle"
+    cold_scan_seconds, _ = timed(lambda: LibraryScanner(scan_cache_path).scan([library]), repeat=args.repeat)
+    scanner = LibraryScanner(scan_cache_path)
+    scanner.scan([library])
+    scanner.save()
+    warm_scan_seconds, song_paths = timed(lambda: LibraryScanner(scan_cache_path).scan([library]), repeat=args.repeat)
+
+    index = ContentKeyIndex(workdir / "content_keys.pickle")
+    cold_seconds, _ = timed(lambda: [index.key(path) for path in song_paths])
+    warm_seconds, _ = timed(lambda: [index.key(path) for path in song_paths], repeat=args.repeat)
+    return [
+        ("scan_cold", len(song_paths), cold_scan_seconds),
+        ("scan_warm", len(song_paths), warm_scan_seconds),
+        ("content_keys_cold", len(song_paths), cold_seconds),
+        ("content_keys_warm", len(song_paths), warm_seconds),
+    ]
+
+
+def bench_decode(size: int, workdir: Path, args) -> list:
+    n_songs = min(size, args.sample_songs)
+    paths = synthetic_wav_files(workdir / "wav", n_songs, seconds=args.decode_seconds)
+    results = []
+    for decode_mode in ("standard", "fast"):
+        seconds, _ = timed(lambda: [Song.load_audio(path, decode_mode=decode_mode) for path in paths])
+        results.append((f"decode_{decode_mode}", n_songs, seconds))
+    return results
+
+
+def bench_embed(size: int, workdir: Path, args) -> list:
+    n_songs = min(size, args.sample_songs)
+    rng = np.random.default_rng(0)
+    # Reuse a handful of waveforms, so that the sample doesn't need gigabytes of audio
+    waveforms = [synthetic_waveform(rng, SONG_SECONDS) for _ in range(DEFAULT_INFERENCE_BATCH_SIZE)]
+    inference = YamnetInference(StandInModel())
+
+    def embed():
+        for start in range(0, n_songs, DEFAULT_INFERENCE_BATCH_SIZE):
+            inference.embed(waveforms[: min(DEFAULT_INFERENCE_BATCH_SIZE, n_songs - start)])
+
+    seconds, _ = timed(embed, repeat=args.repeat)
+    return [("embed", n_songs, seconds)]
+
+
+def bench_collapse(size: int, workdir: Path, args) -> list:
+    rng = np.random.default_rng(0)
+    patches = [rng.random((PATCHES_PER_SONG, 1024), dtype=np.float32) for _ in range(16)]
+    seconds, _ = timed(
+        lambda: [Song.collapse_matrix(patches[i % len(patches)]) for i in range(size)], repeat=args.repeat
+    )
+    return [("collapse", size, seconds)]
+
+
+def bench_similarity_dense(size: int, workdir: Path, args) -> list:
+    if size > args.dense_limit:
+        return []
+    embeddings = synthetic_embeddings(size)
+    path = workdir / "similarity_matrix.f32"
+
+    def build():
+        matrix = SimilarityMatrix.allocate(path, [str(i) for i in range(size)])
+        SimilarityEngine(embeddings, memory_budget_mb=args.memory_budget_mb).compute(out=matrix.data)
+        matrix.commit()
+        return matrix
+
+    seconds, matrix = timed(build)
+    n_pairs = size * (size - 1) // 2
+    results = [("similarity_dense", n_pairs, seconds)] + bench_playlists(PlaylistGenerator(matrix), size, "dense", args)
+
+    deleted = [str(i) for i in np.random.default_rng(0).choice(size, DELETED_SONGS, replace=False)]
+    delete_seconds, _ = timed(matrix.delete, deleted)
+    compact_seconds, _ = timed(matrix.compact)
+    return results + [("delete_dense", DELETED_SONGS, delete_seconds), ("compact_dense", size, compact_seconds)]
+
+
+def bench_similarity_topk(size: int, workdir: Path, args) -> list:
+    embeddings = synthetic_embeddings(size)
+    keys = [str(i) for i in range(size)]
+
+    def build():
+        graph = NeighbourGraph.empty(keys, k=DEFAULT_NEIGHBOURS)
+        engine = SimilarityEngine(embeddings, memory_budget_mb=args.memory_budget_mb)
+        for row_songs, col_songs, medians in engine.iter_pairs():
+            graph.add_candidates(row_songs, col_songs, medians)
+        return graph
+
+    seconds, graph = timed(build)
+    n_pairs = size * (size - 1) // 2
+    return [("similarity_topk", n_pairs, seconds)] + bench_playlists(
+        PlaylistGenerator(neighbour_graph=graph), size, "topk", args
+    )
+
+
+def bench_playlists(generator: PlaylistGenerator, size: int, storage: str, args) -> list:
+    """Generates N_PLAYLISTS playlists in one batch, from single root songs and from several seeds each"""
+    rng = np.random.default_rng(0)
+    roots = [str(i) for i in rng.integers(0, size, N_PLAYLISTS)]
+    seed_sets = [[str(i) for i in rng.integers(0, size, SEEDS_PER_PLAYLIST)] for _ in range(N_PLAYLISTS)]
+    single_seconds, _ = timed(generator.generate, roots, PLAYLIST_LENGTH, repeat=args.repeat)
+    multi_seconds, _ = timed(generator.generate, seed_sets, PLAYLIST_LENGTH, repeat=args.repeat)
+    return [
+        (f"playlist_{storage}", N_PLAYLISTS, single_seconds),
+        (f"playlist_{storage}_multiseed", N_PLAYLISTS, multi_seconds),
+    ]
+
+
+BENCHMARKS = {
+    "scan": bench_scan,
+    "decode": bench_decode,
+    "embed": bench_embed,
+    "collapse": bench_collapse,
+    "similarity_dense": bench_similarity_dense,
+    "similarity_topk": bench_similarity_topk,
+}
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent
+        ).stdout.strip()
+        dirty = bool(
+            subprocess.run(
+                ["git", "status", "--porcelain", "--untracked-files=no"],
+                capture_output=True,
+                text=True,
+                cwd=Path(__file__).parent,
+            ).stdout.strip()
+        )
+    except OSError:
+        commit, dirty = None, None
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(results: list, baseline_path: Path, threshold: float) -> bool:
+    """Prints each result against the baseline's, returning whether any got slower by more than `threshold`"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    baseline_seconds = {(r["metric"], r["size"]): r["seconds"] for r in baseline["results"]}
+    print(f"\nCompared with {baseline_path} (commit {baseline['environment']['commit']}):")
+    regressed = False
+    for result in results:
+        before = baseline_seconds.get((result["metric"], result["size"]))
+        if before is None:
+            continue
+        ratio = result["seconds"] / before if before > 0 else np.inf
+        flag = ""
+        if ratio > 1 + threshold:
+            flag, regressed = "  REGRESSION", True
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print(
+            f"{result['metric']:<20} {result['size']:>7} {before:>10.3f}s -> {result['seconds']:>10.3f}s {ratio:>6.2f}x{flag}"
+        )
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Library sizes to benchmark")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="Only run these benchmarks")
+    parser.add_argument("--repeat", type=int, default=1, help="Repeats of the cheaper benchmarks (best is kept)")
+    parser.add_argument("--sample-songs", type=int, default=DEFAULT_SAMPLE_SONGS)
+    parser.add_argument("--decode-seconds", type=float, default=30, help="Length of the synthetic .wav files")
+    parser.add_argument("--dense-limit", type=int, default=DEFAULT_DENSE_LIMIT)
+    parser.add_argument("--memory-budget-mb", type=float, default=512)
+    parser.add_argument("--output", type=Path, default=None, help="Where to save results (default: benchmarks/results)")
+    parser.add_argument("--compare", type=Path, default=None, help="Earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="Slowdown counted as regression")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'metric':<20} {'size':>7} {'items':>12} {'seconds':>10} {'per item':>12}")
+    for size in args.sizes:
+        for name, benchmark in BENCHMARKS.items():
+            if args.only and name not in args.only:
+                continue
+            with tempfile.TemporaryDirectory() as workdir:
+                for metric, n_items, seconds in benchmark(size, Path(workdir), args):
+                    per_item_us = 1e6 * seconds / max(n_items, 1)
+                    results.append(
+                        {
+                            "metric": metric,
+                            "size": size,
+                            "items": n_items,
+                            "seconds": seconds,
+                            "per_item_us": per_item_us,
+                        }
+                    )
+                    print(f"{metric:<20} {size:>7} {n_items:>12} {seconds:>10.3f} {per_item_us:>10.2f}us")
+
+    report = {"environment": environment(), "arguments": {k: str(v) for k, v in vars(args).items()}, "results": results}
+    output = args.output or RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{report['environment']['commit']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
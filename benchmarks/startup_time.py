@@ -0,0 +1,130 @@
+"""
+Checks that the app starts within its time budget and without loading the analysis stack.
+
+TensorFlow, keras and librosa take seconds to import, and the YAMNet model longer still to load, so they must only be
+loaded once an analysis starts. Each check runs in a fresh interpreter, so nothing is already imported, and fails if
+the startup took longer than its budget or pulled in any of the modules it mustn't:
+
+    uv run python benchmarks/startup_time.py
+    uv run python benchmarks/startup_time.py --budget-s 0.5 --repeat 5
+
+The slowest imports are listed for any check that fails (from `python -X importtime`). Exits with 1 if a check failed.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+DEFAULT_BUDGET_S = 0.8
+DEFAULT_REPEAT = 3
+SLOWEST_IMPORTS_SHOWN = 15
+
+# Modules which are only needed to analyse songs, and so must never be imported at startup
+ANALYSIS_ONLY_MODULES = ["tensorflow", "keras", "librosa", "selecta.yamnet_model"]
+
+# Each check times its code in a fresh interpreter, then reports the time and which modules it had imported
+CHECKS = {
+    "gui_imports": {
+        "code": "import app.MainWindow",
+        "forbidden": ANALYSIS_ONLY_MODULES + ["app.AnalysisWorker", "selecta.SongProcessorDesktop"],
+    },
+    "gui_window": {
+        "code": "from PyQt5.QtWidgets import QApplication\n"
+        "from app.MainWindow import MainWindow\n"
+        "app = QApplication([])\n"
+        "window = MainWindow()\n"
+        "window.show()\n"
+        "app.processEvents()",
+        "forbidden": ANALYSIS_ONLY_MODULES + ["app.AnalysisWorker", "selecta.SongProcessorDesktop"],
+    },
+    "cli_imports": {
+        "code": "import selecta.cli",
+        "forbidden": ANALYSIS_ONLY_MODULES,
+    },
+}
+
+TIMER = """
+import sys, json, time
+start = time.perf_counter()
+exec(compile({code!r}, "<startup>", "exec"))
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "modules": sorted(sys.modules)}}))
+"""
+
+
+def environment() -> dict:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(SRC_DIR), env.get("PYTHONPATH")]))
+    # Lets the window check run without a display
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    return env
+
+
+def run_check(code: str) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", TIMER.format(code=code)], capture_output=True, text=True, env=environment()
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "check failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(code: str, n: int = SLOWEST_IMPORTS_SHOWN) -> list:
+    """The n imports which took longest, including their own imports, as (seconds, module)"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, env=environment()
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        # Lines look like "import time:      self [us] |  cumulative | imported package"
+        parts = line.removeprefix("import time:").split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            imports.append((int(parts[1]) / 1e6, parts[2].rstrip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-s", type=float, default=DEFAULT_BUDGET_S, help="Time allowed for each check")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Runs per check (the fastest is kept)")
+    parser.add_argument("--only", nargs="+", choices=list(CHECKS), help="Only run these checks")
+    args = parser.parse_args()
+
+    failed = False
+    for name, check in CHECKS.items():
+        if args.only and name not in args.only:
+            continue
+        try:
+            runs = [run_check(check["code"]) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{name:<12} ERROR {e}")
+            failed = True
+            continue
+
+        seconds = min(run["seconds"] for run in runs)
+        loaded = sorted(
+            module
+            for module in runs[0]["modules"]
+            if any(module == forbidden or module.startswith(forbidden + ".") for forbidden in check["forbidden"])
+        )
+        over_budget = seconds > args.budget_s
+        status = "FAIL" if over_budget or loaded else "ok"
+        print(f"{name:<12} {status:<4} {seconds:.3f}s (budget {args.budget_s:.3f}s)")
+        if loaded:
+            print(f"    imported analysis-only modules: {', '.join(loaded[:10])}{' ...' if len(loaded) > 10 else ''}")
+        if over_budget or loaded:
+            failed = True
+            print("    slowest imports (cumulative):")
+            for import_seconds, module in slowest_imports(check["code"]):
+                print(f"    {import_seconds:8.3f}s {module}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
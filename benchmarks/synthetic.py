@@ -0,0 +1,118 @@
+"""
+Synthetic data for the benchmarks: audio, embeddings, a music library on disk, and a stand-in for the YAMNet model.
+
+Everything is generated from a seed, so every run benchmarks exactly the same data.
+"""
+
+import numpy as np
+
+from pathlib import Path
+from scipy.io import wavfile
+
+from selecta.YamnetInference import SAMPLE_RATE, PATCH_WINDOW_SAMPLES, PATCH_HOP_SAMPLES
+
+EMBEDDING_DIM = 1024
+N_STYLES = 50
+# Most songs fill the full two minutes that are analysed (three collapsed segments), some are shorter
+SEGMENT_COUNTS = (1, 2, 3)
+SEGMENT_COUNT_WEIGHTS = (0.05, 0.10, 0.85)
+
+
+class StandInModel:
+    """
+    Offline stand-in for the YAMNet SavedModel, with the same call signature and output framing.
+
+    It frames the waveform into the same 0.96s patches as YAMNet and projects simple band energies of each patch to a
+    1024-dimensional non-negative embedding. It is far cheaper than YAMNet, so benchmarks using it measure Selecta's
+    own overhead around the model rather than TensorFlow.
+    """
+
+    class Output:
+        def __init__(self, array: np.ndarray):
+            self.array = array
+
+        def numpy(self) -> np.ndarray:
+            return self.array
+
+    def __init__(self, seed: int = 0, n_bands: int = 64):
+        self.n_bands = n_bands
+        self.projection = np.random.default_rng(seed).standard_normal((n_bands, EMBEDDING_DIM)).astype(np.float32)
+
+    def __call__(self, waveform) -> dict:
+        waveform = np.asarray(waveform, dtype=np.float32)
+        # Pad like YAMNet: at least one patch, then a whole number of hops
+        n_samples = max(len(waveform), PATCH_WINDOW_SAMPLES)
+        n_hops = -(-(n_samples - PATCH_WINDOW_SAMPLES) // PATCH_HOP_SAMPLES)
+        padded = np.zeros(PATCH_WINDOW_SAMPLES + n_hops * PATCH_HOP_SAMPLES, dtype=np.float32)
+        padded[: len(waveform)] = waveform
+
+        patches = np.lib.stride_tricks.sliding_window_view(padded, PATCH_WINDOW_SAMPLES)[::PATCH_HOP_SAMPLES]
+        band_samples = PATCH_WINDOW_SAMPLES // self.n_bands
+        bands = patches[:, : band_samples * self.n_bands].reshape(len(patches), self.n_bands, band_samples)
+        features = np.log(np.float32(1e-6) + bands.var(axis=2))
+        return {"output_1": self.Output(np.maximum(features @ self.projection, 0))}
+
+
+def synthetic_waveform(rng: np.random.Generator, seconds: float, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """A few tones with a slow amplitude envelope, plus noise"""
+    t = np.arange(int(seconds * sample_rate), dtype=np.float32) / sample_rate
+    waveform = np.zeros_like(t)
+    for frequency in rng.uniform(50, 2000, size=4):
+        waveform += np.sin(2 * np.pi * np.float32(frequency) * t) * np.float32(rng.uniform(0.1, 0.5))
+    waveform *= 0.6 + 0.4 * np.sin(2 * np.pi * np.float32(rng.uniform(0.05, 0.5)) * t)
+    waveform += rng.standard_normal(len(t)).astype(np.float32) * np.float32(0.05)
+    return waveform
+
+
+def synthetic_embeddings(n_songs: int, seed: int = 0) -> list:
+    """
+    Collapsed segment embeddings for a library of songs, as stored in the embedding store.
+
+    Songs are drawn around a number of "styles", so that they have genuine nearest neighbours.
+    """
+    rng = np.random.default_rng(seed)
+    styles = rng.gamma(0.5, 1.0, size=(N_STYLES, EMBEDDING_DIM)).astype(np.float32)
+    song_styles = rng.integers(0, N_STYLES, size=n_songs)
+    segment_counts = rng.choice(SEGMENT_COUNTS, size=n_songs, p=SEGMENT_COUNT_WEIGHTS)
+
+    embeddings = []
+    for style, n_segments in zip(song_styles, segment_counts):
+        song = styles[style] + rng.gamma(0.5, 0.5, size=EMBEDDING_DIM).astype(np.float32)
+        segments = song + rng.gamma(0.5, 0.2, size=(n_segments, EMBEDDING_DIM)).astype(np.float32)
+        embeddings.append(segments)
+    return embeddings
+
+
+def synthetic_library(directory: Path, n_songs: int, seed: int = 0, songs_per_folder: int = 100) -> list:
+    """
+    Writes a library of small fake .mp3 files (an ID3 tag followed by random bytes), in nested folders.
+
+    The files can't be decoded, but have everything scanning and content keys look at.
+    """
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(n_songs):
+        folder = Path(directory) / f"artist_{i // (songs_per_folder * 10):03d}" / f"album_{i // songs_per_folder:04d}"
+        if i % songs_per_folder == 0:
+            folder.mkdir(parents=True, exist_ok=True)
+        path = folder / f"{i % songs_per_folder:02d} Track {i}.mp3"
+        id3_header = b"ID3\x03\x00\x00\x00\x00\x00\x40" + bytes(64)
+        path.write_bytes(id3_header + rng.bytes(2048))
+        paths.append(path)
+    return paths
+
+
+def synthetic_wav_files(directory: Path, n_songs: int, seconds: float, sample_rate: int = 44100, seed: int = 0) -> list:
+    """Writes decodable 16-bit stereo .wav files of synthetic audio at a typical CD sample rate"""
+    rng = np.random.default_rng(seed)
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(n_songs):
+        left = synthetic_waveform(rng, seconds, sample_rate)
+        right = synthetic_waveform(rng, seconds, sample_rate)
+        stereo = np.stack([left, right], axis=1)
+        stereo = (stereo / np.abs(stereo).max() * 32767 * 0.9).astype(np.int16)
+        path = Path(directory) / f"song_{i:05d}.wav"
+        wavfile.write(path, sample_rate, stereo)
+        paths.append(path)
+    return paths
@@ -1,7 +1,10 @@
+import threading
+
 import pandas as pd
 from PyQt5.QtCore import QRunnable, pyqtSlot
 
 from app.AnalysisWorkerSignals import AnalysisWorkerSignals
+from selecta.ProgressBus import ProgressBus, log_progress
 from selecta.SongProcessorDesktop import SongProcessorDesktop
 
 
@@ -10,11 +13,45 @@ class AnalysisWorker(QRunnable):
         super().__init__()
         self.new_songs_df = new_songs_df
         self.signals = AnalysisWorkerSignals()
+        self.progress = ProgressBus()
+        self.progress.subscribe(self.emit_signals)
+        self.progress.subscribe(log_progress)
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        """Stops the analysis as soon as possible. Whatever was done so far is kept, and picked up by the next run"""
+        self.cancel_event.set()
+
+    def emit_signals(self, event):
+        """Forwards (already rate limited) progress events to the Qt signals"""
+        if event.stage == "status":
+            self.signals.status.emit(event.message)
+            if event.message == "Done":
+                # Reset the panel ready for the next run
+                self.signals.analysis_progress.emit(0)
+                self.signals.similarity_progress.emit(0)
+                self.signals.status.emit("")
+            elif event.message == "Cancelled":
+                self.signals.analysis_progress.emit(0)
+                self.signals.similarity_progress.emit(0)
+                self.signals.status.emit("Analysis cancelled, it will resume from here next time")
+            return
+
+        self.signals.status.emit(event.describe())
+        if event.stage == "analysis":
+            self.signals.analysis_progress.emit(round(event.percentage))
+        elif event.stage == "similarity":
+            self.signals.similarity_progress.emit(round(event.percentage))
 
     @pyqtSlot()
     def run(self):
         new_song_paths = list(self.new_songs_df["location"])
-        song_processor = SongProcessorDesktop(
-            local_song_paths=new_song_paths,
-        )
-        song_processor.run(signals=self.signals)
+        try:
+            song_processor = SongProcessorDesktop(
+                local_song_paths=new_song_paths,
+                progress=self.progress,
+                cancel_event=self.cancel_event,
+            )
+            song_processor.run()
+        finally:
+            self.signals.finished.emit()
@@ -8,9 +8,12 @@ class AnalysisWorkerSignals(QObject):
         str idictating current status
     progress
         int indicating % progress
+    finished
+        emitted when the worker stops, whether it completed, was cancelled or failed
 
     """
 
     status = pyqtSignal(str)
     analysis_progress = pyqtSignal(int)
     similarity_progress = pyqtSignal(int)
+    finished = pyqtSignal()
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex
+
+
+class DataFrameTableModel(QAbstractTableModel):
+    """
+    Read-only table model serving its cells straight from a DataFrame.
+
+    Unlike a `QStandardItemModel`, no item is created per cell: a view asks for the rows it is showing and they are
+    formatted on demand, so building or replacing the model costs the same for 100 songs as for 100k. Sorting reorders
+    an array of row numbers rather than the rows themselves, and `source_row` maps a row of the view back to the
+    DataFrame.
+    """
+
+    def __init__(self, df: pd.DataFrame, columns: list, headers: list = None, parent=None):
+        super().__init__(parent)
+        self.columns = list(columns)
+        self.headers = list(headers) if headers is not None else self.columns
+        self.sort_column = None
+        self.sort_order = Qt.AscendingOrder
+        self.set_dataframe(df)
+
+    def set_dataframe(self, df: pd.DataFrame):
+        """Replaces the rows shown, keeping the current sort order"""
+        self.beginResetModel()
+        self.df = df.reset_index(drop=True)
+        self.values = [self.df[column].to_numpy(dtype=object) for column in self.columns]
+        self.order = self.sorted_order() if self.sort_column is not None else np.arange(len(self.df))
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.order)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.ToolTipRole):
+            return None
+        value = self.values[index.column()][self.order[index.row()]]
+        return "" if pd.isna(value) else str(value)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.headers[section]
+        return str(section + 1)
+
+    def sorted_order(self) -> np.ndarray:
+        # Case-insensitive, with missing values last, like QStandardItemModel
+        values = self.values[self.sort_column]
+        sort_keys = [
+            "\U0010ffff" if missing else str(value).casefold() for value, missing in zip(values, pd.isna(values))
+        ]
+        order = sorted(range(len(sort_keys)), key=sort_keys.__getitem__, reverse=self.sort_order == Qt.DescendingOrder)
+        return np.array(order, dtype=np.int64)
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if column < 0 or column >= len(self.columns):
+            return
+        self.layoutAboutToBeChanged.emit()
+        self.sort_column, self.sort_order = column, order
+        previous_order = self.order
+        self.order = self.sorted_order()
+
+        # Keep selections and other persistent indexes on the same rows of the DataFrame
+        positions = np.empty_like(self.order)
+        positions[self.order] = np.arange(len(self.order))
+        persistent_indexes = self.persistentIndexList()
+        self.changePersistentIndexList(
+            persistent_indexes,
+            [self.index(int(positions[previous_order[index.row()]]), index.column()) for index in persistent_indexes],
+        )
+        self.layoutChanged.emit()
+
+    def source_row(self, row: int) -> int:
+        """Position in the DataFrame of a row of the view"""
+        return int(self.order[row])
+
+    def source_rows(self, indexes: list) -> pd.DataFrame:
+        """Rows of the DataFrame behind a list of view indexes, e.g. a selection"""
+        return self.df.iloc[sorted({self.source_row(index.row()) for index in indexes})]
@@ -0,0 +1,180 @@
+import threading
+
+import pandas as pd
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from selecta.logger import generate_logger
+from selecta.utils import (
+    get_embedding_store,
+    get_similarity_matrix_cache,
+    get_neighbour_graph_cache,
+    get_playlists_cache,
+    save_playlists_cache,
+)
+
+logger = generate_logger()
+
+
+class LibraryState(QObject):
+    """
+    The app's in-memory copy of the library: its songs, similarity data and playlists, shared by every panel.
+
+    Each cache is read from disk once, when it is first needed. Changes made in the app go through this object, which
+    applies them in memory, writes them through to the caches and emits the matching *_changed signal, so views update
+    without reading anything back. An analysis writes the caches from its own processes, so once it finishes
+    `reload_analysis` drops the songs and similarity data, to be read again on next use.
+
+    Deleted songs are only logged in each cache (see `TombstoneLog`). Once a cache holds enough of them it is compacted
+    in a background thread, which writes a new copy while the current one stays readable. The copy replaces it in
+    `finish_compaction`, which only then removes the files of the old one. Nothing else writes the caches meanwhile:
+    deleting more songs, generating or exporting playlists and starting an analysis first wait for the compaction to
+    finish.
+    """
+
+    songs_changed = pyqtSignal()
+    similarities_changed = pyqtSignal()
+    playlists_changed = pyqtSignal()
+    compaction_finished = pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        self._embedding_store = None
+        self._similarity_matrix = None
+        self._neighbour_graph = None
+        self._neighbour_graph_loaded = False
+        self._playlists_df = None
+        self.compaction_thread = None
+        self.compacted_caches = {}
+        self.compaction_finished.connect(self.finish_compaction)
+
+    @property
+    def embedding_store(self):
+        if self._embedding_store is None:
+            self._embedding_store = get_embedding_store()
+        return self._embedding_store
+
+    @property
+    def songs_df(self) -> pd.DataFrame:
+        # Songs are identified by the "key" column
+        return self.embedding_store.songs_df
+
+    @property
+    def similarity_matrix(self):
+        if self._similarity_matrix is None:
+            self._similarity_matrix = get_similarity_matrix_cache()
+        return self._similarity_matrix
+
+    @property
+    def neighbour_graph(self):
+        """Top-k neighbour graph, or None if the library was never analysed with top-k storage"""
+        if not self._neighbour_graph_loaded:
+            self._neighbour_graph = get_neighbour_graph_cache()
+            self._neighbour_graph_loaded = True
+        return self._neighbour_graph
+
+    @property
+    def playlists_df(self) -> pd.DataFrame:
+        if self._playlists_df is None:
+            self._playlists_df = get_playlists_cache()
+        return self._playlists_df
+
+    def reload_analysis(self):
+        """Forgets the songs and similarity data, after an analysis has rewritten them"""
+        self.finish_compaction()
+        self._embedding_store = None
+        self._similarity_matrix = None
+        self._neighbour_graph = None
+        self._neighbour_graph_loaded = False
+        self.songs_changed.emit()
+        self.similarities_changed.emit()
+
+    def add_playlists(self, playlists: list):
+        """
+        Adds playlists to the library.
+
+        Args:
+            playlists (list): (name, song names) pairs.
+        """
+        new_playlists_df = pd.DataFrame(playlists, columns=["name", "songs"])
+        if self.playlists_df.empty:
+            self._playlists_df = new_playlists_df
+        else:
+            self._playlists_df = pd.concat([self.playlists_df, new_playlists_df], ignore_index=True)
+        save_playlists_cache(self._playlists_df)
+        self.playlists_changed.emit()
+
+    def delete_playlist(self, name: str):
+        self._playlists_df = self.playlists_df[self.playlists_df["name"] != name].reset_index(drop=True)
+        save_playlists_cache(self._playlists_df)
+        self.playlists_changed.emit()
+
+    def delete_songs(self, song_keys: list):
+        """
+        Removes songs from the embedding store, the similarity data and every playlist.
+
+        The songs are logged as deleted in each cache, so this costs O(songs deleted) rather than rewriting the caches.
+        """
+        self.finish_compaction()
+        embedding_store = self.embedding_store
+
+        # Playlists refer to songs by name
+        song_names = set(embedding_store.metadata.loc[embedding_store.metadata["key"].isin(song_keys), "name"])
+
+        embedding_store.delete(song_keys)
+        self.similarity_matrix.delete(song_keys)
+        # The neighbour graph only exists if the top-k storage mode is in use
+        if self.neighbour_graph is not None:
+            self.neighbour_graph.delete(song_keys)
+
+        playlists_df = self.playlists_df.copy()
+        playlists_df["songs"] = playlists_df["songs"].apply(
+            lambda songs: [song_name for song_name in songs if song_name not in song_names]
+        )
+        self._playlists_df = playlists_df
+        save_playlists_cache(playlists_df)
+
+        self.songs_changed.emit()
+        self.similarities_changed.emit()
+        self.playlists_changed.emit()
+
+        self.start_compaction()
+
+    def start_compaction(self):
+        """Compacts the caches holding enough deleted songs in a background thread"""
+        caches = {
+            name: cache
+            for name, cache in [
+                ("_embedding_store", self.embedding_store),
+                ("_similarity_matrix", self.similarity_matrix),
+                ("_neighbour_graph", self.neighbour_graph),
+            ]
+            if cache is not None and cache.needs_compaction
+        }
+        if not caches or self.compaction_thread is not None:
+            return
+        self.compaction_thread = threading.Thread(
+            target=self.compact, args=(caches,), name="cache-compaction", daemon=True
+        )
+        self.compaction_thread.start()
+
+    def compact(self, caches: dict):
+        try:
+            for name, cache in caches.items():
+                # The old files are removed once nothing reads them, see `finish_compaction`
+                self.compacted_caches[name] = cache.compact(keep_old_generations=True)
+        except Exception as e:
+            # The caches are left as they were, with their deleted songs logged
+            logger.error(f"Error compacting caches: {e}")
+        self.compaction_finished.emit()
+
+    def finish_compaction(self):
+        """Waits for a running compaction, switches to the compacted caches and removes the files they replace"""
+        if self.compaction_thread is None:
+            return
+        self.compaction_thread.join()
+        self.compaction_thread = None
+        for name, cache in self.compacted_caches.items():
+            setattr(self, name, cache)
+            cache.remove_old_generations()
+        self.compacted_caches = {}
@@ -5,6 +5,7 @@ from PyQt5.QtWidgets import (
 from PyQt5.QtCore import Qt
 
 from selecta.logger import generate_logger
+from app.LibraryState import LibraryState
 from app.SongsPanel import SongsPanel
 from app.PlaylistsPanel import PlaylistsPanel
 
@@ -17,9 +18,10 @@ class MainWindow(QMainWindow):
         super().__init__()
         self.setWindowTitle("Selecta")
 
-        # Create SongsPanel and PlaylistsPanel widgets
-        self.songs_panel = SongsPanel()
-        self.playlists_panel = PlaylistsPanel()
+        # Both panels share one copy of the library, which notifies them of each other's changes
+        self.library = LibraryState()
+        self.songs_panel = SongsPanel(self.library)
+        self.playlists_panel = PlaylistsPanel(self.library)
 
         # Use QSplitter for resizable layout
         splitter = QSplitter(Qt.Horizontal)
@@ -29,3 +31,10 @@ class MainWindow(QMainWindow):
 
         # Set splitter as central widget
         self.setCentralWidget(splitter)
+
+    def closeEvent(self, event):
+        # Stop a running analysis cleanly, so that it checkpoints its progress and its worker processes exit
+        self.songs_panel.cancel_analysis()
+        self.songs_panel.threadpool.waitForDone()
+        self.library.finish_compaction()
+        super().closeEvent(event)
@@ -1,4 +1,3 @@
-import pickle
 from pathlib import Path
 
 from PyQt5.QtCore import Qt
@@ -20,28 +19,29 @@ from PyQt5.QtWidgets import (
     QAbstractItemView,
     QHBoxLayout,
     QFileDialog,
+    QInputDialog,
+    QListWidget,
+    QListWidgetItem,
 )
-from PyQt5.QtGui import QStandardItemModel, QStandardItem
 
-import os
-import shutil
-import tempfile
-from zipfile import ZipFile
+import pandas as pd
 
+from app.LibraryState import LibraryState
+from app.DataFrameTableModel import DataFrameTableModel
 from selecta.logger import generate_logger
-from selecta.utils import local_app_data_dir, get_playlists_cache, get_songs_cache, get_similarity_matrix_cache
+from selecta.PlaylistExporter import PlaylistExporter, EXPORT_SUFFIXES, safe_file_name
+from selecta.PlaylistGenerator import PlaylistGenerator, SEED_COMBINE_MODES
 
 # Logger
 logger = generate_logger()
 
 
 class PlaylistWidget(QWidget):
-    def __init__(self, playlist_name, songs, songs_df):
+    def __init__(self, playlist_name, songs, library: LibraryState):
         super().__init__()
-        self.playlists_df = get_playlists_cache()
         self.playlist_name = playlist_name
         self.songs = songs
-        self.songs_df = songs_df
+        self.library = library
         self.expanded = False
 
         self.layout = QVBoxLayout()
@@ -50,23 +50,23 @@ class PlaylistWidget(QWidget):
         self.toggle_button.clicked.connect(self.toggle_content)
         self.layout.addWidget(self.toggle_button)
 
-        # Content widget (initially hidden)
-        self.content_widget = QWidget()
-        self.content_layout = QVBoxLayout()
+        # Content widget, built the first time the playlist is expanded
+        self.content_widget = None
+        self.setLayout(self.layout)
 
-        self.table_view = QTableView()
-        self.model = QStandardItemModel()
-        self.model.setHorizontalHeaderLabels(["Song Name"])
-        for song in songs:
-            self.model.appendRow([QStandardItem(song)])
+    def create_content_widget(self) -> QWidget:
+        content_widget = QWidget()
+        content_layout = QVBoxLayout()
 
+        self.table_view = QTableView()
+        self.model = DataFrameTableModel(pd.DataFrame({"name": self.songs}), columns=["name"], headers=["Song Name"])
         self.table_view.setModel(self.model)
         self.table_view.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
         self.table_view.setSelectionBehavior(QAbstractItemView.SelectRows)
         self.table_view.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.table_view.setSortingEnabled(True)
 
-        self.content_layout.addWidget(self.table_view)
+        content_layout.addWidget(self.table_view)
 
         button_layout = QHBoxLayout()
         self.download_button = QPushButton("Download")
@@ -76,63 +76,62 @@ class PlaylistWidget(QWidget):
         button_layout.addWidget(self.download_button)
         button_layout.addWidget(self.delete_button)
 
-        self.content_layout.addLayout(button_layout)
-        self.content_widget.setLayout(self.content_layout)
-        self.content_widget.setVisible(False)
-        self.layout.addWidget(self.content_widget)
-        self.setLayout(self.layout)
+        content_layout.addLayout(button_layout)
+        content_widget.setLayout(content_layout)
+        return content_widget
 
     def toggle_content(self):
         self.expanded = not self.expanded
-        self.content_widget.setVisible(self.expanded)
+        if self.expanded and self.content_widget is None:
+            self.content_widget = self.create_content_widget()
+            self.layout.addWidget(self.content_widget)
+        if self.content_widget is not None:
+            self.content_widget.setVisible(self.expanded)
         self.toggle_button.setText(("▼ " if self.expanded else "▶ ") + self.playlist_name)
 
     def download_playlist(self):
-        try:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                song_paths = []
-
-                for song_name in self.songs:
-                    row = self.songs_df[self.songs_df["name"] == song_name]
-                    if not row.empty:
-                        song_path = row.iloc[0]["location"]
-                        if os.path.isfile(song_path):
-                            dest_path = os.path.join(temp_dir, os.path.basename(song_path))
-                            shutil.copy2(song_path, dest_path)
-                            song_paths.append(dest_path)
-
-                if not song_paths:
-                    QMessageBox.warning(None, "Download Failed", "No valid song files found for this playlist.")
-                    return
-
-                zip_file_path, _ = QFileDialog.getSaveFileName(
-                    self, "Save Playlist Zip", f"{self.playlist_name}.zip", "Zip Files (*.zip)"
-                )
-                if not zip_file_path:
-                    return
-
-                with ZipFile(zip_file_path, "w") as zipf:
-                    for path in song_paths:
-                        zipf.write(path, os.path.basename(path))
-
-                QMessageBox.information(None, "Download Complete", f"Playlist saved:\n{zip_file_path}")
+        # Archives copy the audio files, the other formats only reference them where they are
+        file_filters = {
+            "zip": "Zip Files (*.zip)",
+            "m3u8": "M3U8 Playlists (*.m3u8)",
+            "rekordbox": "Rekordbox XML (*.xml)",
+        }
+        export_path, selected_filter = QFileDialog.getSaveFileName(
+            self, "Save Playlist", f"{safe_file_name(self.playlist_name)}.zip", ";;".join(file_filters.values())
+        )
+        if not export_path:
+            return
+        # A typed suffix takes precedence over the selected filter
+        suffix_formats = {suffix: export_format for export_format, suffix in EXPORT_SUFFIXES.items()}
+        export_format = suffix_formats.get(Path(export_path).suffix.lower()) or next(
+            (export_format for export_format, file_filter in file_filters.items() if file_filter == selected_filter),
+            "zip",
+        )
 
+        try:
+            self.library.finish_compaction()
+            exporter = PlaylistExporter(self.library.songs_df)
+            missing, failed = exporter.export([(self.playlist_name, self.songs)], Path(export_path), export_format)
         except Exception as e:
             logger.error(f"Error downloading playlist: {e}")
-            QMessageBox.critical(None, "Error", "An error occurred while creating the playlist zip file.")
+            QMessageBox.critical(None, "Error", "An error occurred while saving the playlist.")
+            return
+
+        if failed:
+            QMessageBox.warning(
+                None, "Download Failed", "No valid song files found for this playlist, nothing was saved."
+            )
+        elif missing:
+            QMessageBox.warning(
+                None, "Download Incomplete", f"Playlist saved:\n{export_path}\n\n{len(missing)} songs were not found."
+            )
+        else:
+            QMessageBox.information(None, "Download Complete", f"Playlist saved:\n{export_path}")
 
     def delete_playlist(self, name):
         try:
-            # Drop playlist by name
-            self.playlists_df = self.playlists_df[self.playlists_df["name"] != name]
-
-            # Save back to cache
-            local_path = Path(f"{local_app_data_dir}/cache/playlists.pickle")
-            with open(local_path, "wb") as f:
-                pickle.dump(self.playlists_df, f)
-
-            # Refresh UI
-            self.setParent(None)
+            # Drop playlist by name, which redisplays the playlists
+            self.library.delete_playlist(name)
 
             QMessageBox.information(None, "Playlist Deleted", f"{name} has been deleted.")
 
@@ -140,13 +139,9 @@ class PlaylistWidget(QWidget):
             logger.error(f"Error deleting playlist {name}: {e}")
             QMessageBox.critical(None, "Error", "An error occurred while deleting the playlist.")
 
-    def refresh(self):
-        self.songs, self.songs_df = get_songs_cache()
-        self.playlists_df = get_playlists_cache()
-
 
 class CreatePlaylistDialog(QDialog):
-    def __init__(self, song_names):
+    def __init__(self, songs_df):
         super().__init__()
         self.setWindowTitle("Create Playlist")
         self.setMinimumWidth(300)
@@ -158,13 +153,36 @@ class CreatePlaylistDialog(QDialog):
 
         self.root_song_combo = QComboBox()
         self.root_song_combo.setEditable(True)
-        self.root_song_combo.addItems(sorted(song_names))
+        # Songs are shown by name but identified by content key, since different files can share a name
+        for song in songs_df.sort_values("name").itertuples(index=False):
+            self.root_song_combo.addItem(song.name, song.key)
         completer = self.root_song_combo.completer()
         completer.setCaseSensitivity(Qt.CaseInsensitive)
         layout.addRow("Root Song:", self.root_song_combo)
 
+        # Further seed songs are picked from the same list, and removed again by double clicking them
+        self.seed_combo = QComboBox()
+        self.seed_combo.setEditable(True)
+        self.seed_combo.setModel(self.root_song_combo.model())
+        self.seed_combo.completer().setCaseSensitivity(Qt.CaseInsensitive)
+        add_seed_button = QPushButton("Add")
+        add_seed_button.clicked.connect(self.add_seed)
+        seed_layout = QHBoxLayout()
+        seed_layout.addWidget(self.seed_combo)
+        seed_layout.addWidget(add_seed_button)
+        layout.addRow("More Seed Songs:", seed_layout)
+        self.seed_list = QListWidget()
+        self.seed_list.setMaximumHeight(100)
+        self.seed_list.itemDoubleClicked.connect(lambda item: self.seed_list.takeItem(self.seed_list.row(item)))
+        layout.addRow(self.seed_list)
+
+        self.combine_combo = QComboBox()
+        for mode, description in SEED_COMBINE_MODES.items():
+            self.combine_combo.addItem(description.capitalize(), mode)
+        layout.addRow("Songs Ranked By:", self.combine_combo)
+
         self.num_songs_spin = QSpinBox()
-        self.num_songs_spin.setRange(1, len(song_names) - 1)
+        self.num_songs_spin.setRange(1, len(songs_df) - 1)
         layout.addRow("Number of Songs:", self.num_songs_spin)
 
         self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
@@ -172,16 +190,27 @@ class CreatePlaylistDialog(QDialog):
         self.buttons.rejected.connect(self.reject)
         layout.addRow(self.buttons)
 
+    def add_seed(self):
+        index = self.seed_combo.findText(self.seed_combo.currentText())
+        if index < 0:
+            return
+        item = QListWidgetItem(self.seed_combo.itemText(index))
+        item.setData(Qt.UserRole, self.seed_combo.itemData(index))
+        self.seed_list.addItem(item)
+
     def get_values(self):
-        return self.name_input.text(), self.root_song_combo.currentText(), self.num_songs_spin.value()
+        root_song_index = self.root_song_combo.findText(self.root_song_combo.currentText())
+        root_song_key = self.root_song_combo.itemData(root_song_index) if root_song_index >= 0 else None
+        seed_song_keys = [root_song_key] + [
+            self.seed_list.item(i).data(Qt.UserRole) for i in range(self.seed_list.count())
+        ]
+        return self.name_input.text(), seed_song_keys, self.num_songs_spin.value(), self.combine_combo.currentData()
 
 
 class PlaylistsPanel(QWidget):
-    def __init__(self):
+    def __init__(self, library: LibraryState):
         super().__init__()
-        self.songs, self.songs_df = get_songs_cache()
-        self.similarity_matrix_df = get_similarity_matrix_cache()
-        self.playlists_df = get_playlists_cache()
+        self.library = library
 
         # Main Layout
         self.layout = QVBoxLayout()
@@ -191,6 +220,10 @@ class PlaylistsPanel(QWidget):
         self.create_button.clicked.connect(self.create_playlist_dialog)
         self.layout.addWidget(self.create_button)
 
+        self.generate_button = QPushButton("Generate Playlists From File")
+        self.generate_button.clicked.connect(self.generate_playlists_from_file)
+        self.layout.addWidget(self.generate_button)
+
         self.scroll_area = QScrollArea()
         self.scroll_area.setWidgetResizable(True)
         self.scroll_widget = QWidget()
@@ -201,59 +234,84 @@ class PlaylistsPanel(QWidget):
         self.layout.addWidget(self.scroll_area)
 
         self.display_playlists()
+        self.library.playlists_changed.connect(self.display_playlists)
 
     def create_playlist_dialog(self):
-        self.refresh()
-
-        if self.songs_df is None or self.similarity_matrix_df is None:
+        if self.library.songs_df is None or self.library.similarity_matrix is None:
             QMessageBox.warning(None, "Missing Data", "Songs or similarity matrix not available.")
             return
 
-        dialog = CreatePlaylistDialog(self.songs_df["name"].tolist())
+        dialog = CreatePlaylistDialog(self.library.songs_df)
         if dialog.exec_():
-            name, root_song, n = dialog.get_values()
-            self.generate_playlist(name, root_song, n)
-
-        self.refresh()
-
-    def generate_playlist(self, name, root_song, n):
-        if root_song not in self.similarity_matrix_df.index:
-            QMessageBox.warning(None, "Invalid Root Song", "Selected root song not found in similarity matrix.")
+            name, seed_songs, n, combine = dialog.get_values()
+            self.generate_playlist(name, seed_songs, n, combine)
+
+    def generate_playlist(self, name, seed_songs, n, combine="centroid"):
+        # seed_songs are content keys, the root song first; playlists store song names
+        self.library.finish_compaction()
+        generator = PlaylistGenerator(self.library.similarity_matrix, self.library.neighbour_graph)
+        [playlist_songs] = generator.generate([seed_songs], n, combine=combine)
+        if playlist_songs is None:
+            QMessageBox.warning(None, "Invalid Root Song", "Selected songs not found in the similarity data.")
+            return
+        if len(playlist_songs) < n:
+            QMessageBox.warning(None, "Playlist Truncated", f"Only {len(playlist_songs)} similar songs were found.")
+
+        songs_df = self.library.songs_df
+        song_names = dict(zip(songs_df["key"], songs_df["name"]))
+        playlist_songs = [
+            song_names[key] for key in list(dict.fromkeys(seed_songs)) + playlist_songs if key in song_names
+        ]
+
+        self.library.add_playlists([(name, playlist_songs)])
+
+    def generate_playlists_from_file(self):
+        """Generates every playlist described by a seeds file, the format `python -m selecta playlists` reads"""
+        songs_df = self.library.songs_df
+        seeds_path, _ = QFileDialog.getOpenFileName(self, "Open Playlist Seeds", "", "JSON Files (*.json)")
+        if not seeds_path:
+            return
+        n, ok = QInputDialog.getInt(self, "Generate Playlists", "Songs per playlist:", 30, 1, max(len(songs_df) - 1, 1))
+        if not ok:
             return
 
-        similarities = self.similarity_matrix_df.loc[root_song]
-        most_similar = similarities.sort_values(ascending=True)
-        most_similar = most_similar[most_similar.index != root_song]
-        playlist_songs = most_similar.head(n).index.tolist()
-        playlist_songs = [root_song] + playlist_songs
-
-        self.update_playlists_cache(name, playlist_songs)
+        try:
+            specs = PlaylistGenerator.read_seeds_file(Path(seeds_path), songs_df)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Error reading playlist seeds {seeds_path}: {e}")
+            QMessageBox.critical(None, "Error", "The playlist seeds file could not be read.")
+            return
 
-    @staticmethod
-    def update_playlists_cache(name, songs):
-        playlists_df = get_playlists_cache()
-        playlists_df.loc[len(playlists_df)] = {"name": name, "songs": songs}
-        local_path = Path(f"{local_app_data_dir}/cache/playlists.pickle")
-        local_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(local_path, "wb") as f:
-            pickle.dump(playlists_df, f)
+        self.library.finish_compaction()
+        generator = PlaylistGenerator(self.library.similarity_matrix, self.library.neighbour_graph)
+        generated = generator.generate([seed_keys for _, seed_keys, _ in specs], n)
+        song_names = dict(zip(songs_df["key"], songs_df["name"]))
+        playlists = [
+            (name, [song_names[key] for key in seed_keys + playlist_songs])
+            for (name, seed_keys, unknown), playlist_songs in zip(specs, generated)
+            if playlist_songs is not None and not unknown
+        ]
+        self.library.add_playlists(playlists)
+
+        message = f"Generated {len(playlists)} playlists."
+        if len(playlists) < len(specs):
+            message += f" {len(specs) - len(playlists)} could not be generated, as their seed songs were not found."
+        QMessageBox.information(None, "Playlists Generated", message)
 
     def display_playlists(self):
+        # Relayout once at the end rather than after every playlist
+        self.scroll_widget.setUpdatesEnabled(False)
         for i in reversed(range(self.scroll_layout.count())):
             widget_to_remove = self.scroll_layout.itemAt(i).widget()
             if widget_to_remove:
                 widget_to_remove.setParent(None)
+                widget_to_remove.deleteLater()
 
-        for row in self.playlists_df.itertuples(index=False):
+        for row in self.library.playlists_df.itertuples(index=False):
             widget = PlaylistWidget(
                 playlist_name=row.name,
                 songs=row.songs,
-                songs_df=self.songs_df,
+                library=self.library,
             )
             self.scroll_layout.addWidget(widget)
-
-    def refresh(self):
-        self.songs, self.songs_df = get_songs_cache()
-        self.similarity_matrix_df = get_similarity_matrix_cache()
-        self.playlists_df = get_playlists_cache()
-        self.display_playlists()
+        self.scroll_widget.setUpdatesEnabled(True)
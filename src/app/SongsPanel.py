@@ -1,9 +1,9 @@
-import pickle
+import os
+import importlib
+import threading
 
 import pandas as pd
 
-from pathlib import Path
-from PyQt5.QtGui import QStandardItemModel, QStandardItem
 from PyQt5.QtCore import Qt, QThreadPool
 from PyQt5.QtWidgets import (
     QWidget,
@@ -19,16 +19,15 @@ from PyQt5.QtWidgets import (
     QFileDialog,
 )
 
-from app.AnalysisWorker import AnalysisWorker
-from selecta.utils import get_similarity_matrix_cache, get_songs_cache, get_local_app_data_dir, get_playlists_cache
+from app.LibraryState import LibraryState
+from app.DataFrameTableModel import DataFrameTableModel
+from selecta.utils import get_library_scanner
 
 
 class SongsPanel(QWidget):
-    def __init__(self):
+    def __init__(self, library: LibraryState):
         super().__init__()
-        self.songs, self.songs_df = get_songs_cache()
-        self.similarity_matrix_df = get_similarity_matrix_cache()
-        self.added_songs_df = pd.DataFrame()
+        self.library = library
         self.new_songs_df = pd.DataFrame()
 
         layout = QVBoxLayout()  # Main vertical layout
@@ -36,6 +35,7 @@ class SongsPanel(QWidget):
 
         # Threadpool for background workers
         self.threadpool = QThreadPool()
+        self.analysis_worker = None
 
         # --- Column 1: Status + Progress Bars ---
         progress_layout = QVBoxLayout()
@@ -58,17 +58,21 @@ class SongsPanel(QWidget):
         add_songs_button = QPushButton("Add Songs")
         analyse_songs_button = QPushButton("Analyse Songs")
         delete_songs_button = QPushButton("Delete Songs")
+        self.cancel_analysis_button = QPushButton("Cancel Analysis")
+        self.cancel_analysis_button.setEnabled(False)
         add_songs_button.clicked.connect(self.select_folder)
         analyse_songs_button.clicked.connect(self.analyse_songs)
         delete_songs_button.clicked.connect(self.delete_selected_songs)
+        self.cancel_analysis_button.clicked.connect(self.cancel_analysis)
         button_layout.addWidget(add_songs_button)
         button_layout.addWidget(analyse_songs_button)
         button_layout.addWidget(delete_songs_button)
+        button_layout.addWidget(self.cancel_analysis_button)
         self.panel_header.addLayout(button_layout)
 
         # --- Table View ---
         self.table_view = QTableView()
-        self.table_model = self.create_table_model(self.songs_df)
+        self.table_model = DataFrameTableModel(self.library.songs_df, columns=["name", "location"])
         self.table_view.setModel(self.table_model)
         self.table_view.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
         self.table_view.setSelectionBehavior(QAbstractItemView.SelectRows)
@@ -80,62 +84,95 @@ class SongsPanel(QWidget):
         layout.addWidget(self.table_view)
         self.setLayout(layout)
 
-    @staticmethod
-    def create_table_model(df: pd.DataFrame) -> QStandardItemModel:
-        model = QStandardItemModel()
-        model.setColumnCount(len(df.columns))
-        model.setHorizontalHeaderLabels(df.columns.tolist())
-
-        for row in df.itertuples(index=False):
-            items = [QStandardItem(str(field)) for field in row]
-            model.appendRow(items)
+        self.library.songs_changed.connect(self.refresh)
 
-        return model
+    @staticmethod
+    def prewarm_analysis() -> threading.Thread:
+        """
+        Imports the analysis modules in a background thread, so that the first analysis doesn't wait on them.
+
+        They are left out of the panel's own imports so that the window opens without loading them.
+        """
+        thread = threading.Thread(
+            target=importlib.import_module, args=("app.AnalysisWorker",), name="analysis-prewarm", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def displayed_songs_df(self) -> pd.DataFrame:
+        """Analysed songs, followed by songs added since that are still waiting to be analysed"""
+        songs_df = self.library.songs_df
+        if self.new_songs_df.empty:
+            return songs_df
+        pending = self.new_songs_df[~self.new_songs_df["location"].isin(set(songs_df["location"]))]
+        return pd.concat([songs_df, pending], ignore_index=True)
 
     def select_folder(self):
         folder_path = QFileDialog.getExistingDirectory(self, "Select Folder")
         if folder_path:
-            added_songs = []
-            audio_files = list(Path(folder_path).rglob("*.mp3"))
-            for file_path in audio_files:
-                added_songs.append({"name": file_path.name, "location": file_path})
-
-            self.added_songs_df = pd.DataFrame(added_songs)
+            scanner = get_library_scanner()
+            audio_files = scanner.scan([folder_path])
+            scanner.save()
 
             # Filter to songs not yet added
-            subset_cols = ["name", "location"]
-            if self.songs_df.empty:
-                self.new_songs_df = self.added_songs_df
-            else:
-                self.new_songs_df = self.added_songs_df[
-                    ~self.added_songs_df[subset_cols].isin(self.songs_df[subset_cols]).all(axis=1)
-                ]
-
-            # Update the main table model with all songs
-            self.table_model = self.create_table_model(pd.concat([self.songs_df, self.added_songs_df]))
-            self.table_view.setModel(self.table_model)
+            songs_df = self.library.songs_df
+            known_locations = set(songs_df["location"])
+            new_songs = [
+                {"name": os.path.basename(location), "location": location}
+                for location in audio_files
+                if location not in known_locations
+            ]
+            self.new_songs_df = pd.DataFrame(new_songs, columns=["name", "location"])
+
+            # Update the main table with all songs
+            self.table_model.set_dataframe(self.displayed_songs_df())
 
             QMessageBox.information(
                 None,
                 "Added Songs",
-                f"Added {len(self.new_songs_df)} new songs. Total songs: {len(self.new_songs_df) + len(self.songs_df)}",
+                f"Added {len(self.new_songs_df)} new songs. Total songs: {len(self.new_songs_df) + len(songs_df)}",
             )
 
     def analyse_songs(self):
+        if self.analysis_worker is not None:
+            QMessageBox.warning(None, "Analysis Running", "Please wait for the current analysis to finish.")
+            return
         if self.new_songs_df.empty:
             QMessageBox.warning(None, "No Songs", "Please add new songs before analysing.")
             return
 
+        # Imported on first use (or by `prewarm_analysis`), to keep the analysis stack out of the app's startup
+        from app.AnalysisWorker import AnalysisWorker
+
+        # The analysis writes the caches itself, so a compaction of them must be done first
+        self.library.finish_compaction()
+
         worker = AnalysisWorker(new_songs_df=self.new_songs_df)
 
         # Connect signals to slots
         worker.signals.status.connect(self.update_status)
         worker.signals.analysis_progress.connect(self.update_analysis_progress)
         worker.signals.similarity_progress.connect(self.update_similarity_progress)
+        worker.signals.finished.connect(self.analysis_finished)
 
+        self.analysis_worker = worker
+        self.cancel_analysis_button.setEnabled(True)
         self.threadpool.start(worker)
 
-        self.refresh()
+    def cancel_analysis(self):
+        if self.analysis_worker is not None:
+            self.status_label.setText("Cancelling...")
+            self.cancel_analysis_button.setEnabled(False)
+            self.analysis_worker.cancel()
+
+    def analysis_finished(self):
+        self.analysis_worker = None
+        self.cancel_analysis_button.setEnabled(False)
+        # The analysis has rewritten the caches, which refreshes the table
+        self.library.reload_analysis()
+        # Songs it stored are no longer pending, while those a cancelled or failed run didn't reach are analysed next time
+        analysed = self.new_songs_df["location"].isin(set(self.library.songs_df["location"]))
+        self.new_songs_df = self.new_songs_df[~analysed].reset_index(drop=True)
 
     def update_status(self, message: str):
         self.status_label.setText(message)
@@ -147,56 +184,23 @@ class SongsPanel(QWidget):
         self.similarity_progress_bar.setValue(value)
 
     def delete_selected_songs(self):
-        self.refresh()
-
+        if self.analysis_worker is not None:
+            QMessageBox.warning(None, "Analysis Running", "Please wait for the current analysis to finish.")
+            return
         selection_model = self.table_view.selectionModel()
         selected_rows = selection_model.selectedRows()  # returns QModelIndex list
 
         if not selected_rows:
             return  # Nothing selected
 
-        # Extract song names from the selected rows
-        song_names_to_delete = []
-        for index in selected_rows:
-            row = index.row()
-            song_name = self.songs_df.iloc[row]["name"]
-            song_names_to_delete.append(song_name)
-
-        # Call your existing function
-        self.delete_songs(song_names_to_delete)
-
-        # Update the table view to reflect changes
-        self.refresh()
-
-        self.table_model = self.create_table_model(self.songs_df)
-        self.table_view.setModel(self.table_model)
+        # Selected rows are mapped back through the model, as the view may be sorted. Songs which haven't been
+        # analysed yet have no key and nothing to delete
+        song_keys_to_delete = self.table_model.source_rows(selected_rows)["key"].dropna().tolist()
+        if not song_keys_to_delete:
+            return
 
-    def delete_songs(self, song_names):
-        local_app_data_dir = get_local_app_data_dir()
-        songs_cache, _ = get_songs_cache()
-        similarity_matrix_cache = get_similarity_matrix_cache()
-        playlists_cache = get_playlists_cache()
-
-        # Filter songs and save back to cache
-        songs_cache_updated = [song for song in songs_cache if song.name not in song_names]
-        songs_cache_path = Path(f"{local_app_data_dir}/cache/songs.pickle")
-        with open(songs_cache_path, "wb") as f:
-            pickle.dump(songs_cache_updated, f)
-
-        # Filter similarity matrix cols and index and save back to cache
-        similarity_matrix_cache_updated = similarity_matrix_cache[[col for col in similarity_matrix_cache.columns if col not in song_names]]
-        similarity_matrix_cache_updated = similarity_matrix_cache_updated[~similarity_matrix_cache_updated.index.isin(song_names)]
-        similarity_matrix_cache_path = Path(f"{local_app_data_dir}/cache/similarity_matrix.pickle")
-        with open(similarity_matrix_cache_path, "wb") as f:
-            pickle.dump(similarity_matrix_cache_updated, f)
-
-        # Filter playlists and save back to cache
-        playlists_cache_updated = playlists_cache.copy()
-        playlists_cache["songs"] = playlists_cache["songs"].apply(lambda x: [song_name for song_name in x if song_name not in song_names])
-        playlists_cache_path = Path(f"{local_app_data_dir}/cache/playlists.pickle")
-        with open(playlists_cache_path, "wb") as f:
-            pickle.dump(playlists_cache_updated, f)
+        # Removes the songs from the caches and playlists, which refreshes the table
+        self.library.delete_songs(song_keys_to_delete)
 
     def refresh(self):
-        self.songs, self.songs_df = get_songs_cache()
-        self.similarity_matrix_df = get_similarity_matrix_cache()
+        self.table_model.set_dataframe(self.displayed_songs_df())
@@ -0,0 +1,334 @@
+import time
+import queue
+import signal
+import secrets
+import multiprocessing
+import numpy as np
+
+from pathlib import Path
+from multiprocessing import resource_tracker, shared_memory
+
+from selecta.logger import generate_logger
+from selecta.Song import Song
+from selecta.RunReport import RunReport, profiled_call, worker_stats
+from selecta.YamnetInference import YamnetInference, DEFAULT_INFERENCE_BATCH_SIZE, SAMPLE_RATE
+
+logger = generate_logger()
+
+# How many batches of decoded songs may wait in shared memory for each inference worker
+DEFAULT_BUFFERED_BATCHES_PER_WORKER = 2
+
+# How often a running pipeline checks whether it has been cancelled while it waits for workers
+CANCEL_POLL_INTERVAL_S = 0.2
+
+# Set in each inference worker process by `init_inference_worker`
+inference = None
+
+
+def init_decode_worker():
+    # Ctrl+C reaches every process in the group; the main process decides how to stop, and terminates the pools
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def init_inference_worker():
+    """Loads and warms up YAMNet once per inference worker process, rather than once per song"""
+    global inference
+    init_decode_worker()
+    from selecta.yamnet_model import load_yamnet_model
+
+    inference = YamnetInference(load_yamnet_model())
+    inference.warm_up()
+
+
+def decode_song(song_path, key, block_name, decode_mode="standard", profile_path=None):
+    """
+    Decodes a song into a new shared memory block, for an inference worker to pick up.
+
+    Args:
+        song_path (str): The file path of the song.
+        key (str): The song's content key.
+        block_name (str): Name to create the shared memory block under.
+        decode_mode (str): Passed to `Song.load_audio`.
+        profile_path (str): Optional path to dump cProfile stats of the decode to.
+
+    Returns:
+        tuple: (song_path, key, block_name, n_samples, timings). block_name is None if the song could not be decoded.
+    """
+    start, cpu_start = time.perf_counter(), time.process_time()
+    waveform = profiled_call(profile_path, Song.load_audio, song_path, decode_mode=decode_mode)
+
+    def timings():
+        return {
+            "wall_s": round(time.perf_counter() - start, 4),
+            "cpu_s": round(time.process_time() - cpu_start, 4),
+            **worker_stats(),
+        }
+
+    if waveform is None:
+        return song_path, key, None, 0, timings()
+
+    waveform = np.asarray(waveform, dtype=np.float32)
+    # Shared memory blocks can't be empty
+    block = shared_memory.SharedMemory(name=block_name, create=True, size=max(waveform.nbytes, 1))
+    np.ndarray(waveform.shape, dtype=np.float32, buffer=block.buf)[:] = waveform
+    block.close()
+    # Attaching registers the block with the resource tracker again (before Python 3.13), so the worker that frees it
+    # tracks it from then on, and the tracker doesn't report it as leaked by this one
+    resource_tracker.unregister(block._name, "shared_memory")
+    return song_path, key, block.name, len(waveform), timings()
+
+
+def embed_shared_waveforms(blocks: list, sizes: list) -> list:
+    """Embeds waveforms held in shared memory, returning None for any song that fails"""
+    # The waveforms are views into the blocks, so they must not outlive this function (or any exception raised in it)
+    waveforms = [
+        np.ndarray((n_samples,), dtype=np.float32, buffer=block.buf) for block, n_samples in zip(blocks, sizes)
+    ]
+    try:
+        return inference.embed(waveforms)
+    except Exception as e:
+        logger.error(f"Error processing a batch of {len(waveforms)} songs, retrying individually: {e}")
+
+    embeddings = []
+    for waveform, block in zip(waveforms, blocks):
+        try:
+            embeddings.append(inference.embed([waveform])[0])
+        except Exception as e:
+            logger.error(f"Error processing audio from shared memory block {block.name}: {e}")
+            embeddings.append(None)
+    return embeddings
+
+
+def embed_song_batch(decoded_songs: list, profile_path=None):
+    """
+    Extracts embeddings for a batch of decoded songs with a single YAMNet call, freeing their shared memory.
+
+    Args:
+        decoded_songs (list): Results of `decode_song`.
+        profile_path (str): Optional path to dump cProfile stats of the YAMNet call to.
+
+    Returns:
+        tuple: (songs, timings), with the songs in the same order as `decoded_songs`.
+    """
+    start, cpu_start = time.perf_counter(), time.process_time()
+    blocks = [shared_memory.SharedMemory(name=block_name) for _, _, block_name, _, _ in decoded_songs]
+    try:
+        embeddings = profiled_call(
+            profile_path, embed_shared_waveforms, blocks, [n_samples for _, _, _, n_samples, _ in decoded_songs]
+        )
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    timings = {
+        "wall_s": round(time.perf_counter() - start, 4),
+        "cpu_s": round(time.process_time() - cpu_start, 4),
+        "batch_size": len(decoded_songs),
+        "collapse_s": [],
+    }
+
+    songs = []
+    for (song_path, key, _, _, _), song_embeddings in zip(decoded_songs, embeddings):
+        collapse_start = time.perf_counter()
+        songs.append(Song.from_embeddings(Path(song_path), song_embeddings, key=key))
+        timings["collapse_s"].append(round(time.perf_counter() - collapse_start, 5))
+    return songs, {**timings, **worker_stats()}
+
+
+def free_shared_memory(block_name: str):
+    try:
+        block = shared_memory.SharedMemory(name=block_name)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
+
+
+class AnalysisPipeline:
+    """
+    Analyses songs in two stages: a pool of decoder processes feeding a smaller pool of YAMNet inference processes.
+
+    Decoders write each normalised 16kHz waveform into its own shared memory block, so only a block name passes
+    between processes, and inference workers embed decoded songs in batches. At most `max_buffered_songs` songs are in
+    flight at once (being decoded, waiting in shared memory or being embedded), which caps memory use whichever stage
+    is slower, while the other stage keeps working.
+    """
+
+    def __init__(
+        self,
+        n_decode_workers: int,
+        n_inference_workers: int,
+        batch_size: int = DEFAULT_INFERENCE_BATCH_SIZE,
+        max_buffered_songs: int = None,
+        decode_mode: str = "standard",
+        report: RunReport = None,
+        profile_keys: set = None,
+        cancel_event=None,
+    ):
+        """
+        Args:
+            n_decode_workers (int): Number of decoder processes.
+            n_inference_workers (int): Number of inference processes, each with its own copy of YAMNet.
+            batch_size (int): Maximum number of songs per YAMNet call.
+            max_buffered_songs (int): Maximum number of songs in flight. Defaults to enough to keep every inference
+                                      worker busy with a few batches queued.
+            decode_mode (str): "standard", or "fast" for a cheaper resampler. See `Song.load_audio`.
+            report (RunReport): Optional report to record each song's timings in.
+            profile_keys (set): Keys of songs whose decode and inference should be profiled into the report.
+            cancel_event (threading.Event): Optional event which stops the run when set. Work in progress is
+                                            abandoned and the worker processes are terminated.
+        """
+        self.n_decode_workers = n_decode_workers
+        self.n_inference_workers = n_inference_workers
+        self.batch_size = batch_size
+        self.max_buffered_songs = max_buffered_songs or batch_size * n_inference_workers * (
+            1 + DEFAULT_BUFFERED_BATCHES_PER_WORKER
+        )
+        self.decode_mode = decode_mode
+        self.report = report
+        self.profile_keys = profile_keys or set()
+        self.cancel_event = cancel_event
+        self.decode_seconds = 0.0
+        self.inference_seconds = 0.0
+
+    def profile_path(self, stage: str, songs: list):
+        """Where to dump cProfile stats for a task covering the given songs, or None if none of them are profiled"""
+        profiled = [song[1] for song in songs if song[1] in self.profile_keys]
+        if self.report is None or not profiled:
+            return None
+        return self.report.profile_path(stage, profiled[0])
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def record_song(self, song_path, key, decode_timings, inference_timings=None, **fields):
+        if self.report is not None:
+            self.report.record_song(song_path, key, decode_timings, inference_timings, **fields)
+
+    def run(self, song_paths_and_keys):
+        """
+        Analyses songs, yielding them in lists as they complete (in no particular order).
+
+        Args:
+            song_paths_and_keys (iterable): (song_path, key) pairs.
+
+        Yields:
+            list: Analysed `Song` objects. Songs which could not be decoded or embedded have no embeddings. If the
+                  run is cancelled, songs still being analysed are not yielded.
+        """
+        # Pool callbacks run on a background thread, so they only post events for this generator to handle
+        events = queue.SimpleQueue()
+        pending = iter(song_paths_and_keys)
+        decoded = []
+        # Block names are chosen here rather than by the decoders, so that every block which may exist is known, even
+        # one being created by a decoder when the pools are terminated. Names are short for macOS's 31 character limit
+        block_prefix = f"sel{secrets.token_hex(4)}_"
+        n_blocks = 0
+        live_blocks = set()
+        n_in_flight = 0
+        n_decoding = 0
+
+        # Blocks are created by decoders and freed by inference workers, so both must report to the same tracker
+        resource_tracker.ensure_running()
+        try:
+            with multiprocessing.Pool(processes=self.n_decode_workers, initializer=init_decode_worker) as decode_pool:
+                with multiprocessing.Pool(
+                    processes=self.n_inference_workers, initializer=init_inference_worker
+                ) as inference_pool:
+                    while not self.cancelled:
+                        # Top up the decoders, within the in-flight limit
+                        while n_in_flight < self.max_buffered_songs:
+                            song_path_and_key = next(pending, None)
+                            if song_path_and_key is None:
+                                break
+                            n_in_flight += 1
+                            n_decoding += 1
+                            block_name = f"{block_prefix}{n_blocks}"
+                            n_blocks += 1
+                            live_blocks.add(block_name)
+                            decode_pool.apply_async(
+                                decode_song,
+                                (
+                                    *song_path_and_key,
+                                    block_name,
+                                    self.decode_mode,
+                                    self.profile_path("decode", [song_path_and_key]),
+                                ),
+                                callback=lambda result: events.put(("decoded", result)),
+                                error_callback=lambda e, item=(*song_path_and_key, block_name): events.put(
+                                    ("decode_failed", (item, e))
+                                ),
+                            )
+
+                        # Send full batches for inference, or whatever is left once no more songs are being decoded
+                        while len(decoded) >= self.batch_size or (decoded and n_decoding == 0):
+                            batch, decoded = decoded[: self.batch_size], decoded[self.batch_size :]
+                            inference_pool.apply_async(
+                                embed_song_batch,
+                                (batch, self.profile_path("inference", batch)),
+                                callback=lambda result, batch=batch: events.put(("embedded", (batch, result))),
+                                error_callback=lambda e, batch=batch: events.put(("embed_failed", (batch, e))),
+                            )
+
+                        if n_in_flight == 0:
+                            break
+
+                        try:
+                            kind, result = events.get(timeout=CANCEL_POLL_INTERVAL_S)
+                        except queue.Empty:
+                            continue
+                        if kind == "decoded":
+                            n_decoding -= 1
+                            song_path, key, block_name, _, decode_timings = result
+                            self.decode_seconds += decode_timings["wall_s"]
+                            if block_name is None:
+                                n_in_flight -= 1
+                                self.record_song(song_path, key, decode_timings, failed=True)
+                                yield [Song.from_embeddings(Path(song_path), None, key=key)]
+                            else:
+                                decoded.append(result)
+                        elif kind == "decode_failed":
+                            n_decoding -= 1
+                            n_in_flight -= 1
+                            (song_path, key, block_name), e = result
+                            free_shared_memory(block_name)
+                            live_blocks.discard(block_name)
+                            logger.error(f"Error decoding audio file {song_path}: {e}")
+                            if self.report is not None:
+                                self.report.write("song", path=str(song_path), key=key, failed=True, error=str(e))
+                            yield [Song.from_embeddings(Path(song_path), None, key=key)]
+                        elif kind == "embedded":
+                            batch, (songs, inference_timings) = result
+                            self.inference_seconds += inference_timings["wall_s"]
+                            n_in_flight -= len(songs)
+                            live_blocks.difference_update(block_name for _, _, block_name, _, _ in batch)
+                            for (song_path, key, _, n_samples, decode_timings), song, collapse_seconds in zip(
+                                batch, songs, inference_timings["collapse_s"]
+                            ):
+                                self.record_song(
+                                    song_path,
+                                    key,
+                                    decode_timings,
+                                    inference_timings,
+                                    audio_s=round(n_samples / SAMPLE_RATE, 2),
+                                    collapse_s=collapse_seconds,
+                                    failed=song.simplified_yamnet_embeddings is None,
+                                )
+                            yield songs
+                        else:
+                            batch, e = result
+                            logger.error(f"Error processing a batch of {len(batch)} songs: {e}")
+                            n_in_flight -= len(batch)
+                            for song_path, key, block_name, _, decode_timings in batch:
+                                free_shared_memory(block_name)
+                                live_blocks.discard(block_name)
+                                self.record_song(song_path, key, decode_timings, failed=True, error=str(e))
+                            yield [
+                                Song.from_embeddings(Path(song_path), None, key=key)
+                                for song_path, key, _, _, _ in batch
+                            ]
+        finally:
+            # Free anything left behind if analysis stopped early. Blocks which were never created are skipped
+            for block_name in live_blocks:
+                free_shared_memory(block_name)
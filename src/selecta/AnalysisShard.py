@@ -0,0 +1,163 @@
+import os
+import re
+import json
+import socket
+import hashlib
+
+from pathlib import Path
+
+from selecta.logger import generate_logger
+from selecta.utils import atomic_write
+from selecta.ContentKeyIndex import ContentKeyIndex
+from selecta.EmbeddingStore import EmbeddingStore
+from selecta.SimilarityMatrix import SimilarityMatrix
+
+logger = generate_logger()
+
+MANIFEST_NAME = "shard.json"
+SHARD_DIRECTORY_PATTERN = re.compile(r"shard-(\d+)-of-(\d+)")
+
+
+def shard_number(relative_path: str, n_shards: int) -> int:
+    """Shard (from 1 to n_shards) of a song, from a hash of its path relative to the folder it was found in"""
+    digest = hashlib.blake2b(relative_path.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % n_shards + 1
+
+
+class AnalysisShard:
+    """
+    One of several parts of a library analysed separately, e.g. by analysis machines sharing a NAS.
+
+    Songs are split between shards by a hash of their path relative to the scanned folder they are in, so every machine
+    assigns each song to the same shard without reading it, even when the library is mounted at different paths. Each
+    shard is a directory of the shared shard directory, named shard-<number>-of-<count>, which holds a complete cache
+    of its songs:
+        embeddings/             an `EmbeddingStore` of the shard's songs
+        similarity_matrix.*     a `SimilarityMatrix` of the pairs between them
+        content_keys.pickle, similarity_checkpoint.json, run_reports/
+                                the rest of the cache, so that an interrupted shard resumes like a library does
+        shard.json              the manifest, removed while the shard is being analysed and written once it is done
+
+    `SongProcessorDesktop` analyses a shard into its directory, and merges complete shards into the app's caches: their
+    songs are added to the embedding store, and only the pairs between songs of different shards are computed, with
+    those within each shard copied from its matrix. Each shard must only be analysed by one process at a time.
+    """
+
+    def __init__(self, directory: Path, number: int, count: int):
+        """
+        Args:
+            directory (Path): Shared directory holding every shard.
+            number (int): Number of this shard, from 1 to `count`.
+            count (int): Number of shards the library is split into.
+        """
+        if not 1 <= number <= count:
+            raise ValueError(f"Shard number must be between 1 and {count}, got {number}")
+        self.number = number
+        self.count = count
+        self.directory = Path(directory) / f"shard-{number}-of-{count}"
+        self.manifest_path = self.directory / MANIFEST_NAME
+
+    def __repr__(self):
+        return f"AnalysisShard({self.number}/{self.count} at {self.directory})"
+
+    @classmethod
+    def find(cls, directory: Path) -> list:
+        """
+        Every shard of a shared shard directory, checking that they are all there and complete.
+
+        Raises:
+            ValueError: If the directory holds no shards, shards of different splits, or some are missing or still
+                        being analysed.
+        """
+        found = {}
+        for path in sorted(Path(directory).iterdir()) if Path(directory).is_dir() else []:
+            match = SHARD_DIRECTORY_PATTERN.fullmatch(path.name)
+            if match is not None and path.is_dir():
+                number, count = int(match.group(1)), int(match.group(2))
+                found[number, count] = cls(directory, number, count)
+        if not found:
+            raise ValueError(f"No shards in {directory}")
+        counts = {count for _, count in found}
+        if len(counts) > 1:
+            raise ValueError(f"{directory} holds shards of several splits: {sorted(counts)} shards")
+
+        count = counts.pop()
+        shards = [found.get((number, count)) for number in range(1, count + 1)]
+        missing = [number for number, shard in enumerate(shards, start=1) if shard is None]
+        incomplete = [shard.number for shard in shards if shard is not None and not shard.complete]
+        if missing or incomplete:
+            raise ValueError(
+                f"Shards of {directory} are not ready to merge: missing {missing or 'none'}, "
+                f"incomplete {incomplete or 'none'}"
+            )
+        return shards
+
+    def select(self, song_paths: list, roots: list) -> list:
+        """
+        The songs of this shard.
+
+        Args:
+            song_paths (list): Paths of every song in the library, as found by `LibraryScanner`.
+            roots (list): The directories which were scanned.
+
+        Returns:
+            list: The paths of the songs belonging to this shard, in their original order.
+        """
+        roots = sorted((Path(os.path.abspath(root)) for root in roots), key=lambda root: len(root.parts))
+        selected = []
+        for song_path in song_paths:
+            path = Path(os.path.abspath(song_path))
+            # Relative to the outermost scanned folder holding it, so that also scanning a subfolder changes nothing
+            root = next((root for root in roots if path.is_relative_to(root)), None)
+            relative_path = path.relative_to(root).as_posix() if root is not None else path.as_posix()
+            if shard_number(relative_path, self.count) == self.number:
+                selected.append(song_path)
+        return selected
+
+    @property
+    def embedding_store(self) -> EmbeddingStore:
+        return EmbeddingStore(self.directory / "embeddings")
+
+    @property
+    def similarity_matrix(self) -> SimilarityMatrix:
+        return SimilarityMatrix(self.directory / "similarity_matrix.f32")
+
+    @property
+    def content_key_index(self) -> ContentKeyIndex:
+        return ContentKeyIndex(self.directory / "content_keys.pickle")
+
+    @property
+    def manifest(self):
+        """The manifest of a complete shard, or None"""
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    @property
+    def complete(self) -> bool:
+        return self.manifest is not None
+
+    @property
+    def aggregation(self) -> str:
+        return self.similarity_matrix.aggregation
+
+    def start(self):
+        """Marks the shard as being analysed, so that it isn't merged until it is complete again"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.manifest_path.unlink(missing_ok=True)
+
+    def finish(self, **fields):
+        """Writes the manifest of a complete shard, with its details and any other fields"""
+        manifest = {
+            "number": self.number,
+            "count": self.count,
+            "songs": len(self.embedding_store),
+            "aggregation": self.aggregation,
+            "host": socket.gethostname(),
+            **fields,
+        }
+        with atomic_write(self.manifest_path, "w") as f:
+            json.dump(manifest, f)
+        logger.info(f"Finished shard {self.number} of {self.count} with {manifest['songs']} songs")
@@ -0,0 +1,84 @@
+import os
+import pickle
+import hashlib
+
+from pathlib import Path
+
+from selecta.utils import atomic_write
+
+HASH_CHUNK_SIZE = 2**20
+ID3V1_TAG_SIZE = 128
+
+
+class ContentKeyIndex:
+    """
+    Identifies audio files by their content rather than their file name.
+
+    A song's key is a hash of its audio stream, with ID3 tags stripped so that editing a track's metadata doesn't
+    change its key. Hashing means reading the whole file, so keys are remembered per location together with the file's
+    size and modification time: as long as neither changed the cached key is reused without touching the file.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        try:
+            with open(self.path, "rb") as f:
+                # location -> (size, mtime_ns, key)
+                self.entries = pickle.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def key(self, location) -> str:
+        location = str(location)
+        stat = os.stat(location)
+        cached = self.entries.get(location)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+
+        key = self.audio_stream_hash(location)
+        self.entries[location] = (stat.st_size, stat.st_mtime_ns, key)
+        return key
+
+    def key_or_placeholder(self, location) -> str:
+        """Key of a file, or a placeholder derived from its location if it no longer exists"""
+        try:
+            return self.key(location)
+        except FileNotFoundError:
+            return "missing-" + hashlib.blake2b(str(location).encode(), digest_size=16).hexdigest()
+
+    def prune(self, locations: set):
+        """Drops the keys remembered for every location but the given ones, e.g. of songs since deleted or moved"""
+        self.entries = {location: entry for location, entry in self.entries.items() if location in locations}
+
+    @staticmethod
+    def audio_stream_hash(location) -> str:
+        """Hashes an MP3 file's audio frames, skipping any leading ID3v2 tag and trailing ID3v1 tag"""
+        size = os.path.getsize(location)
+        with open(location, "rb") as f:
+            start = 0
+            header = f.read(10)
+            if len(header) == 10 and header[:3] == b"ID3":
+                # ID3v2 tag size is a 28-bit "synchsafe" integer, excluding the 10-byte header (and optional footer)
+                tag_size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+                start = 10 + tag_size + (10 if header[5] & 0x10 else 0)
+
+            stop = size
+            if size - ID3V1_TAG_SIZE >= start:
+                f.seek(size - ID3V1_TAG_SIZE)
+                if f.read(3) == b"TAG":
+                    stop = size - ID3V1_TAG_SIZE
+
+            digest = hashlib.blake2b(digest_size=16)
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(HASH_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+        return digest.hexdigest()
+
+    def save(self):
+        with atomic_write(self.path) as f:
+            pickle.dump(self.entries, f)
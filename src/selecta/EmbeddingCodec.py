@@ -0,0 +1,216 @@
+import numpy as np
+
+from pathlib import Path
+
+COMPRESSION_MODES = {
+    "none": "float32 embeddings, as analysed",
+    "float16": "float16 embeddings, half the size",
+    "pca": "embeddings projected onto the library's principal directions, as float16",
+    "pq": "PCA-projected embeddings product quantised to one byte per subvector",
+}
+DEFAULT_PCA_DIMS = 128
+DEFAULT_PQ_SUBVECTORS = 16
+PQ_CENTROIDS = 256
+# Projections and codebooks are fitted on a random sample of this many segments
+FIT_SAMPLE_SEGMENTS = 65536
+KMEANS_ITERATIONS = 20
+
+
+class EmbeddingCodec:
+    """
+    Encodes segment embeddings for the embedding store, and decodes them for similarity computation.
+
+    Modes (see COMPRESSION_MODES):
+        none     float32 as analysed
+        float16  float16, which changes cosine distances by around 1e-5
+        pca      a projection onto the top principal directions of the library's segments, stored as float16. The
+                 directions are those of the uncentred segments, which preserve dot products (and so cosine
+                 distances) best for their number of dimensions
+        pq       the PCA projection, scaled to unit length and split into subvectors which are each stored as the
+                 one-byte index of their nearest centroid in a per-subvector codebook
+
+    `decode` gives vectors in the projected space, whose cosine distances approximate those of the original
+    embeddings, and `reconstruct` maps them back to the original space, e.g. to fit a new codec. Quantised codes can
+    also be compared without decoding them: `distance_tables` holds the dot product of each query subvector with
+    every centroid, so the dot product of a query with a coded segment is a sum of table lookups.
+    """
+
+    def __init__(self, mode: str = "none", projection: np.ndarray = None, codebooks: np.ndarray = None):
+        """
+        Args:
+            mode (str): One of COMPRESSION_MODES.
+            projection (np.ndarray): (pca_dims, n_features) projection of the "pca" and "pq" modes.
+            codebooks (np.ndarray): (n_subvectors, n_centroids, subvector_dims) centroids of the "pq" mode.
+        """
+        if mode not in COMPRESSION_MODES:
+            raise ValueError(f"Unknown embedding compression {mode!r}, expected one of {list(COMPRESSION_MODES)}")
+        self.mode = mode
+        self.projection = projection
+        self.codebooks = codebooks
+        if codebooks is not None:
+            self.subvector_dims = codebooks.shape[2]
+            # Squared length of every centroid, to find the length of coded segments without decoding them
+            self.centroid_norms = np.sum(codebooks.astype(np.float32) ** 2, axis=2)
+
+    @property
+    def dtype(self) -> str:
+        return {"none": "float32", "float16": "float16", "pca": "float16", "pq": "uint8"}[self.mode]
+
+    @property
+    def quantised(self) -> bool:
+        return self.mode == "pq"
+
+    @property
+    def pca_dims(self):
+        return None if self.projection is None else self.projection.shape[0]
+
+    @classmethod
+    def fit(
+        cls,
+        segments: np.ndarray,
+        mode: str,
+        pca_dims: int = DEFAULT_PCA_DIMS,
+        pq_subvectors: int = DEFAULT_PQ_SUBVECTORS,
+        seed: int = 0,
+    ):
+        """
+        Fits a codec to a library.
+
+        Args:
+            segments (np.ndarray): (n_segments, n_features) sample of the library's segment embeddings.
+            mode (str): One of COMPRESSION_MODES.
+            pca_dims (int): Dimensions kept by the "pca" and "pq" modes.
+            pq_subvectors (int): Subvectors (bytes per segment) of the "pq" mode, which must divide `pca_dims`.
+            seed (int): Seed for sampling segments and initialising centroids.
+
+        Returns:
+            EmbeddingCodec: The fitted codec.
+        """
+        if mode not in ("pca", "pq"):
+            return cls(mode)
+        segments = np.asarray(segments)
+        if not 0 < pca_dims <= segments.shape[1]:
+            raise ValueError(f"PCA dimensions must be between 1 and {segments.shape[1]}, got {pca_dims}")
+        if mode == "pq" and pca_dims % pq_subvectors:
+            raise ValueError(f"{pq_subvectors} subvectors don't divide {pca_dims} PCA dimensions")
+        rng = np.random.default_rng(seed)
+        if len(segments) > FIT_SAMPLE_SEGMENTS:
+            segments = segments[np.sort(rng.choice(len(segments), FIT_SAMPLE_SEGMENTS, replace=False))]
+
+        # Eigenvectors of the (n_features, n_features) Gram matrix are the principal directions of the segments,
+        # and cheaper to find than an SVD of the segments themselves
+        segments = segments.astype(np.float64)
+        _, eigenvectors = np.linalg.eigh(segments.T @ segments)
+        projection = np.ascontiguousarray(eigenvectors[:, ::-1][:, :pca_dims].T, dtype=np.float32)
+        if mode == "pca":
+            return cls(mode, projection=projection)
+
+        projected = unit_rows(segments.astype(np.float32) @ projection.T)
+        projected = projected[np.any(projected != 0, axis=1)]
+        subvector_dims = pca_dims // pq_subvectors
+        codebooks = np.stack(
+            [
+                kmeans(projected[:, m * subvector_dims : (m + 1) * subvector_dims], PQ_CENTROIDS, rng)
+                for m in range(pq_subvectors)
+            ]
+        )
+        return cls(mode, projection=projection, codebooks=codebooks)
+
+    def encode(self, segments: np.ndarray) -> np.ndarray:
+        """Encodes (n_segments, n_features) embeddings as the rows stored in the embedding store"""
+        segments = np.asarray(segments, dtype=np.float32)
+        if self.projection is not None:
+            segments = segments @ self.projection.T
+        if not self.quantised:
+            return np.ascontiguousarray(segments, dtype=self.dtype)
+
+        segments = unit_rows(segments)
+        codes = np.empty((len(segments), len(self.codebooks)), dtype=np.uint8)
+        for m, codebook in enumerate(self.codebooks):
+            codes[:, m] = nearest_centroids(self.subvector(segments, m), codebook)
+        return codes
+
+    def decode(self, stored: np.ndarray) -> np.ndarray:
+        """Stored rows as float32 vectors, in the projected space for the "pca" and "pq" modes"""
+        if not self.quantised:
+            return np.asarray(stored, dtype=np.float32)
+        subvectors = self.codebooks[np.arange(len(self.codebooks)), np.asarray(stored, dtype=np.intp)]
+        return subvectors.reshape(len(stored), -1)
+
+    def reconstruct(self, stored: np.ndarray) -> np.ndarray:
+        """Stored rows as float32 vectors in the space of the original embeddings"""
+        decoded = self.decode(stored)
+        if self.projection is None:
+            return decoded
+        # The projection's rows are orthonormal, so its transpose maps projected vectors back
+        return decoded @ self.projection
+
+    def distance_tables(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Dot products of query subvectors with every centroid, for comparing queries with coded segments.
+
+        Args:
+            queries (np.ndarray): (n_queries, pca_dims) vectors in the projected space.
+
+        Returns:
+            np.ndarray: An (n_subvectors, n_queries, n_centroids) array. Summing `tables[m][:, codes[:, m]]` over the
+                        subvectors m gives the dot products of every query with every coded segment.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        return np.stack([self.subvector(queries, m) @ codebook.T for m, codebook in enumerate(self.codebooks)])
+
+    def subvector(self, vectors: np.ndarray, m: int) -> np.ndarray:
+        return vectors[:, m * self.subvector_dims : (m + 1) * self.subvector_dims]
+
+    def code_norms(self, codes: np.ndarray) -> np.ndarray:
+        """Lengths of the decoded segments of an (n_segments, n_subvectors) array of codes"""
+        squared_norms = np.zeros(len(codes), dtype=np.float32)
+        for m, norms in enumerate(self.centroid_norms):
+            squared_norms += norms[codes[:, m]]
+        return np.sqrt(squared_norms)
+
+    def save(self, path: Path):
+        arrays = {"projection": self.projection, "codebooks": self.codebooks}
+        with open(path, "wb") as f:
+            np.savez(f, mode=self.mode, **{name: array for name, array in arrays.items() if array is not None})
+
+    @classmethod
+    def load(cls, path: Path):
+        with np.load(path) as data:
+            return cls(str(data["mode"]), projection=data.get("projection"), codebooks=data.get("codebooks"))
+
+
+def unit_rows(vectors: np.ndarray) -> np.ndarray:
+    """Scales rows to unit length, leaving all-zero rows as they are"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.where(norms > 0, norms, 1)).astype(np.float32)
+
+
+def nearest_centroids(points: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # The squared distance to each centroid, less the squared length of the point which is the same for every centroid
+    return np.argmin(np.sum(centroids**2, axis=1) - 2 * points @ centroids.T, axis=1)
+
+
+def kmeans(points: np.ndarray, k: int, rng: np.random.Generator, iterations: int = KMEANS_ITERATIONS) -> np.ndarray:
+    """
+    Lloyd's k-means, initialised with distinct random points.
+
+    Returns:
+        np.ndarray: (k, n_dims) centroids. With fewer than k points, the missing centroids repeat the first point
+                    so that codes always index a full codebook.
+    """
+    centroids = np.zeros((k, points.shape[1]), dtype=np.float32)
+    n_initial = min(k, len(points))
+    if n_initial == 0:
+        return centroids
+    centroids[:n_initial] = points[rng.choice(len(points), n_initial, replace=False)]
+    centroids[n_initial:] = centroids[0]
+    for _ in range(iterations):
+        assignment = nearest_centroids(points, centroids[:n_initial])
+        counts = np.bincount(assignment, minlength=n_initial)
+        sums = np.zeros((n_initial, points.shape[1]), dtype=np.float64)
+        np.add.at(sums, assignment, points)
+        # Centroids which lose all their points stay where they are
+        assigned = counts > 0
+        centroids[:n_initial][assigned] = sums[assigned] / counts[assigned, None]
+    return centroids
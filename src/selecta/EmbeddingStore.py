@@ -0,0 +1,418 @@
+import os
+import json
+import pickle
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+from selecta.logger import generate_logger
+from selecta.utils import atomic_write
+from selecta.EmbeddingCodec import EmbeddingCodec, DEFAULT_PCA_DIMS, DEFAULT_PQ_SUBVECTORS, FIT_SAMPLE_SEGMENTS
+from selecta.TombstoneLog import (
+    TombstoneLog,
+    INITIAL_GENERATION,
+    new_generation,
+    generation_path,
+    remove_other_generations,
+)
+
+logger = generate_logger()
+
+METADATA_COLUMNS = ["key", "name", "location", "offset", "n_segments"]
+# Songs are re-encoded this many at a time when the store is compressed or merged into another
+REWRITE_BATCH_SONGS = 1024
+
+
+class EmbeddingStore:
+    """
+    On-disk columnar store of song metadata and collapsed segment embeddings.
+
+    The store is a directory holding:
+        metadata.pickle         a small DataFrame with each song's content key (see `ContentKeyIndex`), name,
+                                location, first row (offset) and number of rows, along with the store's generation
+                                and its header: the dtype and dimension of the stored rows, and their compression
+        embeddings.<gen>.f32    every song's segment embeddings as one contiguous array, opened with np.memmap
+        embeddings.<gen>.tombstones  the songs deleted since the embeddings were last compacted (see `TombstoneLog`)
+        codec.<gen>.npz         the projection and codebooks of a compressed store (see `EmbeddingCodec`)
+
+    Reading the metadata never touches the embeddings, embeddings are paged in lazily by the OS, and adding songs
+    appends to the end of the embeddings file without rewriting existing data. Deleting songs only logs them, and
+    `metadata` and everything derived from it leave them out; `compact` drops them from the files once enough pile up.
+    The metadata names the generation of the embeddings file, so replacing it commits a compaction in one step.
+
+    Embeddings are stored as float32 until the store is compressed with `compress`, which fits an `EmbeddingCodec` to
+    the library and re-encodes it. Songs added later are encoded with the same codec, and `codec` decodes the rows.
+    Stores written before the header was kept with the metadata have it in header.json instead.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        # Each generation of the embeddings file is named after this one, see `generation_path`
+        self.base_embeddings_path = self.directory / "embeddings.f32"
+        self.metadata_path = self.directory / "metadata.pickle"
+        self.legacy_header_path = self.directory / "header.json"
+        # Each codec is named after this one, with the generation it was fitted under
+        self.base_codec_path = self.directory / "codec.npz"
+        self._stored_metadata = None
+        self._metadata = None
+        self._header = None
+        self._codec = None
+        self._memmap = None
+        self._tombstones = None
+
+    @property
+    def stored_metadata(self) -> pd.DataFrame:
+        """Metadata of every song in the embeddings file, including deleted ones"""
+        if self._stored_metadata is None:
+            try:
+                with open(self.metadata_path, "rb") as f:
+                    self._stored_metadata = pickle.load(f)
+            except FileNotFoundError:
+                self._stored_metadata = pd.DataFrame(columns=METADATA_COLUMNS)
+        return self._stored_metadata
+
+    @property
+    def generation(self) -> str:
+        return self.stored_metadata.attrs.get("generation", INITIAL_GENERATION)
+
+    @property
+    def embeddings_path(self) -> Path:
+        return generation_path(self.base_embeddings_path, self.generation)
+
+    @property
+    def tombstones(self) -> TombstoneLog:
+        if self._tombstones is None:
+            tombstones_path = generation_path(self.base_embeddings_path, self.generation, ".tombstones")
+            self._tombstones = TombstoneLog(tombstones_path, self.generation)
+        return self._tombstones
+
+    @property
+    def metadata(self) -> pd.DataFrame:
+        """Metadata of the songs in the store"""
+        if self._metadata is None:
+            stored_metadata = self.stored_metadata
+            if len(self.tombstones):
+                stored_metadata = stored_metadata[~stored_metadata["key"].isin(self.tombstones.keys)]
+            self._metadata = stored_metadata.reset_index(drop=True)
+        return self._metadata
+
+    @property
+    def header(self) -> dict:
+        if self._header is None:
+            header = self.stored_metadata.attrs.get("header")
+            if header is None:
+                try:
+                    with open(self.legacy_header_path) as f:
+                        header = json.load(f)
+                except FileNotFoundError:
+                    header = {"dtype": "float32", "dim": None}
+            self._header = {"compression": "none", "codec": None, **header}
+        return self._header
+
+    @property
+    def compression(self) -> str:
+        return self.header["compression"]
+
+    @property
+    def codec(self) -> EmbeddingCodec:
+        """Codec the rows of the embeddings file are encoded with"""
+        if self._codec is None:
+            if self.header["codec"] is None:
+                self._codec = EmbeddingCodec(self.compression)
+            else:
+                self._codec = EmbeddingCodec.load(generation_path(self.base_codec_path, self.header["codec"]))
+        return self._codec
+
+    def exists(self) -> bool:
+        return self.metadata_path.exists()
+
+    def __len__(self):
+        return len(self.metadata)
+
+    @property
+    def keys(self) -> list:
+        return self.metadata["key"].tolist()
+
+    @property
+    def songs_df(self) -> pd.DataFrame:
+        return self.metadata[["name", "location", "key"]]
+
+    @property
+    def needs_compaction(self) -> bool:
+        return self.tombstones.needs_compaction(len(self.stored_metadata))
+
+    def stored_rows(self) -> int:
+        """Number of embedding rows in use in the embeddings file"""
+        metadata = self.stored_metadata
+        return int((metadata["offset"] + metadata["n_segments"]).max()) if len(metadata) else 0
+
+    def memmap(self) -> np.ndarray:
+        """Read-only view of every stored segment embedding, opened on first use"""
+        if self._memmap is None:
+            n_rows = self.stored_rows()
+            if n_rows == 0:
+                return np.empty((0, self.header["dim"] or 0), dtype=np.float32)
+            self._memmap = np.memmap(
+                self.embeddings_path, dtype=self.header["dtype"], mode="r", shape=(n_rows, self.header["dim"])
+            )
+        return self._memmap
+
+    def get_embeddings(self, i: int):
+        """Segment embeddings of the i-th song, or None if it could not be analysed"""
+        row = self.metadata.iloc[i]
+        if row["n_segments"] == 0:
+            return None
+        return self.memmap()[row["offset"] : row["offset"] + row["n_segments"]]
+
+    def all_embeddings(self) -> list:
+        """Segment embeddings of every song in store order, as views into the memory-mapped file"""
+        data = self.memmap()
+        return [
+            data[offset : offset + n_segments] if n_segments else None
+            for offset, n_segments in zip(self.metadata["offset"], self.metadata["n_segments"])
+        ]
+
+    def append(self, songs: list):
+        """
+        Appends analysed songs to the store.
+
+        Args:
+            songs (list): `Song` objects. Their collapsed embeddings are stored; songs without embeddings are recorded
+                          with no segments so they are not analysed again.
+        """
+        self.append_entries(
+            [(song.key, song.name, str(song.path), song.simplified_yamnet_embeddings) for song in songs]
+        )
+
+    def append_entries(self, entries: list):
+        """
+        Appends songs to the store.
+
+        Args:
+            entries (list): (key, name, location, embeddings) tuples, with float32 embeddings in the space of the
+                            analysed ones, or None for songs which could not be analysed.
+        """
+        if not entries:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # Songs added back after being deleted replace their deleted entries, which are left for compaction to drop
+        added_keys = {key for key, _, _, _ in entries}
+        stored_metadata = self.stored_metadata
+        tombstones = self.tombstones
+        revived = any(key in tombstones for key in added_keys)
+        if revived:
+            stored_metadata = stored_metadata[~stored_metadata["key"].isin(added_keys)]
+
+        offset = self.stored_rows()
+        rows = []
+        with open(self.embeddings_path, "ab") as f:
+            # Drop embeddings written after the last stored song, by a run which stopped before saving their metadata
+            f.truncate(offset * (self.header["dim"] or 0) * np.dtype(self.header["dtype"]).itemsize)
+            for key, name, location, embeddings in entries:
+                n_segments = 0
+                if embeddings is not None:
+                    embeddings = self.codec.encode(embeddings)
+                    if self.header["dim"] is None:
+                        self.header["dim"] = embeddings.shape[1]
+                    f.write(embeddings.tobytes())
+                    n_segments = embeddings.shape[0]
+                rows.append(
+                    {"key": key, "name": name, "location": location, "offset": offset, "n_segments": n_segments}
+                )
+                offset += n_segments
+
+        new_rows = pd.DataFrame(rows, columns=METADATA_COLUMNS)
+        self.write_metadata(
+            new_rows if stored_metadata.empty else pd.concat([stored_metadata, new_rows], ignore_index=True)
+        )
+        if revived:
+            # Only once the deleted entries are gone from the metadata, so that a crash before this can't restore them.
+            # It leaves the added songs deleted instead, to be analysed again
+            tombstones.rewrite([key for key in tombstones if key not in added_keys])
+
+    def merge(self, other) -> int:
+        """
+        Appends the songs of another store which aren't in this one, e.g. those of an `AnalysisShard`.
+
+        Embeddings are reconstructed with the other store's codec and encoded with this one's, so the two stores can be
+        compressed differently.
+
+        Args:
+            other (EmbeddingStore): Store to take songs from. It isn't changed.
+
+        Returns:
+            int: Number of songs added.
+        """
+        stored_keys = set(self.keys)
+        metadata = other.metadata
+        new_songs = [i for i, key in enumerate(metadata["key"]) if key not in stored_keys]
+        all_embeddings = other.all_embeddings()
+        for start in range(0, len(new_songs), REWRITE_BATCH_SONGS):
+            self.append_entries(
+                [
+                    (
+                        metadata["key"].iat[i],
+                        metadata["name"].iat[i],
+                        metadata["location"].iat[i],
+                        None if all_embeddings[i] is None else other.codec.reconstruct(all_embeddings[i]),
+                    )
+                    for i in new_songs[start : start + REWRITE_BATCH_SONGS]
+                ]
+            )
+        return len(new_songs)
+
+    def relocate(self, locations: dict):
+        """
+        Points songs at new files, e.g. after they were moved or renamed, without touching their embeddings.
+
+        Args:
+            locations (dict): New location for each song key.
+        """
+        if not locations:
+            return
+        metadata = self.stored_metadata.copy()
+        moved = metadata["key"].isin(locations.keys())
+        metadata.loc[moved, "location"] = metadata.loc[moved, "key"].map(locations).astype(str)
+        metadata.loc[moved, "name"] = metadata.loc[moved, "location"].map(lambda location: Path(location).name)
+        self.write_metadata(metadata)
+
+    def delete(self, keys: list):
+        """Removes songs from the store by logging them as deleted, leaving the embeddings file untouched"""
+        stored_keys = set(self.metadata["key"])
+        self.tombstones.add([key for key in keys if key in stored_keys])
+        self._metadata = None
+
+    def compact(self, keep_old_generations: bool = False):
+        """
+        Writes the embeddings of the songs in the store to a new file, without those of deleted songs, and commits it.
+
+        This store isn't changed, so it can still be read while the new file is written, e.g. from another thread. With
+        `keep_old_generations` it also stays readable afterwards, until the new store's `remove_old_generations` is
+        called.
+
+        Returns:
+            EmbeddingStore: The compacted store.
+        """
+        compacted = self.rewrite(self.header, keep_old_generations=keep_old_generations)
+        logger.info(f"Compacted embedding store at {self.directory}, dropping {len(self.tombstones)} deleted songs")
+        return compacted
+
+    def compress(
+        self, mode: str, pca_dims: int = DEFAULT_PCA_DIMS, pq_subvectors: int = DEFAULT_PQ_SUBVECTORS, seed: int = 0
+    ):
+        """
+        Fits a codec to the songs in the store, and rewrites their embeddings with it (also dropping deleted songs).
+
+        Embeddings are re-encoded from what is stored, so compressing an already compressed store keeps its losses.
+        Like `compact`, this store isn't changed.
+
+        Args:
+            mode (str): One of COMPRESSION_MODES.
+            pca_dims (int): Dimensions kept by the "pca" and "pq" modes.
+            pq_subvectors (int): Bytes per segment of the "pq" mode.
+            seed (int): Seed for fitting the codec.
+
+        Returns:
+            EmbeddingStore: The compressed store.
+        """
+        codec = EmbeddingCodec.fit(self.sample_segments(seed), mode, pca_dims, pq_subvectors, seed=seed)
+        header = {"dtype": codec.dtype, "dim": None, "compression": mode, "codec": None}
+        if codec.projection is not None:
+            header["codec"] = new_generation()
+            codec_path = generation_path(self.base_codec_path, header["codec"])
+            codec.save(codec_path)
+        compressed = self.rewrite(header, lambda embeddings: codec.encode(self.codec.reconstruct(embeddings)))
+        remove_other_generations(self.base_codec_path, header["codec"] or INITIAL_GENERATION, [".npz"])
+        logger.info(f"Compressed embedding store at {self.directory} to {mode} ({compressed.header['dim']} dims)")
+        return compressed
+
+    def sample_segments(self, seed: int = 0) -> np.ndarray:
+        """A random sample of the songs' segment embeddings, reconstructed as float32, to fit a codec to"""
+        offsets = self.metadata["offset"].to_numpy(dtype=np.int64)
+        n_segments = self.metadata["n_segments"].to_numpy(dtype=np.int64)
+        # Rows of every segment of the songs in the store: each song's offset, plus the segment's position in the song
+        song_starts = np.cumsum(n_segments) - n_segments
+        rows = np.repeat(offsets - song_starts, n_segments) + np.arange(n_segments.sum())
+        if len(rows) > FIT_SAMPLE_SEGMENTS:
+            rows = np.sort(np.random.default_rng(seed).choice(rows, FIT_SAMPLE_SEGMENTS, replace=False))
+        return self.codec.reconstruct(self.memmap()[rows])
+
+    def rewrite(self, header: dict, encode=None, keep_old_generations: bool = False):
+        """
+        Writes the embeddings of the songs in the store to a new generation, and commits it.
+
+        Args:
+            header (dict): Header of the new generation. Its dimension is filled in if missing.
+            encode (callable): Re-encodes an (n_segments, dim) array of stored rows, by default kept as they are.
+            keep_old_generations (bool): Leave the previous embeddings file in place, for readers which still have it
+                                         open, until `remove_old_generations` is called.
+
+        Returns:
+            EmbeddingStore: The rewritten store.
+        """
+        metadata = self.metadata.copy()
+        n_segments = metadata["n_segments"].to_numpy(dtype=np.int64)
+        metadata["offset"] = np.cumsum(n_segments) - n_segments
+
+        rewritten = EmbeddingStore(self.directory)
+        rewritten._header = dict(header)
+        generation = new_generation()
+        embeddings_path = generation_path(self.base_embeddings_path, generation)
+        all_embeddings = [embeddings for embeddings in self.all_embeddings() if embeddings is not None]
+        with open(embeddings_path, "wb") as f:
+            for start in range(0, len(all_embeddings), REWRITE_BATCH_SONGS):
+                embeddings = np.vstack(all_embeddings[start : start + REWRITE_BATCH_SONGS])
+                if encode is not None:
+                    embeddings = encode(embeddings)
+                rewritten.header["dim"] = embeddings.shape[1]
+                f.write(np.ascontiguousarray(embeddings, dtype=rewritten.header["dtype"]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        # The metadata names the new file, so writing it is what switches the store over
+        rewritten.write_metadata(metadata, generation=generation)
+        if not keep_old_generations:
+            rewritten.remove_old_generations()
+        return rewritten
+
+    def remove_old_generations(self):
+        """Removes the embeddings files of every generation before this one"""
+        remove_other_generations(self.base_embeddings_path, self.generation, [".f32", ".tombstones"])
+
+    def write_metadata(self, metadata: pd.DataFrame, generation: str = None):
+        """
+        Atomically replaces the stored metadata.
+
+        Args:
+            metadata (pd.DataFrame): Metadata of every song in the embeddings file, including deleted ones.
+            generation (str): Generation of the embeddings file it describes, by default the current one.
+        """
+        metadata.attrs["header"] = dict(self.header)
+        metadata.attrs["generation"] = self.generation if generation is None else generation
+        with atomic_write(self.metadata_path) as f:
+            pickle.dump(metadata, f)
+        self._stored_metadata = metadata
+        self._metadata = None
+        self._tombstones = None
+        # The memory map is sized from the metadata, so reopen it on next use
+        self._memmap = None
+
+    def import_songs_pickle(self, songs_pickle_path: Path, content_key_index):
+        """Migrates a legacy songs.pickle cache into the store, keeping the old file as a backup"""
+        logger.info(f"Migrating {songs_pickle_path} to embedding store at {self.directory}")
+        with open(songs_pickle_path, "rb") as f:
+            songs = pickle.load(f)
+        for song in songs:
+            song.key = content_key_index.key_or_placeholder(song.path)
+        self.append(songs)
+        if not self.exists():
+            self.write_metadata(self.stored_metadata)
+        os.replace(songs_pickle_path, songs_pickle_path.with_suffix(".pickle.bak"))
+
+    def add_content_keys(self, content_key_index):
+        """Migrates a store written before songs were identified by content key"""
+        logger.info(f"Adding content keys to embedding store at {self.directory}")
+        metadata = self.stored_metadata.copy()
+        metadata.insert(0, "key", [content_key_index.key_or_placeholder(location) for location in metadata["location"]])
+        self.write_metadata(metadata)
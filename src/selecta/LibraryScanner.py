@@ -0,0 +1,110 @@
+import os
+import time
+import pickle
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from selecta.logger import generate_logger
+from selecta.utils import atomic_write
+
+logger = generate_logger()
+
+AUDIO_EXTENSIONS = (".mp3",)
+DEFAULT_SCAN_THREADS = 8
+# A directory modified this recently may still be changing within its mtime's resolution, so its listing isn't cached
+RACY_MTIME_NS = 2 * 10**9
+
+
+class LibraryScanner:
+    """
+    Finds the audio files under a set of directories, remembering each directory's listing between scans.
+
+    Directories are listed with `os.scandir`, a whole level of the tree at a time across a pool of threads. A
+    directory's listing is cached with its modification time, which changes whenever an entry is added, removed or
+    renamed in it, so rescanning an unchanged tree costs one `stat` per directory instead of listing every file.
+    Symbolic links to directories are not followed.
+    """
+
+    def __init__(self, cache_path: Path = None, n_threads: int = DEFAULT_SCAN_THREADS):
+        self.cache_path = Path(cache_path) if cache_path is not None else None
+        self.n_threads = n_threads
+        # directory -> (mtime_ns, audio files, subdirectories)
+        self.directories = {}
+        if self.cache_path is not None:
+            try:
+                with open(self.cache_path, "rb") as f:
+                    self.directories = pickle.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable scan cache {self.cache_path}: {e}")
+
+    def list_directory(self, directory: str) -> tuple:
+        """Audio files and subdirectories directly inside a directory, from the cache if it hasn't changed"""
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError as e:
+            logger.error(f"Error scanning {directory}: {e}")
+            return [], []
+        cached = self.directories.get(directory)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1], cached[2]
+
+        files, subdirectories = [], []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(entry.path)
+                        elif entry.name.endswith(AUDIO_EXTENSIONS) and entry.is_file():
+                            files.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.error(f"Error scanning {directory}: {e}")
+            return [], []
+
+        if time.time_ns() - mtime_ns > RACY_MTIME_NS:
+            self.directories[directory] = (mtime_ns, files, subdirectories)
+        return files, subdirectories
+
+    def scan(self, roots: list) -> list:
+        """
+        Lists every audio file under the given directories.
+
+        Args:
+            roots (list): Directories to scan.
+
+        Returns:
+            list: Paths of the audio files as strings, sorted.
+        """
+        level = [os.path.abspath(root) for root in roots]
+        visited = set()
+        files = []
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            while level:
+                level = [directory for directory in dict.fromkeys(level) if directory not in visited]
+                visited.update(level)
+                next_level = []
+                for directory_files, subdirectories in executor.map(self.list_directory, level):
+                    files.extend(directory_files)
+                    next_level.extend(subdirectories)
+                level = next_level
+
+        self.forget_missing(roots, visited)
+        return sorted(files)
+
+    def forget_missing(self, roots: list, visited: set):
+        """Drops cached listings of directories under the roots which no longer exist"""
+        prefixes = tuple(os.path.join(os.path.abspath(root), "") for root in roots)
+        for directory in list(self.directories):
+            if directory not in visited and directory.startswith(prefixes):
+                del self.directories[directory]
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        with atomic_write(self.cache_path) as f:
+            pickle.dump(self.directories, f)
@@ -0,0 +1,123 @@
+import os
+import queue
+import threading
+
+from selecta.logger import generate_logger
+from selecta.LibraryScanner import LibraryScanner
+
+logger = generate_logger()
+
+DEFAULT_WATCH_INTERVAL_S = 30.0
+
+
+class LibraryWatcher:
+    """
+    Polls directories for new or changed audio files and queues them for incremental analysis.
+
+    Each poll rescans the directories with a `LibraryScanner`, then compares every file's size and modification time
+    with the previous poll. A new or changed file is only queued once it has stayed the same for a whole interval, so
+    that files which are still being copied or downloaded aren't analysed half-written. Deleted files are not
+    reported.
+
+    Polling needs no platform-specific file system notifications and works on network drives, at the cost of one
+    `stat` per file per poll.
+    """
+
+    def __init__(self, scanner: LibraryScanner, roots: list, interval_s: float = DEFAULT_WATCH_INTERVAL_S):
+        self.scanner = scanner
+        self.roots = [str(root) for root in roots]
+        self.interval_s = interval_s
+        self.queue = queue.Queue()
+        self.stop_event = threading.Event()
+        self.thread = None
+        # path -> (size, mtime_ns) of every file seen and accounted for
+        self.file_stats = {}
+        # path -> (size, mtime_ns) of new or changed files waiting to settle
+        self.pending = {}
+
+    @staticmethod
+    def stat_file(path: str):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def poll(self, queue_changes: bool = True) -> list:
+        """
+        Rescans the directories once.
+
+        Args:
+            queue_changes (bool): Queue settled new or changed files. The first poll is usually made with False, to
+                                  record the files which are already there.
+
+        Returns:
+            list: Paths of the files queued by this poll.
+        """
+        paths = self.scanner.scan(self.roots)
+        self.scanner.save()
+        stats = dict(zip(paths, map(self.stat_file, paths)))
+
+        settled = []
+        for path, stat in stats.items():
+            if stat is None or self.file_stats.get(path) == stat:
+                continue
+            if not queue_changes:
+                self.file_stats[path] = stat
+            elif self.pending.get(path) == stat:
+                del self.pending[path]
+                self.file_stats[path] = stat
+                settled.append(path)
+            else:
+                self.pending[path] = stat
+
+        # Forget deleted files, so that they are picked up again if they come back
+        for path in [path for path in self.file_stats if path not in stats]:
+            del self.file_stats[path]
+        for path in [path for path in self.pending if path not in stats]:
+            del self.pending[path]
+
+        for path in settled:
+            self.queue.put(path)
+        if settled:
+            logger.info(f"Queued {len(settled)} new or changed songs for analysis")
+        return settled
+
+    def start(self):
+        """Polls in a background thread every `interval_s` seconds until `stop` is called"""
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="library-watcher", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval_s):
+            try:
+                self.poll()
+            except Exception as e:
+                logger.exception(f"Error watching {', '.join(self.roots)}: {e}")
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def next_batch(self, timeout: float = None) -> list:
+        """
+        Waits for queued files and takes every one queued so far.
+
+        Args:
+            timeout (float): Longest time to wait, in seconds. None waits until something is queued.
+
+        Returns:
+            list: Paths of the files, empty if none were queued before the timeout.
+        """
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                return list(dict.fromkeys(batch))
@@ -0,0 +1,182 @@
+import numpy as np
+
+from pathlib import Path
+
+from selecta.utils import atomic_write
+from selecta.TombstoneLog import (
+    TombstoneLog,
+    INITIAL_GENERATION,
+    new_generation,
+    generation_path,
+    remove_other_generations,
+)
+
+DEFAULT_NEIGHBOURS = 100
+
+
+class NeighbourGraph:
+    """
+    Sparse alternative to the dense similarity matrix which keeps only each song's K nearest neighbours.
+
+    Neighbours are stored as two compact (n_songs, K) arrays: the index of each neighbour and its distance (the median
+    cosine distance unless another aggregation was chosen). Unused slots (songs with fewer than K analysed neighbours)
+    hold index -1 and distance inf. Storage and load time grow linearly with the library instead of quadratically.
+
+    A graph loaded from a file can `delete` songs without saving it again: they are dropped in memory and logged to the
+    file's `TombstoneLog`, and dropped again whenever the file is loaded, until the graph is next saved.
+    """
+
+    def __init__(self, keys: list, neighbours: np.ndarray, distances: np.ndarray, aggregation: str = "median"):
+        self.keys = list(keys)
+        self.neighbours = neighbours
+        self.distances = distances
+        # How song distances were aggregated from segment distances, see `SimilarityEngine`
+        self.aggregation = aggregation
+        self.key_to_index = {key: i for i, key in enumerate(self.keys)}
+        # The file the graph was loaded from or saved to, and its deleted songs
+        self.path = None
+        self.tombstones = None
+
+    @classmethod
+    def empty(cls, keys: list, k: int = DEFAULT_NEIGHBOURS, aggregation: str = "median"):
+        return cls(
+            keys=keys,
+            neighbours=np.full((len(keys), k), -1, dtype=np.int32),
+            distances=np.full((len(keys), k), np.inf, dtype=np.float32),
+            aggregation=aggregation,
+        )
+
+    @property
+    def k(self) -> int:
+        return self.distances.shape[1]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.key_to_index
+
+    def add_songs(self, keys: list):
+        """Appends songs with no neighbours yet, so that they can be filled in incrementally"""
+        self.neighbours = np.vstack([self.neighbours, np.full((len(keys), self.k), -1, dtype=np.int32)])
+        self.distances = np.vstack([self.distances, np.full((len(keys), self.k), np.inf, dtype=np.float32)])
+        for key in keys:
+            self.key_to_index[key] = len(self.keys)
+            self.keys.append(key)
+
+    def add_candidates(self, rows: np.ndarray, cols: np.ndarray, distances: np.ndarray):
+        """
+        Merges a block of candidate neighbours into the graph, keeping the K nearest per song.
+
+        Args:
+            rows (np.ndarray): Indices of the songs receiving candidates.
+            cols (np.ndarray): Indices of the candidate songs.
+            distances (np.ndarray): (len(rows), len(cols)) distances. NaN distances and self pairs are ignored.
+        """
+        candidates = np.broadcast_to(np.asarray(cols, dtype=np.int32), distances.shape)
+        candidate_distances = np.where(
+            np.isnan(distances) | (candidates == np.asarray(rows)[:, None]), np.inf, distances
+        ).astype(np.float32)
+
+        merged_neighbours = np.hstack([self.neighbours[rows], candidates])
+        merged_distances = np.hstack([self.distances[rows], candidate_distances])
+        nearest = np.argpartition(merged_distances, self.k - 1, axis=1)[:, : self.k]
+        self.neighbours[rows] = np.take_along_axis(merged_neighbours, nearest, axis=1)
+        self.distances[rows] = np.take_along_axis(merged_distances, nearest, axis=1)
+
+    def nearest(self, key: str, n: int) -> list:
+        """
+        Returns the keys of up to n songs nearest to a song, closest first.
+
+        Args:
+            key (str): Key of the song.
+            n (int): Number of neighbours wanted. At most K neighbours are available.
+
+        Returns:
+            list: Song keys, excluding the song itself.
+        """
+        row = self.key_to_index[key]
+        order = np.argsort(self.distances[row], kind="stable")
+        order = order[np.isfinite(self.distances[row][order])][:n]
+        return [self.keys[i] for i in self.neighbours[row][order]]
+
+    def drop_songs(self, keys: list):
+        """
+        Removes songs from the graph and from every neighbour list.
+
+        Songs which lose neighbours keep fewer than K until the graph is next rebuilt.
+        """
+        dropped = set(keys)
+        keep = np.array([key not in dropped for key in self.keys], dtype=bool)
+        new_index = np.full(len(self.keys) + 1, -1, dtype=np.int32)
+        new_index[:-1][keep] = np.arange(np.count_nonzero(keep), dtype=np.int32)
+
+        # Index -1 maps to the extra trailing slot, which stays -1
+        self.neighbours = new_index[self.neighbours[keep]]
+        self.distances = np.where(self.neighbours >= 0, self.distances[keep], np.inf).astype(np.float32)
+        self.keys = [key for key, kept in zip(self.keys, keep) if kept]
+        self.key_to_index = {key: i for i, key in enumerate(self.keys)}
+
+    @property
+    def needs_compaction(self) -> bool:
+        return self.tombstones is not None and self.tombstones.needs_compaction(len(self.keys) + len(self.tombstones))
+
+    def delete(self, keys: list):
+        """Drops songs from the graph, and logs them as deleted from its file rather than saving it again"""
+        keys = [key for key in keys if key in self.key_to_index]
+        self.drop_songs(keys)
+        if self.tombstones is not None:
+            self.tombstones.add(keys)
+
+    def compact(self, keep_old_generations: bool = False):
+        """
+        Saves the graph in place of its file and deleted songs.
+
+        Args:
+            keep_old_generations (bool): Leave the tombstones of the previous file in place until
+                                         `remove_old_generations` is called.
+
+        Returns:
+            NeighbourGraph: The saved copy, as the graph itself may keep changing while it is written.
+        """
+        compacted = NeighbourGraph(self.keys, self.neighbours, self.distances, self.aggregation)
+        compacted.save(self.path, keep_old_generations)
+        return compacted
+
+    def save(self, path: Path, keep_old_generations: bool = False):
+        generation = new_generation()
+        # Written to a temporary file first, so that an interrupted save never leaves a truncated graph behind
+        with atomic_write(path) as f:
+            np.savez(
+                f,
+                keys=np.array(self.keys, dtype=str),
+                neighbours=self.neighbours,
+                distances=self.distances,
+                generation=np.array(generation),
+                aggregation=np.array(self.aggregation),
+            )
+        self.path = path
+        self.tombstones = TombstoneLog(generation_path(path, generation, ".tombstones"), generation)
+        if not keep_old_generations:
+            self.remove_old_generations()
+
+    def remove_old_generations(self):
+        """Removes the tombstones of every file saved before this one"""
+        remove_other_generations(self.path, self.tombstones.generation, [".tombstones"])
+
+    @classmethod
+    def load(cls, path: Path):
+        with np.load(path) as data:
+            graph = cls(
+                keys=data["keys"].tolist(),
+                neighbours=data["neighbours"],
+                distances=data["distances"],
+                # Graphs saved before aggregations were selectable hold medians
+                aggregation=str(data["aggregation"]) if "aggregation" in data else "median",
+            )
+            generation = str(data["generation"]) if "generation" in data else INITIAL_GENERATION
+        graph.path = path
+        graph.tombstones = TombstoneLog(generation_path(path, generation, ".tombstones"), generation)
+        if len(graph.tombstones):
+            graph.drop_songs(list(graph.tombstones))
+        return graph
@@ -0,0 +1,172 @@
+import os
+import re
+import shutil
+import pandas as pd
+import xml.etree.ElementTree as ET
+
+from pathlib import Path
+from zipfile import ZipFile, ZipInfo, ZIP_STORED
+
+from selecta.logger import generate_logger
+from selecta.utils import atomic_write
+
+logger = generate_logger()
+
+EXPORT_FORMATS = {
+    "zip": "the audio files in a .zip archive",
+    "m3u8": "an .m3u8 playlist referencing the audio files",
+    "rekordbox": "a Rekordbox XML collection referencing the audio files",
+}
+EXPORT_SUFFIXES = {"zip": ".zip", "m3u8": ".m3u8", "rekordbox": ".xml"}
+COPY_CHUNK_BYTES = 1024 * 1024
+
+
+class PlaylistExporter:
+    """
+    Exports playlists as a .zip of their audio files, or as .m3u8 and Rekordbox XML files which only reference them.
+
+    Playlists hold song names, which are resolved to files through an index built once from the songs DataFrame; a
+    name shared by several songs refers to the first one stored. Archives are written with ZIP_STORED, since MP3s
+    don't compress, and each file is streamed straight into the archive without an intermediate copy. Every export is
+    written to a temporary file first and moved into place once complete. A playlist with songs none of whose files
+    are found fails, and nothing is written for it; an empty playlist is exported empty.
+    """
+
+    def __init__(self, songs_df: pd.DataFrame):
+        self.locations = dict(zip(songs_df["name"][::-1], songs_df["location"][::-1]))
+
+    def resolve(self, name: str, song_names: list) -> tuple:
+        """
+        Finds the files of a playlist's songs.
+
+        Returns:
+            tuple: (paths of the songs' files, or None if the playlist has songs and none of their files were found,
+                   names of the songs which are unknown or whose file is missing)
+        """
+        paths, missing = [], []
+        for song_name in song_names:
+            location = self.locations.get(song_name)
+            if location is not None and os.path.isfile(location):
+                paths.append(location)
+            else:
+                missing.append(song_name)
+        if song_names and not paths:
+            logger.warning(f"Not exporting {name}, as none of its song files were found")
+            return None, missing
+        return paths, missing
+
+    def export(self, playlists: list, output: Path, export_format: str) -> tuple:
+        """
+        Exports playlists in one of EXPORT_FORMATS.
+
+        Args:
+            playlists (list): (name, song names) pairs.
+            output (Path): File to write. With several playlists in a format holding one playlist per file, a
+                           directory which gets one file per playlist.
+            export_format (str): One of EXPORT_FORMATS.
+
+        Returns:
+            tuple: (names of the songs which could not be exported as their files weren't found, names of the
+                   playlists which failed as none of their files were found)
+        """
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format {export_format!r}, expected one of {list(EXPORT_FORMATS)}")
+        output = Path(output)
+        if export_format == "rekordbox":
+            return self.write_rekordbox_xml(playlists, output)
+
+        write = self.write_zip if export_format == "zip" else self.write_m3u8
+        single_file = len(playlists) == 1 and not output.is_dir()
+        missing, failed = [], []
+        file_names = set()
+        for name, song_names in playlists:
+            if single_file:
+                path = output
+            else:
+                path = output / unique_name(f"{safe_file_name(name)}{EXPORT_SUFFIXES[export_format]}", file_names)
+            paths, playlist_missing = self.resolve(name, song_names)
+            missing += playlist_missing
+            if paths is None:
+                failed.append(name)
+            else:
+                write(name, paths, path)
+        return missing, failed
+
+    def write_zip(self, name: str, paths: list, path: Path):
+        arcnames = set()
+        with atomic_write(path) as f, ZipFile(f, "w", compression=ZIP_STORED, allowZip64=True) as zipf:
+            for song_path in paths:
+                arcname = unique_name(os.path.basename(song_path), arcnames)
+                with open(song_path, "rb") as src, zipf.open(ZipInfo.from_file(song_path, arcname), "w") as dest:
+                    shutil.copyfileobj(src, dest, COPY_CHUNK_BYTES)
+        logger.info(f"Exported {len(paths)} songs of {name} to {path}")
+
+    def write_m3u8(self, name: str, paths: list, path: Path):
+        lines = ["#EXTM3U", f"#PLAYLIST:{name}"]
+        for song_path in paths:
+            lines += [f"#EXTINF:-1,{Path(song_path).stem}", os.path.abspath(song_path)]
+        with atomic_write(path, "w", encoding="utf-8", newline="\n") as f:
+            f.write("\n".join(lines) + "\n")
+        logger.info(f"Exported playlist {name} to {path}")
+
+    def write_rekordbox_xml(self, playlists: list, path: Path) -> tuple:
+        """
+        Writes every playlist into one Rekordbox XML file, with their songs as its collection. Playlists which fail
+        (see `resolve`) are left out, and the file isn't written if that is all of them.
+        """
+        root = ET.Element("DJ_PLAYLISTS", Version="1.0.0")
+        ET.SubElement(root, "PRODUCT", Name="Selecta", Version="1.0", Company="")
+        collection = ET.SubElement(root, "COLLECTION")
+        playlists_node = ET.SubElement(ET.SubElement(root, "PLAYLISTS"), "NODE", Type="0", Name="ROOT")
+
+        track_ids = {}
+        missing, failed = [], []
+        for name, song_names in playlists:
+            paths, playlist_missing = self.resolve(name, song_names)
+            missing += playlist_missing
+            if paths is None:
+                failed.append(name)
+                continue
+            node = ET.SubElement(playlists_node, "NODE", Name=name, Type="1", KeyType="0", Entries=str(len(paths)))
+            for song_path in paths:
+                if song_path not in track_ids:
+                    track_ids[song_path] = str(len(track_ids) + 1)
+                    ET.SubElement(
+                        collection,
+                        "TRACK",
+                        TrackID=track_ids[song_path],
+                        Name=Path(song_path).stem,
+                        Location=rekordbox_location(song_path),
+                    )
+                ET.SubElement(node, "TRACK", Key=track_ids[song_path])
+        collection.set("Entries", str(len(track_ids)))
+        playlists_node.set("Count", str(len(playlists) - len(failed)))
+        if len(failed) == len(playlists):
+            return missing, failed
+
+        tree = ET.ElementTree(root)
+        ET.indent(tree)
+        with atomic_write(path) as f:
+            tree.write(f, encoding="UTF-8", xml_declaration=True)
+        logger.info(f"Exported {len(playlists) - len(failed)} playlists to {path}")
+        return missing, failed
+
+
+def rekordbox_location(song_path: str) -> str:
+    # Rekordbox expects percent-encoded file URLs on the "localhost" host
+    return Path(song_path).absolute().as_uri().replace("file://", "file://localhost", 1)
+
+
+def safe_file_name(name: str) -> str:
+    return re.sub(r'[<>:"/\\|?*\x00-\x1f]', "_", name).strip() or "playlist"
+
+
+def unique_name(name: str, taken: set) -> str:
+    """Name, or name with a number added if it is already taken, e.g. two songs with the same file name"""
+    stem, suffix = os.path.splitext(name)
+    candidate, i = name, 1
+    while candidate in taken:
+        i += 1
+        candidate = f"{stem} ({i}){suffix}"
+    taken.add(candidate)
+    return candidate
@@ -0,0 +1,201 @@
+import json
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+from selecta.NeighbourGraph import NeighbourGraph
+from selecta.SimilarityMatrix import SimilarityMatrix
+
+# How the distances from a candidate song to several seed songs are combined into one
+SEED_COMBINE_MODES = {
+    "centroid": "average distance to the seed songs",
+    "min": "distance to the closest seed song",
+}
+# Most similarity matrix rows read at once, in bytes
+DENSE_BATCH_BYTES = 64 * 1024**2
+
+
+class PlaylistGenerator:
+    """
+    Builds many playlists at once from the similarity data, each from one root song or a set of seed songs.
+
+    With the dense matrix, the rows of every seed song in a batch of playlists are read together, combined per playlist
+    and reduced to each playlist's nearest songs with a single `np.argpartition`, so the cost is one pass over the seed
+    rows rather than a full sort per playlist. With the neighbour graph only the seeds' stored neighbours are
+    candidates, and at most K songs per seed can be returned.
+
+    Playlists are described and returned by content key.
+    """
+
+    def __init__(self, similarity_matrix: SimilarityMatrix = None, neighbour_graph: NeighbourGraph = None):
+        self.similarity_matrix = similarity_matrix
+        self.neighbour_graph = neighbour_graph
+
+    @staticmethod
+    def read_seeds_file(path: Path, songs_df: pd.DataFrame) -> list:
+        """
+        Reads a JSON file describing playlists to generate, such as
+            [{"name": "Warm Up", "seeds": ["Song A.mp3", "/music/Song B.mp3"]}, ...]
+        Seed songs are given by location or by name; a name shared by several songs refers to the first one stored.
+
+        Returns:
+            list: (playlist name, seed song keys, seeds which match no song) for each playlist.
+        """
+        with open(path) as f:
+            specs = json.load(f)
+        keys_by_location = dict(zip(songs_df["location"], songs_df["key"]))
+        keys_by_name = dict(zip(songs_df["name"][::-1], songs_df["key"][::-1]))
+
+        playlists = []
+        for spec in specs:
+            seeds = [spec["seeds"]] if isinstance(spec["seeds"], str) else spec["seeds"]
+            seed_keys, unknown = [], []
+            for seed in seeds:
+                key = keys_by_location.get(seed, keys_by_name.get(seed))
+                if key is None:
+                    unknown.append(seed)
+                else:
+                    seed_keys.append(key)
+            playlists.append((spec["name"], seed_keys, unknown))
+        return playlists
+
+    def generate(self, seeds: list, n: int, combine: str = "centroid") -> list:
+        """
+        Generates playlists.
+
+        Args:
+            seeds (list): For each playlist, the key of its root song or a list of keys of seed songs.
+            n (int): Number of songs wanted in each playlist, besides its seeds.
+            combine (str): How distances to several seeds are combined, one of SEED_COMBINE_MODES.
+
+        Returns:
+            list: For each playlist, the keys of up to n songs closest first, excluding its seeds, or None if a seed
+                  has no similarity data. Songs which could not be analysed are never included.
+        """
+        if combine not in SEED_COMBINE_MODES:
+            raise ValueError(f"Unknown seed combination {combine!r}, expected one of {list(SEED_COMBINE_MODES)}")
+        seed_lists = [[seed] if isinstance(seed, str) else list(dict.fromkeys(seed)) for seed in seeds]
+
+        playlists = [None] * len(seed_lists)
+        dense, sparse = [], []
+        for i, seed_keys in enumerate(seed_lists):
+            if not seed_keys:
+                continue
+            if self.similarity_matrix is not None and all(key in self.similarity_matrix for key in seed_keys):
+                dense.append(i)
+            elif self.neighbour_graph is not None and all(key in self.neighbour_graph for key in seed_keys):
+                sparse.append(i)
+
+        if dense:
+            indices = [[self.similarity_matrix.key_to_index[key] for key in seed_lists[i]] for i in dense]
+            for i, nearest in zip(dense, self.nearest_dense(indices, n, combine)):
+                playlists[i] = [self.similarity_matrix.keys[j] for j in nearest]
+        if sparse:
+            indices = [[self.neighbour_graph.key_to_index[key] for key in seed_lists[i]] for i in sparse]
+            for i, nearest in zip(sparse, self.nearest_sparse(indices, n, combine)):
+                playlists[i] = [self.neighbour_graph.keys[j] for j in nearest]
+        return playlists
+
+    def nearest_dense(self, seed_indices: list, n: int, combine: str) -> list:
+        data = self.similarity_matrix.memmap()
+        deleted = self.similarity_matrix.deleted_indices
+        n_songs = len(self.similarity_matrix)
+        rows_per_batch = max(1, DENSE_BATCH_BYTES // (max(n_songs, 1) * data.dtype.itemsize))
+
+        # Batches hold as many playlists as fit, and always at least one
+        nearest = []
+        batch, batch_rows = [], 0
+        for indices in seed_indices:
+            if batch and batch_rows + len(indices) > rows_per_batch:
+                nearest.extend(self.nearest_dense_batch(data, batch, n, combine, deleted))
+                batch, batch_rows = [], 0
+            batch.append(indices)
+            batch_rows += len(indices)
+        if batch:
+            nearest.extend(self.nearest_dense_batch(data, batch, n, combine, deleted))
+        return nearest
+
+    @staticmethod
+    def nearest_dense_batch(data: np.ndarray, seed_indices: list, n: int, combine: str, deleted: np.ndarray) -> list:
+        flat = np.concatenate([np.asarray(indices, dtype=np.int64) for indices in seed_indices])
+        counts = np.array([len(indices) for indices in seed_indices], dtype=np.int64)
+        starts = np.cumsum(counts) - counts
+
+        # Read the rows in file order, then treat songs without similarities as infinitely far away
+        read_order = np.argsort(flat, kind="stable")
+        rows = np.empty((len(flat), data.shape[1]), dtype=np.float32)
+        rows[read_order] = data[flat[read_order]]
+        rows[np.isnan(rows)] = np.inf
+
+        if combine == "min":
+            distances = np.minimum.reduceat(rows, starts, axis=0)
+        else:
+            distances = np.add.reduceat(rows, starts, axis=0) / counts[:, None]
+        # A playlist's own seeds are never among its songs, and neither are deleted songs
+        distances[np.repeat(np.arange(len(seed_indices)), counts), flat] = np.inf
+        distances[:, deleted] = np.inf
+
+        n = min(n, distances.shape[1])
+        if n <= 0:
+            return [np.empty(0, dtype=np.int64) for _ in seed_indices]
+        candidates = np.argpartition(distances, n - 1, axis=1)[:, :n]
+        candidate_distances = np.take_along_axis(distances, candidates, axis=1)
+        # Closest first, ties broken by song order
+        order = np.lexsort((candidates, candidate_distances))
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        candidate_distances = np.take_along_axis(candidate_distances, order, axis=1)
+        return [row[np.isfinite(row_distances)] for row, row_distances in zip(candidates, candidate_distances)]
+
+    def nearest_sparse(self, seed_indices: list, n: int, combine: str) -> list:
+        graph = self.neighbour_graph
+        n_songs = len(graph)
+        n_playlists = len(seed_indices)
+        flat = np.concatenate([np.asarray(indices, dtype=np.int64) for indices in seed_indices])
+        counts = np.array([len(indices) for indices in seed_indices], dtype=np.int64)
+        seed_playlists = np.repeat(np.arange(n_playlists), counts)
+
+        # Every stored neighbour of every seed is a candidate for the seed's playlist
+        neighbours = graph.neighbours[flat].astype(np.int64)
+        distances = graph.distances[flat].astype(np.float64)
+        valid = (neighbours >= 0) & np.isfinite(distances)
+        if (counts == 1).all():
+            # With a single seed each, a playlist is its seed's neighbours, closest first with ties broken by song order
+            distances[~valid] = np.inf
+            order = np.lexsort((neighbours, distances))
+            neighbours = np.take_along_axis(neighbours, order, axis=1)
+            valid = np.take_along_axis(valid, order, axis=1)
+            return [row[row_valid][: max(n, 0)] for row, row_valid in zip(neighbours, valid)]
+
+        candidate_playlists = np.broadcast_to(seed_playlists[:, None], neighbours.shape)[valid]
+        candidates = neighbours[valid]
+        candidate_distances = distances[valid]
+
+        # Group the candidates by (playlist, song)
+        groups, group_of = np.unique(candidate_playlists * n_songs + candidates, return_inverse=True)
+        group_playlists, group_songs = np.divmod(groups, n_songs)
+        if combine == "min":
+            group_distances = np.full(len(groups), np.inf)
+            np.minimum.at(group_distances, group_of, candidate_distances)
+        else:
+            # A song missing from a seed's neighbours is at least as far as the seed's furthest stored neighbour, so
+            # that distance stands in for it
+            furthest = np.where(valid, distances, -np.inf).max(axis=1)
+            furthest[~np.isfinite(furthest)] = np.inf
+            seed_fallbacks = np.broadcast_to(furthest[:, None], neighbours.shape)[valid]
+            playlist_fallbacks = np.bincount(seed_playlists, weights=furthest, minlength=n_playlists)
+            group_distances = (
+                np.bincount(group_of, weights=candidate_distances, minlength=len(groups))
+                - np.bincount(group_of, weights=seed_fallbacks, minlength=len(groups))
+                + playlist_fallbacks[group_playlists]
+            ) / counts[group_playlists]
+            group_distances[np.isnan(group_distances)] = np.inf
+
+        keep = np.isfinite(group_distances) & ~np.isin(groups, seed_playlists * n_songs + flat)
+        group_playlists, group_songs, group_distances = group_playlists[keep], group_songs[keep], group_distances[keep]
+
+        # Closest first within each playlist, ties broken by song order, then the first n of each
+        order = np.lexsort((group_songs, group_distances, group_playlists))
+        group_playlists, group_songs = group_playlists[order], group_songs[order]
+        boundaries = np.searchsorted(group_playlists, np.arange(n_playlists + 1))
+        return [group_songs[start : min(start + max(n, 0), end)] for start, end in zip(boundaries, boundaries[1:])]
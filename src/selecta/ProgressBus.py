@@ -0,0 +1,138 @@
+import time
+
+from selecta.logger import generate_logger
+
+logger = generate_logger()
+
+DEFAULT_MIN_INTERVAL_S = 0.2
+DEFAULT_MIN_PERCENTAGE_STEP = 1.0
+# Progress is published at least this often while a stage runs, even if its percentage hasn't moved
+DEFAULT_HEARTBEAT_INTERVAL_S = 5.0
+
+
+class ProgressEvent:
+    """Snapshot of progress through one stage of a run, as published by a `ProgressBus`"""
+
+    def __init__(self, stage: str, done: int, total: int, elapsed_s: float, message: str = None):
+        self.stage = stage
+        self.done = done
+        self.total = total
+        self.elapsed_s = elapsed_s
+        self.message = message
+
+    @property
+    def percentage(self) -> float:
+        return 100 * self.done / self.total if self.total else 100.0
+
+    @property
+    def rate(self) -> float:
+        """Items per second since the stage started"""
+        return self.done / self.elapsed_s if self.elapsed_s > 0 else 0.0
+
+    @property
+    def eta_s(self):
+        """Estimated seconds until the stage finishes, or None before any progress has been made"""
+        if self.rate == 0:
+            return None
+        return (self.total - self.done) / self.rate
+
+    def as_dict(self) -> dict:
+        eta_s = self.eta_s
+        return {
+            "stage": self.stage,
+            "message": self.message,
+            "done": self.done,
+            "total": self.total,
+            "percentage": round(self.percentage, 1),
+            "elapsed_s": round(self.elapsed_s, 3),
+            "rate": round(self.rate, 3),
+            "eta_s": None if eta_s is None else round(eta_s, 1),
+        }
+
+    def describe(self) -> str:
+        text = f"{self.message or self.stage}: {self.done}/{self.total} ({self.percentage:.0f}%), {self.rate:.1f}/s"
+        if self.eta_s is not None and self.done < self.total:
+            text += f", ETA {self.eta_s:.0f}s"
+        return text
+
+
+class ProgressBus:
+    """
+    Publishes progress events to subscribers, rate limited so that reporting progress costs next to nothing.
+
+    Work loops call `update` as often as they like. An event is only built and published once at least
+    `min_interval_s` has passed since the previous one and the percentage has moved by `min_percentage_step`, or
+    `heartbeat_interval_s` has passed, so a subscriber such as a Qt signal sees a handful of events per second at most
+    however fast the loop runs. The start and end of every stage, and status messages, are always published.
+    """
+
+    def __init__(
+        self,
+        min_interval_s: float = DEFAULT_MIN_INTERVAL_S,
+        min_percentage_step: float = DEFAULT_MIN_PERCENTAGE_STEP,
+        heartbeat_interval_s: float = DEFAULT_HEARTBEAT_INTERVAL_S,
+    ):
+        self.min_interval_s = min_interval_s
+        self.min_percentage_step = min_percentage_step
+        self.heartbeat_interval_s = heartbeat_interval_s
+        self.subscribers = []
+        self.stage = None
+        self.message = None
+        self.total = 0
+        self.done = 0
+        self.stage_start = 0.0
+        self.last_published = 0.0
+        self.next_done = 0
+
+    def subscribe(self, callback):
+        """Calls `callback(event)` with every published `ProgressEvent`"""
+        self.subscribers.append(callback)
+        return callback
+
+    def publish(self, event: ProgressEvent):
+        for callback in self.subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                # A broken progress display mustn't stop the work it reports on
+                logger.error(f"Error in progress subscriber {callback}: {e}")
+
+    def status(self, message: str):
+        """Publishes a status message on its own, outside of any stage's progress"""
+        self.publish(ProgressEvent("status", 0, 0, 0.0, message=message))
+
+    def start_stage(self, stage: str, total: int, message: str = None):
+        self.stage = stage
+        self.message = message
+        self.total = total
+        self.done = 0
+        self.stage_start = time.monotonic()
+        self.publish_progress(self.stage_start)
+
+    def update(self, done: int, total: int = None):
+        """Records progress through the current stage, publishing it if enough time and progress have passed"""
+        self.done = done
+        if total is not None:
+            self.total = total
+        now = time.monotonic()
+        since_published = now - self.last_published
+        if since_published >= self.min_interval_s and (
+            done >= self.next_done or since_published >= self.heartbeat_interval_s
+        ):
+            self.publish_progress(now)
+
+    def finish_stage(self):
+        self.done = max(self.done, self.total)
+        self.publish_progress(time.monotonic())
+        self.stage = None
+
+    def publish_progress(self, now: float):
+        self.last_published = now
+        # The item count at which the percentage will next have moved far enough to publish again
+        self.next_done = self.done + self.min_percentage_step * self.total / 100
+        self.publish(ProgressEvent(self.stage, self.done, self.total, now - self.stage_start, message=self.message))
+
+
+def log_progress(event: ProgressEvent):
+    """Subscriber writing progress to the log"""
+    logger.info(event.describe() if event.stage != "status" else event.message)
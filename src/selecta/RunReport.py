@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import time
+import random
+import cProfile
+
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+
+from selecta.logger import generate_logger
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+logger = generate_logger()
+
+# Older reports (and their profiles) are deleted when a new run starts
+MAX_RUN_REPORTS = 20
+
+
+def peak_rss_mb():
+    """Peak resident memory of the current process in MB, or None where the platform doesn't report it"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / 2**20 if sys.platform == "darwin" else peak / 2**10, 1)
+
+
+def worker_stats() -> dict:
+    return {"worker_pid": os.getpid(), "worker_peak_rss_mb": peak_rss_mb()}
+
+
+def profiled_call(profile_path, function, *args, **kwargs):
+    """Calls a function, under cProfile with its stats dumped to `profile_path` unless that is None"""
+    if profile_path is None:
+        return function(*args, **kwargs)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(profile_path)
+
+
+class RunReport:
+    """
+    Structured timing report for one analysis run, written as JSON lines as the run goes.
+
+    Each line is an object with a "type":
+        stage   wall and CPU time of a stage of the run in the main process, plus the process's peak RSS
+        song    per-song decode, inference and collapse times, and the worker processes that handled it
+        worker  peak RSS of every worker process seen
+        run     totals, written when the run ends
+
+    With `profile_songs` set, the decode and inference of a random sample of that many songs also run under cProfile,
+    with stats dumped next to the report (load them with `pstats` or snakeviz).
+    """
+
+    def __init__(self, directory: Path, profile_songs: int = 0):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.prune()
+        self.run_id = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        self.path = self.directory / f"{self.run_id}.jsonl"
+        self.profile_directory = self.directory / self.run_id
+        self.profile_songs = profile_songs
+        self.workers = {}
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.file = open(self.path, "w", encoding="utf-8")
+
+    def prune(self):
+        reports = sorted(self.directory.glob("*.jsonl"))
+        for report in reports[: max(0, len(reports) - MAX_RUN_REPORTS + 1)]:
+            profile_directory = report.with_suffix("")
+            if profile_directory.is_dir():
+                for profile in profile_directory.iterdir():
+                    profile.unlink()
+                profile_directory.rmdir()
+            report.unlink()
+
+    def write(self, record_type: str, **fields):
+        if self.file is None:
+            return
+        self.file.write(json.dumps({"type": record_type, **fields}) + "\n")
+        self.file.flush()
+
+    def choose_profiled_keys(self, keys: list) -> set:
+        """Picks the songs to profile, spread across the whole run"""
+        if not self.profile_songs:
+            return set()
+        return set(random.Random(0).sample(list(keys), min(self.profile_songs, len(keys))))
+
+    def profile_path(self, stage: str, key: str) -> str:
+        self.profile_directory.mkdir(exist_ok=True)
+        return str(self.profile_directory / f"{stage}-{key}.prof")
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times a stage of the run in the main process.
+
+        Yields:
+            dict: Extra fields to add to the stage's record.
+        """
+        fields = {}
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield fields
+        finally:
+            self.write(
+                "stage",
+                stage=name,
+                wall_s=round(time.perf_counter() - start, 4),
+                cpu_s=round(time.process_time() - cpu_start, 4),
+                peak_rss_mb=peak_rss_mb(),
+                **fields,
+            )
+
+    def record_worker(self, role: str, stats: dict):
+        pid, peak = stats["worker_pid"], stats["worker_peak_rss_mb"]
+        worker = self.workers.setdefault(pid, {"role": role, "peak_rss_mb": peak})
+        if peak is not None and (worker["peak_rss_mb"] is None or peak > worker["peak_rss_mb"]):
+            worker["peak_rss_mb"] = peak
+
+    def record_song(self, song_path, key, decode_timings: dict, inference_timings: dict = None, **fields):
+        """Writes a song's record from the timings returned by the decode and inference workers"""
+        self.record_worker("decode", decode_timings)
+        song = {
+            "path": str(song_path),
+            "key": key,
+            "decode_wall_s": decode_timings["wall_s"],
+            "decode_cpu_s": decode_timings["cpu_s"],
+            "decode_pid": decode_timings["worker_pid"],
+        }
+        if inference_timings is not None:
+            self.record_worker("inference", inference_timings)
+            # A batch is a single model call, so its time is shared evenly between the batch's songs
+            batch_size = inference_timings["batch_size"]
+            song.update(
+                inference_wall_s=round(inference_timings["wall_s"] / batch_size, 4),
+                inference_cpu_s=round(inference_timings["cpu_s"] / batch_size, 4),
+                inference_batch_size=batch_size,
+                inference_pid=inference_timings["worker_pid"],
+            )
+        self.write("song", **song, **fields)
+
+    def close(self, **fields):
+        """Writes the worker and run records, and closes the report"""
+        if self.file is None:
+            return
+        for pid, worker in self.workers.items():
+            self.write("worker", pid=pid, **worker)
+        self.write(
+            "run",
+            run_id=self.run_id,
+            wall_s=round(time.perf_counter() - self.start, 3),
+            main_cpu_s=round(time.process_time() - self.cpu_start, 3),
+            main_peak_rss_mb=peak_rss_mb(),
+            max_worker_peak_rss_mb=max(
+                (worker["peak_rss_mb"] for worker in self.workers.values() if worker["peak_rss_mb"] is not None),
+                default=None,
+            ),
+            **fields,
+        )
+        self.file.close()
+        self.file = None
+        logger.info(f"Run report written to {self.path}")
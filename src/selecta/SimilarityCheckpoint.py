@@ -0,0 +1,57 @@
+import json
+import time
+import hashlib
+
+from pathlib import Path
+
+from selecta.logger import generate_logger
+from selecta.utils import atomic_write
+
+logger = generate_logger()
+
+DEFAULT_CHECKPOINT_INTERVAL_S = 30.0
+
+
+class SimilarityCheckpoint:
+    """
+    Records how far a similarity computation got, so that a run which crashed or was cancelled can resume from there.
+
+    The partial results themselves are kept by the caller (the uncommitted temporary file of a dense matrix, or a copy
+    of a neighbour graph); the checkpoint holds the number of song pairs they cover, as counted by
+    `SimilarityEngine.iter_pairs`, along with a fingerprint of the computation. A checkpoint is only resumed by a
+    computation with the same fingerprint, i.e. the same songs, settings and tile order.
+    """
+
+    def __init__(self, path: Path, interval_s: float = DEFAULT_CHECKPOINT_INTERVAL_S):
+        self.path = Path(path)
+        self.interval_s = interval_s
+        self.last_saved = time.monotonic()
+
+    @staticmethod
+    def fingerprint(**fields) -> str:
+        """Hash identifying a computation, from everything that determines its results and the order of its tiles"""
+        return hashlib.blake2b(json.dumps(fields, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+    def load(self, fingerprint: str) -> int:
+        """Number of pairs already computed by an interrupted computation with this fingerprint, or 0"""
+        try:
+            with open(self.path) as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return 0
+        if checkpoint.get("fingerprint") != fingerprint:
+            return 0
+        logger.info(f"Resuming similarity computation after {checkpoint['pairs_done']} pairs")
+        return checkpoint["pairs_done"]
+
+    def due(self) -> bool:
+        return time.monotonic() - self.last_saved >= self.interval_s
+
+    def save(self, fingerprint: str, pairs_done: int):
+        """Records progress. The partial results must already be on disk when this is called"""
+        with atomic_write(self.path, "w") as f:
+            json.dump({"fingerprint": fingerprint, "pairs_done": pairs_done}, f)
+        self.last_saved = time.monotonic()
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
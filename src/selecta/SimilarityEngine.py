@@ -0,0 +1,464 @@
+import time
+import numpy as np
+
+from functools import reduce
+
+from selecta.logger import generate_logger
+
+logger = generate_logger()
+
+DEFAULT_MEMORY_BUDGET_MB = 512
+# Product quantisation lookups are gathered this many columns of a tile at a time, into a small reused buffer
+LOOKUP_COLUMNS = 256
+PRECISIONS = ("float32", "exact")
+# How the distances between the segments of two songs are reduced to one distance between the songs
+AGGREGATIONS = {
+    "median": "median distance over every pair of segments of the two songs",
+    "quantile": "lower median of the segment distances, a single partition per pair which is exact for odd counts",
+    "best_match": "mean distance from each segment to the closest segment of the other song, both ways",
+    "mean_embedding": "distance between the songs' mean segments, a single matrix product for the whole library",
+}
+
+
+class SegmentLayout:
+    """
+    Stacks the segments of a set of songs so that each song is a contiguous slice.
+
+    Songs are ordered by their number of segments, so that every run of songs with the same segment count is also a
+    contiguous slice. Songs without embeddings are left out.
+    """
+
+    def __init__(self, embeddings: list):
+        self.segment_counts = np.array([0 if e is None else e.shape[0] for e in embeddings], dtype=np.int64)
+        analysed = np.flatnonzero(self.segment_counts > 0)
+        # Song indices sorted by segment count (stable, so ties keep their original order)
+        self.order = analysed[np.argsort(self.segment_counts[analysed], kind="stable")]
+        self.offsets = np.concatenate([[0], np.cumsum(self.segment_counts[self.order])])
+
+        if len(self.order):
+            self.segments = np.vstack([embeddings[i] for i in self.order])
+        else:
+            self.segments = np.empty((0, 0))
+
+        # Runs of songs sharing a segment count, as (segment_count, start, stop) positions into self.order
+        sorted_counts = self.segment_counts[self.order]
+        boundaries = np.flatnonzero(np.diff(sorted_counts)) + 1
+        starts = np.concatenate([[0], boundaries]).astype(np.int64)
+        stops = np.concatenate([boundaries, [len(self.order)]]).astype(np.int64)
+        self.groups = [
+            (int(sorted_counts[start]), int(start), int(stop)) for start, stop in zip(starts, stops) if start < stop
+        ]
+
+    def __len__(self):
+        return len(self.order)
+
+
+class SimilarityEngine:
+    """
+    Computes the song-to-song similarity matrix from collapsed segment embeddings.
+
+    The similarity between two songs is the median of the cosine distances between every segment of one song and
+    every segment of the other. Segments are stacked with a `SegmentLayout`, so a block covering many song pairs can be
+    reshaped into one row per pair and reduced with a single vectorised `np.median` call instead of one Python
+    iteration per pair.
+
+    The segment distance matrix is never materialised: distances are computed one tile at a time, with tiles aligned
+    to song boundaries and sized to fit the memory budget, and each tile is reduced to song-pair medians straight
+    away. In the default "float32" precision embeddings are normalised once up front and each tile is a single float32
+    matrix product; "exact" precision computes each tile with float64 `cdist` and matches the reference implementation
+    bit for bit.
+
+    The median is the reference measure, and `AGGREGATIONS` lists the alternatives. "mean_embedding" averages each
+    song's segments when the layout is built, so every song has one segment and the whole computation is one tiled
+    matrix product with nothing to reduce.
+
+    Embeddings read from a compressed store are decoded with its `EmbeddingCodec` when the layout is built, so projected
+    embeddings are compared in their fewer dimensions. Product-quantised embeddings are not decoded along the columns
+    in "float32" precision: each row chunk is turned into per-subvector lookup tables, and a tile of distances is the
+    sum of one table lookup per subvector of each column segment (asymmetric distance computation).
+    """
+
+    def __init__(
+        self,
+        embeddings: list,
+        memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB,
+        precision: str = "float32",
+        codec=None,
+        aggregation: str = "median",
+    ):
+        """
+        Args:
+            embeddings (list): One (n_segments, n_features) array per song, or None for songs which could not be
+                               analysed. The position in the list is the song's index in the similarity matrix.
+            memory_budget_mb (float): Approximate memory allowed for a distance tile and its median workspace.
+            precision (str): "float32" for normalised float32 matrix products, or "exact" for float64 `cdist`.
+            codec (EmbeddingCodec): Codec the embeddings are encoded with, if they come from a compressed store.
+            aggregation (str): How segment distances are reduced to song distances, one of AGGREGATIONS.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation {aggregation!r}, expected one of {list(AGGREGATIONS)}")
+
+        self.n_songs = len(embeddings)
+        self.embeddings = embeddings
+        self.precision = precision
+        self.codec = codec
+        self.aggregation = aggregation
+        # Whether columns stay as product quantisation codes, compared through lookup tables. Mean embeddings can
+        # only be taken of decoded segments
+        self.asymmetric = (
+            codec is not None and codec.quantised and precision == "float32" and aggregation != "mean_embedding"
+        )
+        self.aggregate_block = {
+            "median": self.block_medians,
+            "quantile": self.block_lower_medians,
+            "best_match": self.block_best_matches,
+            "mean_embedding": self.block_single_distances,
+        }[aggregation]
+        self.dtype = np.float64 if precision == "exact" else np.float32
+        # Each distance in a tile is held twice: once in the tile and once in the median's partition workspace
+        self.max_tile_size = max(1, int(memory_budget_mb * 2**20) // (2 * np.dtype(self.dtype).itemsize))
+        # The lookup tables of a row chunk come out of the same budget. Each row segment has a float32 table entry per
+        # centroid of every subvector, held once, so it takes the room of half as many tile distances
+        self.table_size_per_row = codec.codebooks.shape[0] * codec.codebooks.shape[1] // 2 if self.asymmetric else 0
+        self.layout = self.build_layout(embeddings)
+        # Time spent computing segment distances and reducing them to medians, for run reports
+        self.stage_seconds = {"distances": 0.0, "medians": 0.0}
+
+    def build_layout(self, embeddings: list) -> SegmentLayout:
+        if self.aggregation == "mean_embedding":
+            embeddings = [None if e is None else np.mean(self.decode(e), axis=0, keepdims=True) for e in embeddings]
+            layout = SegmentLayout(embeddings)
+        else:
+            layout = SegmentLayout(embeddings)
+            if self.asymmetric or not len(layout):
+                return layout
+            layout.segments = self.decode(layout.segments)
+        if self.precision == "float32" and len(layout):
+            layout.segments = self.normalise(layout.segments)
+        return layout
+
+    def decode(self, segments: np.ndarray) -> np.ndarray:
+        return segments if self.codec is None else self.codec.decode(segments)
+
+    @staticmethod
+    def normalise(segments: np.ndarray) -> np.ndarray:
+        """Scales every segment to unit length as float32; all-zero segments become NaN, as they do in `cdist`"""
+        segments = np.asarray(segments, dtype=np.float32)
+        norms = np.linalg.norm(segments, axis=1, keepdims=True)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(norms > 0, segments / norms, np.nan).astype(np.float32)
+
+    def prepare_rows(self, rows: np.ndarray) -> np.ndarray:
+        """Turns a chunk of row segments into what `tile_distances` takes, once for every tile along the chunk"""
+        if self.asymmetric:
+            return self.codec.distance_tables(self.normalise(self.codec.decode(rows)))
+        return rows
+
+    def tile_distances(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """Cosine distances between two runs of segments"""
+        if self.asymmetric:
+            # Rows are lookup tables from `prepare_rows` and columns are codes. Lookups are gathered into a buffer a few
+            # columns at a time and accumulated in place, so no temporary the size of the tile is allocated
+            distances = np.zeros((rows.shape[1], len(cols)), dtype=np.float32)
+            lookups = np.empty((rows.shape[1], min(LOOKUP_COLUMNS, len(cols))), dtype=np.float32)
+            for start in range(0, len(cols), LOOKUP_COLUMNS):
+                block = distances[:, start : start + LOOKUP_COLUMNS]
+                block_lookups = lookups[:, : block.shape[1]]
+                for m, table in enumerate(rows):
+                    np.take(table, cols[start : start + LOOKUP_COLUMNS, m], axis=1, out=block_lookups, mode="clip")
+                    np.add(block, block_lookups, out=block)
+            distances /= self.codec.code_norms(cols)
+            np.subtract(1.0, distances, out=distances)
+            return distances
+        if self.precision == "exact":
+            # Imported here, as scipy.spatial is slow to import and only the exact precision needs it
+            from scipy.spatial.distance import cdist
+
+            return cdist(rows, cols, metric="cosine")
+        distances = rows @ cols.T
+        np.subtract(1.0, distances, out=distances)
+        return distances
+
+    @staticmethod
+    def block_medians(distances: np.ndarray, row_group: tuple, col_group: tuple) -> np.ndarray:
+        """
+        Reduces the distance block between two groups of songs to the median distance of every song pair.
+
+        Args:
+            distances (np.ndarray): Segment distance block with the row group's segments as rows and the column
+                                    group's segments as columns.
+            row_group (tuple): (segment_count, n_songs) of the songs along the rows.
+            col_group (tuple): (segment_count, n_songs) of the songs along the columns.
+
+        Returns:
+            np.ndarray: An (n_row_songs, n_col_songs) array of median distances.
+        """
+        return np.median(SimilarityEngine.pair_blocks(distances, row_group, col_group), axis=-1)
+
+    @staticmethod
+    def pair_blocks(distances: np.ndarray, row_group: tuple, col_group: tuple) -> np.ndarray:
+        """The distance block between two groups of songs as one row of segment distances per song pair"""
+        row_segments, n_rows = row_group
+        col_segments, n_cols = col_group
+        pair_blocks = distances.reshape(n_rows, row_segments, n_cols, col_segments).transpose(0, 2, 1, 3)
+        return pair_blocks.reshape(n_rows, n_cols, row_segments * col_segments)
+
+    @staticmethod
+    def block_lower_medians(distances: np.ndarray, row_group: tuple, col_group: tuple) -> np.ndarray:
+        """Like `block_medians`, but takes the lower of the two middle distances of song pairs with an even count"""
+        pair_blocks = SimilarityEngine.pair_blocks(distances, row_group, col_group)
+        middle = (pair_blocks.shape[-1] - 1) // 2
+        return np.partition(pair_blocks, middle, axis=-1)[..., middle]
+
+    @staticmethod
+    def block_best_matches(distances: np.ndarray, row_group: tuple, col_group: tuple) -> np.ndarray:
+        """
+        Reduces a distance block to the mean distance from each segment to its closest segment in the other song.
+
+        Both directions are averaged, so the measure is symmetric like the median.
+        """
+        row_segments, n_rows = row_group
+        col_segments, n_cols = col_group
+        blocks = distances.reshape(n_rows, row_segments, n_cols, col_segments)
+        # Songs have few segments, and reducing over them one slice at a time is much faster than along short strided
+        # axes. (n_rows, row_segments, n_cols) closest column segments, and (n_rows, n_cols, col_segments) closest rows
+        row_matches = reduce(np.minimum, [blocks[:, :, :, j] for j in range(col_segments)])
+        col_matches = reduce(np.minimum, [blocks[:, i] for i in range(row_segments)])
+        row_means = sum(row_matches[:, i] for i in range(row_segments)) / row_segments
+        col_means = sum(col_matches[:, :, j] for j in range(col_segments)) / col_segments
+        return (row_means + col_means) / 2
+
+    @staticmethod
+    def block_single_distances(distances: np.ndarray, row_group: tuple, col_group: tuple) -> np.ndarray:
+        """Reduces a distance block between songs of one segment each, which already holds the song distances"""
+        return distances.reshape(row_group[1], col_group[1])
+
+    def iter_tiles(
+        self, row_layout: SegmentLayout, col_layout: SegmentLayout, triangular: bool = False, skip_pairs: int = 0
+    ):
+        """
+        Computes song-pair distances (medians by default, see AGGREGATIONS) one memory-bounded tile at a time.
+
+        Args:
+            row_layout (SegmentLayout): Songs along the rows.
+            col_layout (SegmentLayout): Songs along the columns.
+            triangular (bool): When both layouts are the same, only compute tiles on or above the diagonal (in
+                               sorted order), since the matrix is symmetric.
+            skip_pairs (int): Leading tiles covering this many distinct pairs are skipped without being computed,
+                              to resume an interrupted computation. Tiles are always visited in the same order.
+
+        Yields:
+            tuple: (row_songs, col_songs, medians, diagonal) for every tile, with song indices referring to the
+                   embeddings each layout was built from. Diagonal tiles are square, cover the same songs along both
+                   axes and so already hold both orientations of every pair.
+        """
+        # Roughly square tiles: each row chunk spans about sqrt(max_tile_size) segments
+        rows_segments_per_chunk = max(1, int(np.sqrt(self.max_tile_size)))
+        if self.table_size_per_row:
+            # Keep a row chunk's lookup tables to at most half of the budget
+            rows_segments_per_chunk = min(
+                rows_segments_per_chunk, max(1, self.max_tile_size // (2 * self.table_size_per_row))
+            )
+
+        for row_segments, row_start, row_stop in row_layout.groups:
+            rows_per_chunk = max(1, rows_segments_per_chunk // row_segments)
+
+            for chunk_start in range(row_start, row_stop, rows_per_chunk):
+                chunk_stop = min(chunk_start + rows_per_chunk, row_stop)
+                row_songs = row_layout.order[chunk_start:chunk_stop]
+                rows = row_layout.segments[row_layout.offsets[chunk_start] : row_layout.offsets[chunk_stop]]
+                row_data = self.prepare_rows(rows)
+
+                for col_segments, col_group_start, col_group_stop in col_layout.groups:
+                    tile_size = self.max_tile_size - len(rows) * self.table_size_per_row
+                    cols_per_tile = max(1, tile_size // (len(rows) * col_segments))
+                    if not triangular:
+                        col_ranges = [(col_group_start, col_group_stop, cols_per_tile)]
+                    elif col_group_stop <= chunk_start:
+                        continue
+                    elif col_group_start == row_start:
+                        # A single square tile on the diagonal, then the rest of the row chunk's own group
+                        col_ranges = [
+                            (chunk_start, chunk_stop, chunk_stop - chunk_start),
+                            (chunk_stop, col_group_stop, cols_per_tile),
+                        ]
+                    else:
+                        col_ranges = [(col_group_start, col_group_stop, cols_per_tile)]
+
+                    for range_start, range_stop, range_cols_per_tile in col_ranges:
+                        for col_start in range(range_start, range_stop, range_cols_per_tile):
+                            col_stop = min(col_start + range_cols_per_tile, range_stop)
+                            col_songs = col_layout.order[col_start:col_stop]
+                            diagonal = triangular and col_start == chunk_start
+                            if skip_pairs > 0:
+                                n_rows = len(row_songs)
+                                skip_pairs -= n_rows * (n_rows - 1) // 2 if diagonal else n_rows * len(col_songs)
+                                continue
+                            cols = col_layout.segments[col_layout.offsets[col_start] : col_layout.offsets[col_stop]]
+
+                            start = time.perf_counter()
+                            distances = self.tile_distances(row_data, cols)
+                            distances_done = time.perf_counter()
+                            medians = self.aggregate_block(
+                                distances,
+                                row_group=(row_segments, len(row_songs)),
+                                col_group=(col_segments, len(col_songs)),
+                            )
+                            del distances
+                            self.stage_seconds["distances"] += distances_done - start
+                            self.stage_seconds["medians"] += time.perf_counter() - distances_done
+                            yield row_songs, col_songs, medians, diagonal
+
+    def count_pairs(self, songs=None) -> int:
+        """Number of distinct song pairs `iter_pairs` computes for the same arguments"""
+        n_analysed = len(self.layout)
+        if songs is None:
+            return n_analysed * (n_analysed - 1) // 2
+        n_new = int(np.count_nonzero(self.layout.segment_counts[np.asarray(songs, dtype=np.int64)] > 0))
+        return n_new * (n_analysed - n_new) + n_new * (n_new - 1) // 2
+
+    def iter_pairs(self, songs: list = None, progress_callback=None, start_pairs: int = 0, should_stop=None):
+        """
+        Computes song-pair medians for the whole library, or for the pairs involving a subset of songs.
+
+        Every ordered pair of distinct songs is yielded exactly once (tiles may also include each song paired with
+        itself, which consumers should ignore), so consumers can fill either a dense matrix or a neighbour list
+        without deduplicating.
+
+        Args:
+            songs (list): Optional indices of songs to compute pairs for. When given, only the pairs between these
+                          songs and every song are computed, which is all an incremental update needs.
+            progress_callback (callable): Optional callable taking (pairs_done, pairs_total), counting distinct
+                                          unordered pairs. It is called once every pair of a tile has been yielded,
+                                          in both orientations, so `pairs_done` is always a valid `start_pairs`.
+            start_pairs (int): Resumes a computation with the same embeddings and arguments which was stopped after
+                               `pairs_done` pairs, skipping the tiles it had finished.
+            should_stop (callable): Optional callable checked after each tile, once `progress_callback` has been
+                                    called. When it returns True no further tile is computed.
+
+        Yields:
+            tuple: (row_songs, col_songs, medians) with song indices into the embeddings passed to the constructor.
+        """
+        if songs is None:
+            logger.info(f"Computing pairwise distances between {len(self.layout)} songs...")
+            blocks = [(self.layout, self.layout, True, None, None)]
+        else:
+            logger.info(f"Computing pairwise distances for {len(songs)} new songs...")
+            blocks = self.subset_blocks(np.asarray(songs, dtype=np.int64))
+        yield from self.iter_blocks(blocks, progress_callback, start_pairs, should_stop)
+
+    def iter_group_pairs(self, groups: list, progress_callback=None, start_pairs: int = 0, should_stop=None):
+        """
+        Computes song-pair medians, except for the pairs within each of a set of groups, whose pairs are already known.
+
+        This is what merging separately analysed parts of a library needs, e.g. `AnalysisShard`s which each computed
+        the pairs between their own songs: only the pairs between songs of different groups are computed. Songs in no
+        group are paired with every song, as the new songs of `iter_pairs` are.
+
+        Args:
+            groups (list): Disjoint lists of song indices.
+            progress_callback (callable): As for `iter_pairs`.
+            start_pairs (int): As for `iter_pairs`, for a computation with the same groups.
+            should_stop (callable): As for `iter_pairs`.
+
+        Yields:
+            tuple: (row_songs, col_songs, medians) with song indices into the embeddings passed to the constructor.
+        """
+        groups = [np.asarray(group, dtype=np.int64) for group in groups if len(group)]
+        grouped = np.concatenate(groups) if groups else np.empty(0, dtype=np.int64)
+        ungrouped = np.setdiff1d(np.arange(self.n_songs), grouped)
+        logger.info(
+            f"Computing pairwise distances between {len(groups)} groups of songs and {len(ungrouped)} other songs..."
+        )
+        layouts = [self.build_layout([self.embeddings[i] for i in group]) for group in groups]
+        blocks = [
+            (layouts[a], layouts[b], False, groups[a], groups[b])
+            for a in range(len(groups))
+            for b in range(a + 1, len(groups))
+        ]
+        if len(ungrouped):
+            blocks += self.subset_blocks(ungrouped)
+        yield from self.iter_blocks(blocks, progress_callback, start_pairs, should_stop)
+
+    def subset_blocks(self, songs: np.ndarray) -> list:
+        """Blocks pairing a subset of songs with every other song and with each other, see `iter_blocks`"""
+        others = np.setdiff1d(np.arange(self.n_songs), songs)
+        new_layout = self.build_layout([self.embeddings[i] for i in songs])
+        other_layout = self.build_layout([self.embeddings[i] for i in others])
+        return [(new_layout, other_layout, False, songs, others), (new_layout, new_layout, True, songs, songs)]
+
+    def iter_blocks(self, blocks: list, progress_callback=None, start_pairs: int = 0, should_stop=None):
+        """
+        Computes the song pairs of a list of blocks, in order, yielding both orientations of every pair.
+
+        Args:
+            blocks (list): (row_layout, col_layout, triangular, row_ids, col_ids) tuples, where the ids map the songs
+                           of each layout to song indices, or are None when the layout is built from every song.
+            progress_callback (callable): As for `iter_pairs`.
+            start_pairs (int): As for `iter_pairs`.
+            should_stop (callable): As for `iter_pairs`.
+        """
+        block_pairs = [
+            len(row_layout) * (len(row_layout) - 1) // 2 if triangular else len(row_layout) * len(col_layout)
+            for row_layout, col_layout, triangular, _, _ in blocks
+        ]
+        pairs_total = sum(block_pairs)
+        if pairs_total == 0:
+            return
+
+        pairs_done = 0
+        for (row_layout, col_layout, triangular, row_ids, col_ids), n_pairs in zip(blocks, block_pairs):
+            skip_pairs = min(max(0, start_pairs - pairs_done), n_pairs)
+            pairs_done += skip_pairs
+            if skip_pairs == n_pairs:
+                continue
+            if skip_pairs and progress_callback:
+                progress_callback(pairs_done, pairs_total)
+            if should_stop is not None and should_stop():
+                return
+
+            for row_songs, col_songs, medians, diagonal in self.iter_tiles(
+                row_layout, col_layout, triangular, skip_pairs=skip_pairs
+            ):
+                if row_ids is not None:
+                    row_songs, col_songs = row_ids[row_songs], col_ids[col_songs]
+                yield row_songs, col_songs, medians
+                if diagonal:
+                    pairs_done += len(row_songs) * (len(row_songs) - 1) // 2
+                else:
+                    yield col_songs, row_songs, medians.T
+                    pairs_done += len(row_songs) * len(col_songs)
+                if progress_callback:
+                    progress_callback(pairs_done, pairs_total)
+                if should_stop is not None and should_stop():
+                    return
+
+    def compute(self, progress_callback=None, songs: list = None, out: np.ndarray = None) -> np.ndarray:
+        """
+        Computes the (n_songs, n_songs) song distance matrix, of median cosine distances by default.
+
+        Songs without embeddings get NaN rows and columns, and the diagonal is NaN.
+
+        Args:
+            progress_callback (callable): Optional callable taking (pairs_done, pairs_total).
+            songs (list): Optional indices of songs to compute rows and columns for. Other entries of `out` are
+                          left untouched, so songs added to a library can be filled into the cached matrix.
+            out (np.ndarray): Optional (n_songs, n_songs) matrix to fill in place.
+
+        Returns:
+            np.ndarray: The symmetric similarity matrix, indexed like the embeddings passed to the constructor.
+        """
+        if out is None:
+            out = np.full((self.n_songs, self.n_songs), np.nan)
+        if songs is not None:
+            # Pairs involving songs without embeddings are never yielded, so clear any stale values first
+            out[songs, :] = np.nan
+            out[:, songs] = np.nan
+
+        for row_songs, col_songs, medians in self.iter_pairs(songs=songs, progress_callback=progress_callback):
+            out[np.ix_(row_songs, col_songs)] = medians
+
+        np.fill_diagonal(out, np.nan)
+        return out
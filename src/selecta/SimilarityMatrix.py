@@ -0,0 +1,274 @@
+import os
+import json
+import numpy as np
+
+from pathlib import Path
+
+from selecta.logger import generate_logger
+from selecta.utils import atomic_write
+from selecta.TombstoneLog import (
+    TombstoneLog,
+    INITIAL_GENERATION,
+    new_generation,
+    generation_path,
+    remove_other_generations,
+)
+
+logger = generate_logger()
+
+ROWS_PER_COPY = 1024
+# Room left at the end of each row of a new matrix, as a fraction of its songs (and at least MIN_SPARE_COLUMNS), so that
+# songs added later are written in place with `grow` rather than by rewriting the matrix
+SPARE_COLUMNS = 0.25
+MIN_SPARE_COLUMNS = 64
+
+
+class SimilarityMatrix:
+    """
+    Dense song-to-song similarity matrix persisted as a packed float32 file.
+
+    The matrix lives in a few files:
+        similarity_matrix.json          a small header with the song keys, in row order, the matrix's generation, its
+                                        row stride and how its song distances were aggregated (see `SimilarityEngine`)
+        similarity_matrix.<gen>.f32     the (n, n) matrix as raw row-major float32, with each row padded to the stride
+        similarity_matrix.<gen>.tombstones  the songs deleted since the matrix was written (see `TombstoneLog`)
+
+    Only the header is read up front. Rows are read through a memory map on demand, so looking up one song's
+    similarities costs O(n) regardless of how large the file is, and neither memory use nor startup time depend on the
+    size of the library.
+
+    New matrices are written with `allocate`, filled through the writable memory map in `data`, and made visible with
+    `commit` under a new generation. The header names the generation, so replacing it is the one step which switches
+    to the new matrix, and a crash at any point leaves either the old matrix or the new one.
+
+    Songs added to a library are written into the committed file instead with `grow`, while its rows have room for
+    them: their rows are appended past the last one and their columns fill the padding of every row, so only their own
+    entries are written. Neither is part of the committed matrix until the header listing the new songs is written.
+
+    Deleting songs only logs them: `keys` and `len` still cover every row of the file, while `in`, `live_keys` and
+    lookups skip deleted songs. Once enough are deleted, `compact` rewrites the matrix without them.
+    """
+
+    dtype = np.float32
+
+    def __init__(self, path: Path, keys: list = None, aggregation: str = "median"):
+        self.path = Path(path)
+        self.header_path = self.path.with_suffix(".json")
+        self.tmp_path = self.path.with_suffix(".f32.tmp")
+        self.data = None
+        # Number of songs the matrix held before `grow` added some, or None if its whole file is newly written
+        self.grown_from = None
+        if keys is None:
+            self.generation, keys, self.stride, aggregation = self.read_header()
+        else:
+            # The generation the matrix will be committed under
+            self.generation = new_generation()
+            self.stride = self.padded_stride(len(keys))
+        self.aggregation = aggregation
+        self.keys = list(keys)
+        self.key_to_index = {key: i for i, key in enumerate(self.keys)}
+        self.tombstones = TombstoneLog(generation_path(self.path, self.generation, ".tombstones"), self.generation)
+
+    @property
+    def data_path(self) -> Path:
+        return generation_path(self.path, self.generation)
+
+    @staticmethod
+    def padded_stride(n: int) -> int:
+        return n + max(int(n * SPARE_COLUMNS), MIN_SPARE_COLUMNS)
+
+    def read_header(self) -> tuple:
+        try:
+            with open(self.header_path) as f:
+                header = json.load(f)
+        except FileNotFoundError:
+            return INITIAL_GENERATION, [], 0, "median"
+        generation = header.get("generation", INITIAL_GENERATION)
+        n = len(header["keys"])
+        # Matrices written before rows were padded have none
+        stride = header.get("stride", n)
+        # A matrix file too short for its header (e.g. one removed by hand) is treated as missing. It may be longer,
+        # after songs were added by a `grow` which never committed
+        data_path = generation_path(self.path, generation)
+        expected_size = n * stride * np.dtype(self.dtype).itemsize
+        if not data_path.exists() or data_path.stat().st_size < expected_size:
+            return INITIAL_GENERATION, [], 0, "median"
+        # Matrices written before aggregations were selectable hold medians
+        return generation, header["keys"], stride, header.get("aggregation", "median")
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.key_to_index and key not in self.tombstones
+
+    @property
+    def empty(self) -> bool:
+        return len(self.keys) == 0
+
+    @property
+    def live_keys(self) -> list:
+        """Keys of the songs which haven't been deleted, in row order"""
+        return [key for key in self.keys if key not in self.tombstones]
+
+    @property
+    def deleted_indices(self) -> np.ndarray:
+        """Rows (and columns) of the deleted songs"""
+        return np.array(sorted(self.key_to_index[key] for key in self.tombstones), dtype=np.int64)
+
+    @property
+    def needs_compaction(self) -> bool:
+        return self.tombstones.needs_compaction(len(self.keys))
+
+    def memmap(self) -> np.ndarray:
+        """Read-only memory map of the committed matrix, including the rows of deleted songs"""
+        if self.empty:
+            return np.empty((0, 0), dtype=self.dtype)
+        n = len(self.keys)
+        return np.memmap(self.data_path, dtype=self.dtype, mode="r", shape=(n, self.stride))[:, :n]
+
+    def row(self, key: str) -> np.ndarray:
+        # Copy the row out so that the file isn't kept mapped
+        return np.array(self.memmap()[self.key_to_index[key]])
+
+    def nearest(self, key: str, n: int) -> list:
+        """
+        Returns the keys of the n songs nearest to a song, closest first.
+
+        Args:
+            key (str): Key of the song.
+            n (int): Number of songs wanted.
+
+        Returns:
+            list: Song keys, excluding the song itself.
+        """
+        row_index = self.key_to_index[key]
+        # NaN distances (songs that could not be analysed) sort last
+        order = np.argsort(self.row(key), kind="stable")
+        order = order[(order != row_index) & ~np.isin(order, self.deleted_indices)][:n]
+        return [self.keys[i] for i in order]
+
+    @classmethod
+    def allocate(cls, path: Path, keys: list, tmp_path: Path = None, aggregation: str = "median"):
+        """Creates a new NaN-filled matrix backed by a temporary file, to be filled through `data` and committed"""
+        matrix = cls(path, keys=keys, aggregation=aggregation)
+        if tmp_path is not None:
+            matrix.tmp_path = Path(tmp_path)
+        matrix.path.parent.mkdir(parents=True, exist_ok=True)
+        n = len(keys)
+        # np.memmap can't map an empty file, so an empty matrix gets a one-row file which `read_header` ignores
+        matrix.data = np.memmap(matrix.tmp_path, dtype=cls.dtype, mode="w+", shape=(max(n, 1), matrix.stride))[:n, :n]
+        for start in range(0, n, ROWS_PER_COPY):
+            matrix.data[start : start + ROWS_PER_COPY] = np.nan
+        return matrix
+
+    @classmethod
+    def reopen_allocated(cls, path: Path, keys: list, aggregation: str = "median"):
+        """
+        Reopens the temporary file of a matrix allocated earlier and never committed, e.g. by an interrupted run.
+
+        Returns:
+            SimilarityMatrix or None: The partly filled matrix, or None if there is no temporary file of its size.
+        """
+        matrix = cls(path, keys=keys, aggregation=aggregation)
+        n = len(keys)
+        expected_size = max(n, 1) * matrix.stride * np.dtype(cls.dtype).itemsize
+        if not matrix.tmp_path.exists() or matrix.tmp_path.stat().st_size != expected_size:
+            return None
+        matrix.data = np.memmap(matrix.tmp_path, dtype=cls.dtype, mode="r+", shape=(max(n, 1), matrix.stride))[:n, :n]
+        return matrix
+
+    def grow(self, keys: list, reset: bool = True):
+        """
+        Adds songs to the committed matrix in place, if its rows have room for them.
+
+        The new songs' rows are appended to the file and their columns fill the padding of each row, so the entries
+        already there are neither copied nor changed, and the matrix can still be read meanwhile. The songs are only
+        added once the returned matrix is committed, which just replaces the header.
+
+        Args:
+            keys (list): Keys of the songs to add, none of which may have a row already, deleted or not.
+            reset (bool): Fill the new songs' entries with NaN. False keeps those written by an interrupted `grow`
+                          of the same songs, to resume filling them.
+
+        Returns:
+            SimilarityMatrix or None: The grown matrix, to be filled through `data` and committed, or None if the
+                                      songs don't fit or the file can't be grown.
+        """
+        n_old, n = len(self.keys), len(self.keys) + len(keys)
+        if self.empty or n > self.stride or any(key in self.key_to_index for key in keys):
+            return None
+        grown = SimilarityMatrix(self.path, keys=self.keys + list(keys), aggregation=self.aggregation)
+        grown.generation, grown.stride, grown.grown_from = self.generation, self.stride, n_old
+        grown.tombstones = self.tombstones
+        try:
+            # Mapping past the end of the file extends it
+            grown.data = np.memmap(self.data_path, dtype=self.dtype, mode="r+", shape=(n, self.stride))[:, :n]
+        except OSError as e:
+            # e.g. on Windows, while another process still has the file mapped
+            logger.warning(f"Could not grow the similarity matrix in place, rewriting it instead: {e}")
+            return None
+        if reset:
+            for start in range(0, n, ROWS_PER_COPY):
+                rows = grown.data[start : start + ROWS_PER_COPY]
+                rows[:, n_old:] = np.nan
+                rows[max(n_old - start, 0) :, :n_old] = np.nan
+        return grown
+
+    def copy_from(self, other):
+        """Copies every entry of another matrix whose songs are also in this one"""
+        positions = np.array([self.key_to_index.get(key, -1) for key in other.keys], dtype=np.int64)
+        kept = np.flatnonzero(positions >= 0)
+        if len(kept) == 0:
+            return
+        source = other.memmap()
+        for start in range(0, len(kept), ROWS_PER_COPY):
+            rows = kept[start : start + ROWS_PER_COPY]
+            self.data[np.ix_(positions[rows], positions[kept])] = source[rows][:, kept]
+
+    def commit(self, keep_old_generations: bool = False):
+        """
+        Flushes a freshly allocated or grown matrix and atomically makes it the committed one.
+
+        Args:
+            keep_old_generations (bool): Leave the files of the previous matrix in place, for readers which still have
+                                         it open, until `remove_old_generations` is called.
+        """
+        self.data.flush()
+        self.data = None
+        if self.grown_from is None:
+            os.replace(self.tmp_path, self.data_path)
+        with atomic_write(self.header_path, "w") as f:
+            header = {"keys": self.keys, "generation": self.generation, "stride": self.stride}
+            json.dump({**header, "aggregation": self.aggregation}, f)
+        if not keep_old_generations:
+            self.remove_old_generations()
+
+    def remove_old_generations(self):
+        """Removes the files of every matrix committed before this one"""
+        remove_other_generations(self.path, self.generation, [self.path.suffix, ".tombstones"])
+
+    def delete(self, keys: list):
+        """Logs songs as deleted, leaving the matrix file untouched"""
+        self.tombstones.add([key for key in keys if key in self.key_to_index])
+
+    def compact(self, keep_old_generations: bool = False):
+        """
+        Writes a copy of the matrix without its deleted songs and commits it in place of this one.
+
+        This matrix isn't changed, so it can still be read while the copy is written, e.g. from another thread. With
+        `keep_old_generations` it also stays readable afterwards, until the copy's `remove_old_generations` is called.
+
+        Returns:
+            SimilarityMatrix: The compacted matrix.
+        """
+        # Written beside the temporary file of `allocate`, which may hold the checkpoint of an interrupted analysis
+        compacted = self.allocate(
+            self.path,
+            self.live_keys,
+            tmp_path=self.path.with_suffix(".f32.compacting"),
+            aggregation=self.aggregation,
+        )
+        compacted.copy_from(self)
+        compacted.commit(keep_old_generations)
+        return compacted
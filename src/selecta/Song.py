@@ -1,23 +1,59 @@
-import librosa
 import numpy as np
 
 from pathlib import Path
 
 from selecta.logger import generate_logger
-from selecta.yamnet_model import yamnet_model
 
 logger = generate_logger()
 
+# Resampler used to bring audio down to YAMNet's 16kHz for each decode mode. "fast" trades a little accuracy for a
+# much cheaper resampling filter; benchmarks/decode_drift.py measures the effect on embeddings.
+DECODE_MODES = {"standard": "soxr_hq", "fast": "soxr_lq"}
+
 
 class Song:
     """Class to represent a song"""
 
-    def __init__(self, path: Path):
+    def __init__(self, path: Path, key: str = None):
         self.path = path
         self.name = path.name
+        self.key = key
         self.yamnet_embeddings = None
         self.simplified_yamnet_embeddings = None
 
+    @staticmethod
+    def load_audio(path: Path, decode_mode: str = "standard"):
+        """
+        Loads the first two minutes of an audio file as a 16kHz mono waveform normalised to the range [-1, 1].
+
+        Args:
+            path (str): The file path of the audio file.
+            decode_mode (str): "standard", or "fast" for a cheaper resampler. See `DECODE_MODES`.
+
+        Returns:
+            np.ndarray or None: The waveform, or None if the file could not be loaded.
+        """
+        try:
+            # Imported here rather than with the module, as librosa is slow to import and only decoding needs it
+            import librosa
+
+            # Extract audio
+            audio, sampling_rate = librosa.load(
+                path, sr=16000, mono=True, offset=0, duration=120, res_type=DECODE_MODES[decode_mode]
+            )
+
+            # Normalize to the range [-1, 1], without making a copy of the waveform to take its absolute value
+            max_abs_value = max(float(audio.max()), -float(audio.min()))
+            if max_abs_value == 0:
+                max_abs_value = 1  # Avoid division by zero by setting max_abs_value to 1 where it is 0
+            audio /= max_abs_value
+
+            return audio
+
+        except Exception as e:
+            logger.error(f"Error loading audio file {path}: {e}")
+            return None
+
     def extract_audio_embeddings(self, path: Path):
         """
         Extracts audio embeddings from a given file path using the YamNet model.
@@ -32,24 +68,22 @@ class Song:
             np.ndarray or None: A NumPy array containing the extracted embeddings, or None
                                 if an error occurs during loading or processing.
         """
-        try:
-            # Extract audio
-            audio, sampling_rate = librosa.load(path, sr=16000, mono=True, offset=0, duration=120)
+        audio = self.load_audio(path)
+        if audio is None:
+            return None
 
-            # Normalize to the range [-1, 1]
-            max_abs_value = float(np.max(np.abs(audio), axis=0))
-            if max_abs_value == 0:
-                max_abs_value = 1  # Avoid division by zero by setting max_abs_value to 1 where it is 0
-            audio /= max_abs_value
+        try:
+            # Imported here so that processes which only decode audio never load TensorFlow
+            from selecta.yamnet_model import load_yamnet_model
 
             # Run through YamNet model to extract embeddings
-            outputs_dict = yamnet_model(audio)
+            outputs_dict = load_yamnet_model()(audio)
             yamnet_embeddings = outputs_dict["output_1"].numpy()
 
             return yamnet_embeddings
 
         except Exception as e:
-            logger.error(f"Error loading or processing audio file {path}: {e}")
+            logger.error(f"Error processing audio file {path}: {e}")
             return None
 
     @staticmethod
@@ -94,8 +128,16 @@ class Song:
         return collapsed_matrix
 
     @classmethod
-    def from_path(cls, path: Path):
-        song = cls(path=path)
+    def from_path(cls, path: Path, key: str = None):
+        song = cls(path=path, key=key)
         song.yamnet_embeddings = song.extract_audio_embeddings(song.path)
         song.simplified_yamnet_embeddings = song.collapse_matrix(song.yamnet_embeddings)
         return song
+
+    @classmethod
+    def from_embeddings(cls, path: Path, yamnet_embeddings: np.ndarray, key: str = None):
+        """Builds a song from embeddings extracted elsewhere, e.g. as part of a batch"""
+        song = cls(path=path, key=key)
+        song.yamnet_embeddings = yamnet_embeddings
+        song.simplified_yamnet_embeddings = song.collapse_matrix(yamnet_embeddings)
+        return song
@@ -1,140 +1,698 @@
-import pickle
+import os
+import time
+import threading
 import numpy as np
-import pandas as pd
-import multiprocessing
 
-from scipy.spatial.distance import cdist
 from tqdm import tqdm
 from pathlib import Path
 
 from selecta.logger import generate_logger
-from selecta.Song import Song
-from selecta.utils import local_app_data_dir, get_similarity_matrix_cache, get_songs_cache
+from selecta.ProgressBus import ProgressBus
+from selecta.RunReport import RunReport
+from selecta.NeighbourGraph import NeighbourGraph, DEFAULT_NEIGHBOURS
+from selecta.SimilarityMatrix import SimilarityMatrix, ROWS_PER_COPY
+from selecta.SimilarityEngine import SimilarityEngine, DEFAULT_MEMORY_BUDGET_MB, AGGREGATIONS
+from selecta.SimilarityCheckpoint import SimilarityCheckpoint, DEFAULT_CHECKPOINT_INTERVAL_S
+from selecta.AnalysisPipeline import AnalysisPipeline
+from selecta.AnalysisShard import AnalysisShard
+from selecta.EmbeddingCodec import COMPRESSION_MODES, DEFAULT_PCA_DIMS
+from selecta.Song import DECODE_MODES
+from selecta.YamnetInference import DEFAULT_INFERENCE_BATCH_SIZE
+from selecta.utils import (
+    local_app_data_dir,
+    get_similarity_matrix_cache,
+    get_embedding_store,
+    get_neighbour_graph_cache,
+    get_content_key_index,
+)
 
 logger = generate_logger()
 
-
-def process_song(song_path):
-    return Song.from_path(song_path)
+SIMILARITY_STORAGE_MODES = ("dense", "topk")
+# Analysed songs are added to the embedding store in batches of this many, so that a stopped run loses little work
+STORE_BATCH_SONGS = 32
 
 
 class SongProcessorDesktop:
-    def __init__(self, local_song_paths: list[Path]):
+    def __init__(
+        self,
+        local_song_paths: list[Path],
+        memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB,
+        similarity_precision: str = "float32",
+        incremental: bool = True,
+        similarity_storage: str = "dense",
+        neighbours_k: int = DEFAULT_NEIGHBOURS,
+        n_workers: int = None,
+        n_inference_workers: int = None,
+        inference_batch_size: int = DEFAULT_INFERENCE_BATCH_SIZE,
+        max_buffered_songs: int = None,
+        decode_mode: str = "standard",
+        progress: ProgressBus = None,
+        profile_songs: int = 0,
+        cancel_event: threading.Event = None,
+        checkpoint_interval_s: float = DEFAULT_CHECKPOINT_INTERVAL_S,
+        embedding_compression: str = None,
+        pca_dims: int = DEFAULT_PCA_DIMS,
+        similarity_aggregation: str = None,
+        shard: AnalysisShard = None,
+        merged_shards: list = None,
+    ):
+        if decode_mode not in DECODE_MODES:
+            raise ValueError(f"Unknown decode mode {decode_mode!r}, expected one of {tuple(DECODE_MODES)}")
+        if embedding_compression is not None and embedding_compression not in COMPRESSION_MODES:
+            raise ValueError(
+                f"Unknown embedding compression {embedding_compression!r}, expected one of {list(COMPRESSION_MODES)}"
+            )
+        if similarity_aggregation is not None and similarity_aggregation not in AGGREGATIONS:
+            raise ValueError(
+                f"Unknown similarity aggregation {similarity_aggregation!r}, expected one of {list(AGGREGATIONS)}"
+            )
+        if similarity_storage not in SIMILARITY_STORAGE_MODES:
+            raise ValueError(
+                f"Unknown similarity storage {similarity_storage!r}, expected one of {SIMILARITY_STORAGE_MODES}"
+            )
+        if shard is not None and merged_shards:
+            raise ValueError("A run either analyses a shard or merges shards, not both")
+        if shard is not None and (similarity_storage != "dense" or embedding_compression is not None):
+            raise ValueError("Shards keep dense, uncompressed data; choose the storage and compression when merging")
+
         self.local_song_paths = local_song_paths
-        self.similarity_matrix = get_similarity_matrix_cache()
-        self.songs_cache, _ = get_songs_cache()
-        self.song_paths_to_process = self.compute_song_paths_to_process()
+        self.memory_budget_mb = memory_budget_mb
+        self.similarity_precision = similarity_precision
+        self.incremental = incremental
+        self.similarity_storage = similarity_storage
+        self.neighbours_k = neighbours_k
+        self.n_workers = n_workers or os.cpu_count() or 1
+        # Decoding is cheaper per song than inference, but each inference worker holds a copy of the model and
+        # TensorFlow spreads each call over several cores, so by default a quarter of the workers run inference
+        self.n_inference_workers = n_inference_workers or max(1, self.n_workers // 4)
+        self.n_decode_workers = max(1, self.n_workers - self.n_inference_workers)
+        self.inference_batch_size = inference_batch_size
+        self.max_buffered_songs = max_buffered_songs
+        self.decode_mode = decode_mode
+        # None keeps the store's current compression, see `EmbeddingStore.compress`
+        self.embedding_compression = embedding_compression
+        self.pca_dims = pca_dims
+        # Analysing a shard writes to its directory rather than the app's cache, see `AnalysisShard`
+        self.shard = shard
+        self.merged_shards = merged_shards or []
+        self.cache_dir = Path(f"{local_app_data_dir}/cache") if shard is None else shard.directory
+        # Subscribe to this to follow the run, see `ProgressBus`
+        self.progress = progress or ProgressBus()
+        # Set this (or call `cancel`) to stop the run. Everything analysed or computed up to then is kept, so that
+        # running again resumes where it stopped
+        self.cancel_event = cancel_event or threading.Event()
+        self.similarity_checkpoint = SimilarityCheckpoint(
+            self.cache_dir / "similarity_checkpoint.json", interval_s=checkpoint_interval_s
+        )
+        self.neighbour_graph_checkpoint_path = self.cache_dir / "neighbour_graph.checkpoint.npz"
+        # Timings for the run are written here, see `RunReport`
+        self.report = RunReport(self.cache_dir / "run_reports", profile_songs=profile_songs)
+        self.report.write(
+            "config",
+            n_songs=len(local_song_paths),
+            n_decode_workers=self.n_decode_workers,
+            n_inference_workers=self.n_inference_workers,
+            inference_batch_size=inference_batch_size,
+            decode_mode=decode_mode,
+            similarity_storage=similarity_storage,
+            similarity_precision=similarity_precision,
+            memory_budget_mb=memory_budget_mb,
+            incremental=incremental,
+            embedding_compression=embedding_compression,
+            similarity_aggregation=similarity_aggregation,
+            shard=None if shard is None else f"{shard.number}/{shard.count}",
+            merged_shards=len(self.merged_shards),
+        )
+        self.similarity_engine = None
+        with self.report.stage("load_caches"):
+            if shard is None:
+                self.similarity_matrix = get_similarity_matrix_cache()
+                self.neighbour_graph = get_neighbour_graph_cache()
+                self.embedding_store = get_embedding_store()
+                self.content_key_index = get_content_key_index()
+            else:
+                self.similarity_matrix = shard.similarity_matrix
+                self.neighbour_graph = None
+                self.embedding_store = shard.embedding_store
+                self.content_key_index = shard.content_key_index
+        if self.needs_compression():
+            # Cached similarities were computed from the embeddings before they are re-encoded
+            self.incremental = False
+        # Like the cached similarities, those of the merged shards are only reused when nothing is recomputed
+        self.reuse_shard_similarities = self.incremental
+        # None keeps the aggregation of the cached similarity data, or takes that of the merged shards
+        default_aggregation = self.merged_shards[0].aggregation if self.merged_shards else self.cached_aggregation()
+        self.similarity_aggregation = similarity_aggregation or default_aggregation
+        if self.similarity_aggregation != self.cached_aggregation():
+            self.incremental = False
+        self.song_keys = {}
+        self.moved_songs = {}
+        self.stale_song_keys = []
+        with self.report.stage("content_keys") as fields:
+            self.song_paths_to_process = self.compute_song_paths_to_process()
+            fields.update(songs_to_analyse=len(self.song_paths_to_process), songs_moved=len(self.moved_songs))
         self.analysis_progress_bar_max = len(self.song_paths_to_process)
         self.similarity_progress_bar_max = self.compute_similarity_progress_bar_max_value()
         self.analysis_progress_value = 0
         self.similarity_progress_value = 0
 
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def cached_aggregation(self) -> str:
+        """How the cached similarity data of the storage mode in use was aggregated, see `AGGREGATIONS`"""
+        if self.similarity_storage == "topk":
+            return self.neighbour_graph.aggregation if self.neighbour_graph is not None else "median"
+        return self.similarity_matrix.aggregation
+
+    def get_analysed_song_keys(self):
+        if self.similarity_storage == "topk":
+            return self.neighbour_graph.key_to_index if self.neighbour_graph is not None else {}
+        return set(self.similarity_matrix.live_keys)
+
     def compute_song_paths_to_process(self):
+        """
+        Works out which files need analysing by content key, so that renamed or moved files reuse their embeddings.
+
+        Files whose key is already stored are skipped, and if the stored location no longer exists the song is
+        pointed at its new location. A stored song whose file changed audio gets a new key, so it is analysed again
+        and its stale entry dropped.
+        """
+        stored_locations = dict(zip(self.embedding_store.keys, self.embedding_store.metadata["location"]))
+        stored_keys_by_location = {location: key for key, location in stored_locations.items()}
+
         song_paths_to_process = []
+        queued_keys = set()
         for local_path in self.local_song_paths:
-            song_name = Path(local_path).name
-            if song_name not in self.similarity_matrix.columns:
+            if self.cancelled:
+                break
+            try:
+                key = self.content_key_index.key(local_path)
+            except OSError as e:
+                logger.error(f"Error reading audio file {local_path}: {e}")
+                continue
+
+            if key in stored_locations:
+                if stored_locations[key] != str(local_path) and not Path(stored_locations[key]).exists():
+                    self.moved_songs[key] = str(local_path)
+            elif key not in queued_keys:
+                queued_keys.add(key)
+                stale_key = stored_keys_by_location.get(str(local_path))
+                if stale_key is not None:
+                    self.stale_song_keys.append(stale_key)
+                self.song_keys[local_path] = key
                 song_paths_to_process.append(local_path)
+
+        # Runs often cover only part of the library, so the index keeps the locations of every stored song as well as
+        # those of this run. Entries of songs deleted from the library or moved away are dropped
+        kept_locations = {location for key, location in stored_locations.items() if key not in self.moved_songs}
+        self.content_key_index.prune(kept_locations | {str(local_path) for local_path in self.local_song_paths})
+        self.content_key_index.save()
         return song_paths_to_process
 
+    def apply_library_changes(self):
+        """Relocates moved songs and drops stale entries for songs whose audio changed"""
+        self.embedding_store.relocate(self.moved_songs)
+        if self.stale_song_keys:
+            self.embedding_store.delete(self.stale_song_keys)
+            if self.embedding_store.needs_compaction:
+                self.embedding_store = self.embedding_store.compact()
+            self.similarity_matrix.delete(self.stale_song_keys)
+            if self.neighbour_graph is not None:
+                self.neighbour_graph.delete(self.stale_song_keys)
+
+    def needs_compression(self) -> bool:
+        if self.embedding_compression is None:
+            return False
+        codec = self.embedding_store.codec
+        return codec.mode != self.embedding_compression or codec.pca_dims not in (None, self.pca_dims)
+
+    def compress_embeddings(self):
+        """Re-encodes the embedding store with the requested compression, fitted to the whole library"""
+        if not self.embedding_store.metadata["n_segments"].any():
+            logger.warning("No analysed songs to fit the embedding compression to, leaving the store uncompressed")
+            return
+        self.progress.status("Compressing Embeddings...")
+        self.embedding_store = self.embedding_store.compress(self.embedding_compression, pca_dims=self.pca_dims)
+
     def compute_similarity_progress_bar_max_value(self):
-        future_songs_cache_len = len(self.songs_cache) + len(self.song_paths_to_process)
-        upper_triangle_indices = np.triu_indices(future_songs_cache_len, k=1)
-        num_similarities_to_compute = len(upper_triangle_indices[0])
-        return num_similarities_to_compute
+        if self.merged_shards:
+            song_keys = self.merged_song_keys()
+            groups = self.shard_groups(song_keys, self.reusable_keys(song_keys))
+            return self.count_group_pairs(self.merged_songs_with_segments(song_keys), groups)
 
-    def update_songs_cache(self, signals):
-        new_songs = []
-        with multiprocessing.Pool() as pool:
-            for new_song in tqdm(
-                pool.imap_unordered(process_song, self.song_paths_to_process), total=len(self.song_paths_to_process)
-            ):
-                new_songs.append(new_song)
-                self.analysis_progress_value += 1
-                analysis_progress_percentage = round(
-                    100 * self.analysis_progress_value / self.analysis_progress_bar_max
+        future_songs_cache_len = len(self.embedding_store) + len(self.song_paths_to_process) - len(self.stale_song_keys)
+        if not self.incremental:
+            return future_songs_cache_len * (future_songs_cache_len - 1) // 2
+
+        # Only pairs involving a song without cached similarities need computing
+        analysed_song_keys = self.get_analysed_song_keys()
+        num_cached = sum(
+            key in analysed_song_keys and key not in self.stale_song_keys for key in self.embedding_store.keys
+        )
+        num_new = future_songs_cache_len - num_cached
+        return num_new * num_cached + num_new * (num_new - 1) // 2
+
+    def can_update_similarity_matrix_incrementally(self, song_keys):
+        if not self.incremental or self.similarity_matrix.empty:
+            return False
+        # Cached entries can only be reused when every cached song is still present
+        return set(self.similarity_matrix.live_keys).issubset(song_keys)
+
+    def can_update_neighbour_graph_incrementally(self, song_keys):
+        if not self.incremental or self.neighbour_graph is None or self.neighbour_graph.k != self.neighbours_k:
+            return False
+        # New songs are appended to the embedding store, so the graph must cover exactly its leading songs
+        return self.neighbour_graph.keys == song_keys[: len(self.neighbour_graph)]
+
+    def merged_song_keys(self) -> list:
+        """Keys of the songs in the embedding store once the shards are merged into it, in store order"""
+        song_keys = dict.fromkeys(self.embedding_store.keys)
+        for shard in self.merged_shards:
+            song_keys.update(dict.fromkeys(shard.embedding_store.keys))
+        return list(song_keys)
+
+    def merged_songs_with_segments(self, song_keys: list) -> np.ndarray:
+        """Whether each merged song has embeddings, as songs which could not be analysed aren't paired with any song"""
+        n_segments = {}
+        # The store's own entry wins over a shard's, as it does when merging
+        for store in [shard.embedding_store for shard in reversed(self.merged_shards)] + [self.embedding_store]:
+            metadata = store.metadata
+            n_segments.update(zip(metadata["key"], metadata["n_segments"]))
+        return np.array([n_segments[key] > 0 for key in song_keys], dtype=bool)
+
+    def merge_shard_songs(self) -> int:
+        """Adds the songs of the merged shards to the embedding store, leaving out those already in it"""
+        return sum(self.embedding_store.merge(shard.embedding_store) for shard in self.merged_shards)
+
+    def reusable_keys(self, song_keys: list):
+        """Keys of the songs whose cached similarities are kept, or None if every similarity is recomputed"""
+        if self.similarity_storage == "topk":
+            return self.neighbour_graph.keys if self.can_update_neighbour_graph_incrementally(song_keys) else None
+        return self.similarity_matrix.live_keys if self.can_update_similarity_matrix_incrementally(song_keys) else None
+
+    def shard_groups(self, song_keys: list, cached_keys: list = None) -> list:
+        """
+        Splits the songs into groups whose pairs among themselves are already known, see
+        `SimilarityEngine.iter_group_pairs`: the songs with cached similarities, and the songs of each merged shard.
+
+        A song in several groups only goes in the first. Shards aggregated differently from this run add no group, so
+        their songs are paired with every song.
+
+        Args:
+            song_keys (list): Keys of every song, in store order.
+            cached_keys (list): Keys of the songs whose cached similarities are kept, if any.
+
+        Returns:
+            list: (shard, song_indices) for each group, with None as the shard of the cached songs.
+        """
+        sources = [(None, cached_keys or [])]
+        for shard in self.merged_shards if self.reuse_shard_similarities else []:
+            if shard.aggregation != self.similarity_aggregation:
+                logger.warning(
+                    f"Shard {shard.number} of {shard.count} holds {shard.aggregation} similarities rather than "
+                    f"{self.similarity_aggregation}, so they are computed again"
                 )
-                signals.analysis_progress.emit(analysis_progress_percentage)
+                continue
+            sources.append((shard, shard.similarity_matrix.live_keys))
 
-        updated_songs_cache = self.songs_cache + new_songs
-        return updated_songs_cache
+        key_to_index = {key: i for i, key in enumerate(song_keys)}
+        grouped_keys = set()
+        groups = []
+        for shard, keys in sources:
+            group = [key_to_index[key] for key in keys if key in key_to_index and key not in grouped_keys]
+            grouped_keys.update(keys)
+            groups.append((shard, group))
+        return groups
 
-    def upload_songs_cache(self):
-        local_path = Path(f"{local_app_data_dir}/cache/songs.pickle")
-        local_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(local_path, "wb") as f:
-            pickle.dump(self.songs_cache, f)
+    @staticmethod
+    def count_group_pairs(has_segments: np.ndarray, groups: list) -> int:
+        """
+        Pairs computed for `shard_groups`, i.e. those between different groups and those of ungrouped songs, counting
+        only songs with embeddings as `SimilarityEngine.iter_group_pairs` does.
+        """
+        n_songs = int(np.count_nonzero(has_segments))
+        sizes = [int(np.count_nonzero(has_segments[np.asarray(group, dtype=np.int64)])) for _, group in groups]
+        n_ungrouped = n_songs - sum(sizes)
+        pairs_between_groups = (sum(sizes) ** 2 - sum(size**2 for size in sizes)) // 2
+        return pairs_between_groups + n_ungrouped * (n_songs - n_ungrouped) + n_ungrouped * (n_ungrouped - 1) // 2
 
-    def compute_similarity_matrix(self, signals):
-        song_names = [song.name for song in self.songs_cache]
+    @staticmethod
+    def add_shard_candidates(neighbour_graph: NeighbourGraph, shard: AnalysisShard, song_keys: list, group: list):
+        """Adds the pairs a shard computed between the songs of its group to a neighbour graph"""
+        similarity_matrix = shard.similarity_matrix
+        positions = np.array([similarity_matrix.key_to_index[song_keys[i]] for i in group], dtype=np.int64)
+        group = np.asarray(group, dtype=np.int64)
+        source = similarity_matrix.memmap()
+        for start in range(0, len(group), ROWS_PER_COPY):
+            rows = slice(start, start + ROWS_PER_COPY)
+            neighbour_graph.add_candidates(group[rows], group, np.asarray(source[positions[rows]][:, positions]))
+
+    def update_songs_cache(self):
+        """
+        Analyses the new songs, adding them to the embedding store in small batches as they complete.
+
+        Returns:
+            list: The analysed songs, including those which could not be analysed, without their raw embeddings.
+        """
+        new_songs = []
+        if not self.song_keys:
+            return new_songs
 
-        # Gather embeddings and corresponding song indices
-        embeddings = []
-        song_indices = []
-        for i, song in enumerate(self.songs_cache):
-            if song.simplified_yamnet_embeddings is not None:
-                embeddings.append(song.simplified_yamnet_embeddings)
-                song_indices.extend([i] * song.simplified_yamnet_embeddings.shape[0])
+        pipeline = AnalysisPipeline(
+            n_decode_workers=self.n_decode_workers,
+            n_inference_workers=self.n_inference_workers,
+            batch_size=self.inference_batch_size,
+            max_buffered_songs=self.max_buffered_songs,
+            decode_mode=self.decode_mode,
+            report=self.report,
+            profile_keys=self.report.choose_profiled_keys(self.song_keys.values()),
+            cancel_event=self.cancel_event,
+        )
+        start = time.perf_counter()
+        unstored_songs = []
+        with tqdm(total=len(self.song_paths_to_process)) as progress_bar:
+            for songs in pipeline.run(self.song_keys.items()):
+                new_songs.extend(songs)
+                unstored_songs.extend(songs)
+                if len(unstored_songs) >= STORE_BATCH_SONGS:
+                    self.upload_songs_cache(unstored_songs)
+                    unstored_songs = []
+                progress_bar.update(len(songs))
+                self.analysis_progress_value += len(songs)
+                self.progress.update(self.analysis_progress_value)
+        self.upload_songs_cache(unstored_songs)
 
-        embeddings = np.vstack(embeddings)
-        song_indices = np.array(song_indices)
+        elapsed_seconds = time.perf_counter() - start
+        if new_songs:
+            logger.info(
+                f"Analysed {len(new_songs)} songs in {elapsed_seconds:.1f}s ({len(new_songs) / elapsed_seconds:.2f} "
+                f"songs/s) with {self.n_decode_workers} decode and {self.n_inference_workers} inference workers, "
+                f"batches of up to {self.inference_batch_size} songs; per song: "
+                f"{pipeline.decode_seconds / len(new_songs):.3f}s decoding, "
+                f"{pipeline.inference_seconds / len(new_songs):.3f}s inference"
+            )
+        return new_songs
 
-        logger.info("Computing pairwise distances between song embeddings...")
-        distances = cdist(embeddings, embeddings, metric="cosine")
+    def upload_songs_cache(self, new_songs):
+        # Appends to the embedding store without rewriting the songs already in it
+        self.embedding_store.append(new_songs)
+        for song in new_songs:
+            # Only the collapsed embeddings are kept, so that memory use doesn't grow with the size of the run
+            song.yamnet_embeddings = None
 
-        n_songs = len(self.songs_cache)
-        similarity_matrix_data = np.full((n_songs, n_songs), np.nan)
+    def build_similarity_engine(self):
+        self.similarity_engine = SimilarityEngine(
+            self.embedding_store.all_embeddings(),
+            memory_budget_mb=self.memory_budget_mb,
+            precision=self.similarity_precision,
+            codec=self.embedding_store.codec,
+            aggregation=self.similarity_aggregation,
+        )
+        return self.similarity_engine
 
-        # Precompute masks for each song index once
-        index_masks = [song_indices == i for i in range(n_songs)]
+    def similarity_progress_callback(self, progress_bar):
+        def report_progress(pairs_done, pairs_total):
+            self.similarity_progress_bar_max = pairs_total
+            self.similarity_progress_value = pairs_done
+            progress_bar.total = pairs_total
+            progress_bar.update(pairs_done - progress_bar.n)
+            self.progress.update(pairs_done, pairs_total)
 
-        upper_triangle_indices = np.triu_indices(n_songs, k=1)
-        num_pairs = len(upper_triangle_indices[0])
+        return report_progress
 
-        self.similarity_progress_bar_max = num_pairs
-        similarity_progress_value = 0  # local for performance
+    def similarity_fingerprint(self, song_keys: list, new_songs: list = None, groups: list = None) -> str:
+        """Identifies a similarity computation, so that only an interrupted run of the same one is resumed"""
+        return SimilarityCheckpoint.fingerprint(
+            storage=self.similarity_storage,
+            keys=song_keys,
+            new_songs=new_songs,
+            groups=groups,
+            precision=self.similarity_precision,
+            max_tile_size=self.similarity_engine.max_tile_size,
+            table_size_per_row=self.similarity_engine.table_size_per_row,
+            neighbours_k=self.neighbours_k if self.similarity_storage == "topk" else None,
+            embedding_compression=self.embedding_store.compression,
+            aggregation=self.similarity_aggregation,
+        )
 
-        for idx in tqdm(range(num_pairs)):
-            i = upper_triangle_indices[0][idx]
-            j = upper_triangle_indices[1][idx]
+    def fill_similarities(self, engine, new_songs, start_pairs, add_pairs, save_checkpoint, groups=None):
+        """
+        Computes song-pair medians into a similarity store, checkpointing regularly and stopping if cancelled.
 
-            mask1 = index_masks[i]
-            mask2 = index_masks[j]
+        Args:
+            engine (SimilarityEngine): Engine over every stored song.
+            new_songs (list): Indices of the songs to compute pairs for, or None for every pair.
+            start_pairs (int): Pairs already computed by an interrupted run, see `SimilarityEngine.iter_pairs`.
+            add_pairs (callable): Called with each (row_songs, col_songs, medians) tile.
+            save_checkpoint (callable): Called with the number of pairs done, to make progress so far durable.
+            groups (list): Groups of song indices whose pairs among themselves are already known, to compute only the
+                           other pairs instead, see `SimilarityEngine.iter_group_pairs`.
 
-            # This indexing avoids nested slicing
-            distance_block = distances[np.ix_(mask1, mask2)]
-            median_distance = np.median(distance_block)
+        Returns:
+            bool: Whether every pair was computed, rather than the run being cancelled.
+        """
+        stopping = False
 
-            similarity_matrix_data[i, j] = median_distance
-            similarity_matrix_data[j, i] = median_distance
+        with tqdm(total=self.similarity_progress_bar_max) as progress_bar:
+            report_progress = self.similarity_progress_callback(progress_bar)
 
-            similarity_progress_value += 1
-            if signals:
-                signals.similarity_progress.emit(
-                    round(100 * similarity_progress_value / self.similarity_progress_bar_max)
+            def report_progress_and_checkpoint(pairs_done, pairs_total):
+                nonlocal stopping
+                report_progress(pairs_done, pairs_total)
+                # Only called between tiles, so a checkpoint never covers half of one
+                stopping = self.cancelled and pairs_done < pairs_total
+                if stopping or (self.similarity_checkpoint.due() and pairs_done < pairs_total):
+                    save_checkpoint(pairs_done)
+
+            # Checked by the engine before it computes each tile, so a cancelled run stops without finishing another
+            def should_stop():
+                return stopping
+
+            if groups is None:
+                pairs = engine.iter_pairs(
+                    songs=new_songs,
+                    progress_callback=report_progress_and_checkpoint,
+                    start_pairs=start_pairs,
+                    should_stop=should_stop,
                 )
+            else:
+                pairs = engine.iter_group_pairs(
+                    groups,
+                    progress_callback=report_progress_and_checkpoint,
+                    start_pairs=start_pairs,
+                    should_stop=should_stop,
+                )
+            for row_songs, col_songs, medians in pairs:
+                add_pairs(row_songs, col_songs, medians)
+        return not stopping
+
+    def compute_similarity_matrix(self):
+        """
+        Computes the dense similarity matrix, growing the cached one in place where possible, or into a new file.
+
+        Returns:
+            SimilarityMatrix or None: The matrix, ready to commit, the cached one if there was nothing to compute, or
+                                      None if the run was cancelled first.
+        """
+        song_keys = self.embedding_store.keys
+        self.similarity_engine = None
+
+        new_songs, groups = None, None
+        incremental = self.can_update_similarity_matrix_incrementally(song_keys)
+        if self.merged_shards:
+            # Keep the cached entries and those of each shard, and only compute the pairs between them
+            groups = self.shard_groups(song_keys, self.similarity_matrix.live_keys if incremental else None)
+        elif incremental:
+            # Keep the cached entries and only compute the rows and columns of songs new to the matrix
+            new_songs = [i for i, key in enumerate(song_keys) if key not in self.similarity_matrix]
+            if not new_songs:
+                return self.similarity_matrix
+        engine = self.build_similarity_engine()
+        group_indices = None if groups is None else [group for _, group in groups]
+        fingerprint = self.similarity_fingerprint(song_keys, new_songs, group_indices)
+        if new_songs is not None:
+            # Resuming a grow relies on the entries it wrote into the cached file
+            fingerprint += f"-{self.similarity_matrix.generation}"
+
+        # The new matrix is written straight into its memory-mapped file, and committed on upload. The file of an
+        # interrupted run is picked up again as long as its checkpoint matches
+        start_pairs = self.similarity_checkpoint.load(fingerprint)
+        similarity_matrix = None
+        # Growing keeps the rows of deleted songs, so once there are enough of them the matrix is rewritten instead
+        if new_songs is not None and not self.similarity_matrix.needs_compaction:
+            similarity_matrix = self.similarity_matrix.grow([song_keys[i] for i in new_songs], reset=start_pairs == 0)
+        if similarity_matrix is None and start_pairs:
+            similarity_matrix = SimilarityMatrix.reopen_allocated(
+                self.similarity_matrix.path, song_keys, aggregation=self.similarity_aggregation
+            )
+        if similarity_matrix is None:
+            start_pairs = 0
+            similarity_matrix = SimilarityMatrix.allocate(
+                self.similarity_matrix.path, song_keys, aggregation=self.similarity_aggregation
+            )
+            if incremental:
+                similarity_matrix.copy_from(self.similarity_matrix)
+            for shard, _ in groups or []:
+                if shard is not None:
+                    similarity_matrix.copy_from(shard.similarity_matrix)
 
-        # Convert to DataFrame at the end
-        similarity_matrix = pd.DataFrame(similarity_matrix_data, index=song_names, columns=song_names)
+        # A grown matrix keeps its own row order, which differs from the store's once either was compacted
+        positions = np.array([similarity_matrix.key_to_index[key] for key in song_keys], dtype=np.int64)
+
+        def add_pairs(row_songs, col_songs, medians):
+            similarity_matrix.data[np.ix_(positions[row_songs], positions[col_songs])] = medians
+
+        def save_checkpoint(pairs_done):
+            similarity_matrix.data.flush()
+            self.similarity_checkpoint.save(fingerprint, pairs_done)
+
+        if not self.fill_similarities(engine, new_songs, start_pairs, add_pairs, save_checkpoint, group_indices):
+            return None
+        # Diagonal tiles also hold each song paired with itself
+        diagonal = np.arange(similarity_matrix.grown_from or 0, len(similarity_matrix))
+        similarity_matrix.data[diagonal, diagonal] = np.nan
         return similarity_matrix
 
+    def compute_neighbour_graph(self):
+        """
+        Computes the top-k neighbour graph, updating the cached one where possible.
+
+        Returns:
+            NeighbourGraph or None: The graph, or None if the run was cancelled first.
+        """
+        song_keys = self.embedding_store.keys
+        engine = self.build_similarity_engine()
+
+        new_songs, groups = None, None
+        incremental = self.can_update_neighbour_graph_incrementally(song_keys)
+        if self.merged_shards:
+            # The pairs within each shard come from its matrix, so only the pairs between shards are computed
+            groups = self.shard_groups(song_keys, self.neighbour_graph.keys if incremental else None)
+        elif incremental:
+            # Existing neighbour lists only need merging with candidates from the new songs
+            new_songs = list(range(len(self.neighbour_graph), len(song_keys)))
+        group_indices = None if groups is None else [group for _, group in groups]
+        fingerprint = self.similarity_fingerprint(song_keys, new_songs, group_indices)
+
+        # An interrupted run saved a copy of its partial graph along with its checkpoint
+        start_pairs = self.similarity_checkpoint.load(fingerprint)
+        neighbour_graph = None
+        if start_pairs:
+            try:
+                neighbour_graph = NeighbourGraph.load(self.neighbour_graph_checkpoint_path)
+            except Exception as e:
+                logger.warning(f"Could not load the checkpointed neighbour graph, starting again: {e}")
+        if neighbour_graph is None or neighbour_graph.keys != song_keys:
+            start_pairs = 0
+            if incremental:
+                neighbour_graph = self.neighbour_graph
+                neighbour_graph.add_songs(song_keys[len(neighbour_graph) :])
+            else:
+                neighbour_graph = NeighbourGraph.empty(
+                    song_keys, k=self.neighbours_k, aggregation=self.similarity_aggregation
+                )
+            for shard, group in groups or []:
+                if shard is not None:
+                    self.add_shard_candidates(neighbour_graph, shard, song_keys, group)
+
+        def save_checkpoint(pairs_done):
+            neighbour_graph.save(self.neighbour_graph_checkpoint_path)
+            self.similarity_checkpoint.save(fingerprint, pairs_done)
+
+        if not self.fill_similarities(
+            engine, new_songs, start_pairs, neighbour_graph.add_candidates, save_checkpoint, group_indices
+        ):
+            return None
+        return neighbour_graph
+
+    def clear_similarity_checkpoint(self):
+        self.similarity_checkpoint.clear()
+        self.neighbour_graph_checkpoint_path.unlink(missing_ok=True)
+
     def upload_similarity_matrix(self):
-        local_path = Path(f"{local_app_data_dir}/cache/similarity_matrix.pickle")
-        local_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(local_path, "wb") as f:
-            pickle.dump(self.similarity_matrix, f)
-
-    def run(self, signals=None):
-        if signals:
-            signals.status.emit("Analysing Songs...")
-        self.songs_cache = self.update_songs_cache(signals=signals)
-        self.upload_songs_cache()
-        if signals:
-            signals.status.emit("Computing Similarities...")
-        self.similarity_matrix = self.compute_similarity_matrix(signals=signals)
-        self.upload_similarity_matrix()
-        if signals:
-            signals.status.emit("Done")
-            signals.analysis_progress.emit(0)
-            signals.similarity_progress.emit(0)
-            signals.status.emit("")
+        self.similarity_matrix.commit()
+
+    def upload_neighbour_graph(self):
+        self.neighbour_graph.save(self.cache_dir / "neighbour_graph.npz")
+
+    def run(self):
+        """
+        Analyses new songs, then updates and stores the similarity data, reporting progress through `self.progress`.
+
+        Analysed songs are stored as they complete, and the similarity computation is checkpointed, so a run that is
+        cancelled (or crashes) resumes where it stopped when run again.
+
+        Returns:
+            list: The newly analysed songs.
+        """
+        try:
+            new_songs = self.run_stages()
+        except BaseException as e:
+            self.report.close(status="failed", error=repr(e))
+            raise
+        self.report.close(
+            status="cancelled" if self.cancelled else "ok",
+            songs_analysed=sum(song.simplified_yamnet_embeddings is not None for song in new_songs),
+            songs_failed=sum(song.simplified_yamnet_embeddings is None for song in new_songs),
+        )
+        return new_songs
+
+    def run_stages(self):
+        if self.shard is not None:
+            self.shard.start()
+        with self.report.stage("library_changes"):
+            self.apply_library_changes()
+        if self.merged_shards:
+            self.progress.status("Merging Shards...")
+            with self.report.stage("merge_shards") as fields:
+                fields.update(songs=self.merge_shard_songs())
+
+        self.progress.start_stage("analysis", self.analysis_progress_bar_max, message="Analysing Songs...")
+        with self.report.stage("analysis") as fields:
+            new_songs = self.update_songs_cache()
+            fields.update(songs=len(new_songs))
+        self.progress.finish_stage()
+        if self.cancelled:
+            self.progress.status("Cancelled")
+            return new_songs
+
+        if self.needs_compression():
+            with self.report.stage("compression"):
+                self.compress_embeddings()
+
+        self.progress.start_stage("similarity", self.similarity_progress_bar_max, message="Computing Similarities...")
+        with self.report.stage("similarity") as fields:
+            if self.similarity_storage == "topk":
+                similarities = self.compute_neighbour_graph()
+            else:
+                similarities = self.compute_similarity_matrix()
+            # No engine is built when there is nothing to compute
+            stage_seconds = {} if self.similarity_engine is None else self.similarity_engine.stage_seconds
+            fields.update(
+                pairs=self.similarity_progress_value,
+                **{f"{name}_s": round(seconds, 3) for name, seconds in stage_seconds.items()},
+            )
+        # A cancel which arrives after the last tile leaves a finished result, which is stored like any other
+        if similarities is None:
+            self.progress.status("Cancelled")
+            return new_songs
+
+        with self.report.stage("store_similarities"):
+            if self.similarity_storage == "topk":
+                self.neighbour_graph = similarities
+                self.upload_neighbour_graph()
+            elif similarities is not self.similarity_matrix:
+                self.similarity_matrix = similarities
+                self.upload_similarity_matrix()
+            self.clear_similarity_checkpoint()
+        self.progress.finish_stage()
+        if self.shard is not None:
+            self.shard.finish(precision=self.similarity_precision)
+        self.progress.status("Done")
+        return new_songs
@@ -0,0 +1,114 @@
+import os
+import re
+import uuid
+
+from pathlib import Path
+
+from selecta.utils import atomic_write
+
+# A cache is compacted once this fraction of its songs are deleted
+COMPACTION_THRESHOLD = 0.2
+# Generation of caches written before deletes were logged
+INITIAL_GENERATION = "0"
+
+
+def new_generation() -> str:
+    # Random rather than counted, so that a cache written from scratch never reuses the generation of an older log
+    return uuid.uuid4().hex
+
+
+def generation_path(path: Path, generation: str, suffix: str = None) -> Path:
+    """
+    File of one generation of a cache, e.g. similarity_matrix.<generation>.f32 for similarity_matrix.f32. Files of the
+    initial generation keep the cache's own name.
+    """
+    path = Path(path)
+    suffix = path.suffix if suffix is None else suffix
+    if generation == INITIAL_GENERATION:
+        return path.with_suffix(suffix)
+    return path.with_name(f"{path.stem}.{generation}{suffix}")
+
+
+def remove_other_generations(path: Path, generation: str, suffixes: list):
+    """Removes the files of every other generation of a cache, once the current generation has been committed"""
+    path = Path(path)
+    for suffix in suffixes:
+        keep = generation_path(path, generation, suffix)
+        pattern = re.compile(rf"{re.escape(path.stem)}(\.[0-9a-f]{{32}})?{re.escape(suffix)}")
+        for stale_path in path.parent.glob(f"{path.stem}*{suffix}"):
+            if stale_path != keep and pattern.fullmatch(stale_path.name):
+                try:
+                    stale_path.unlink()
+                except OSError:
+                    # Still mapped by a reader on Windows, it goes with the next generation instead
+                    pass
+
+
+class TombstoneLog:
+    """
+    Append-only log of the songs deleted from one generation of a cache.
+
+    Deleting songs appends their keys to the log, so it costs O(songs deleted) however large the cache is, and readers
+    of the cache skip the logged songs. Each generation of a cache has its own log (see `generation_path`), which also
+    starts with the generation: compacting a cache writes it without its deleted songs under a new generation, so its
+    old log goes stale in the same atomic step that commits the new files.
+
+    Each append is flushed to disk before returning. A last line cut short by a crash is ignored, and a stale log or
+    one whose header was never completed is read as empty.
+    """
+
+    def __init__(self, path: Path, generation: str):
+        self.path = Path(path)
+        self.generation = generation
+        self.keys = set()
+        # Whether the file holds this generation's header, and whether it ends with a complete line
+        self.started = False
+        self.torn = False
+        self.read()
+
+    def read(self):
+        try:
+            with open(self.path, encoding="utf-8", newline="\n") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return
+        lines = text.split("\n")
+        if len(lines) < 2 or lines[0] != f"generation {self.generation}":
+            return
+        self.started = True
+        self.torn = lines[-1] != ""
+        self.keys = set(lines[1:-1])
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def needs_compaction(self, n_songs: int) -> bool:
+        return len(self.keys) > 0 and len(self.keys) >= COMPACTION_THRESHOLD * n_songs
+
+    def add(self, keys: list):
+        """Logs songs as deleted"""
+        new_keys = [key for key in dict.fromkeys(keys) if key not in self.keys]
+        if not new_keys:
+            return
+        if not self.started or self.torn:
+            # A line cut short by a crash could be the start of another key, so it is dropped rather than appended to
+            self.rewrite(list(self.keys) + new_keys)
+            return
+        with open(self.path, "a", encoding="utf-8", newline="\n") as f:
+            f.write("".join(f"{key}\n" for key in new_keys))
+            f.flush()
+            os.fsync(f.fileno())
+        self.keys.update(new_keys)
+
+    def rewrite(self, keys: list):
+        """Atomically replaces the log with one holding only the given songs"""
+        with atomic_write(self.path, "w", encoding="utf-8", newline="\n") as f:
+            f.write(f"generation {self.generation}\n" + "".join(f"{key}\n" for key in keys))
+        self.started, self.torn = True, False
+        self.keys = set(keys)
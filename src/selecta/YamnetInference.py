@@ -0,0 +1,78 @@
+import time
+import numpy as np
+
+from selecta.logger import generate_logger
+
+logger = generate_logger()
+
+SAMPLE_RATE = 16000
+# YAMNet frames a waveform into 0.96s patches every 0.48s. A patch spans 0.975s of audio once the STFT window is
+# included, and YAMNet pads every waveform to at least one patch plus a whole number of hops.
+PATCH_WINDOW_SAMPLES = 15600
+PATCH_HOP_SAMPLES = 7680
+DEFAULT_INFERENCE_BATCH_SIZE = 8
+
+
+class YamnetInference:
+    """
+    Runs YAMNet on several songs in a single model call.
+
+    YAMNet turns one waveform into a batch of patches internally, so songs are batched by laying their waveforms end
+    to end, each starting on a patch hop boundary and followed by silence. Every patch of a song then covers exactly
+    the samples it would cover if the song were run on its own, and the song's embeddings are a contiguous slice of
+    the model's output. Patches straddling two songs are computed but discarded, which costs a few patches per song.
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    @staticmethod
+    def n_patches(n_samples: int) -> int:
+        """Number of patches (and so embeddings) YAMNet produces for a waveform of n_samples"""
+        samples_after_first_patch = max(n_samples, PATCH_WINDOW_SAMPLES) - PATCH_WINDOW_SAMPLES
+        return 1 + -(-samples_after_first_patch // PATCH_HOP_SAMPLES)
+
+    @classmethod
+    def layout(cls, waveforms: list) -> tuple:
+        """
+        Positions songs along a concatenated waveform.
+
+        Returns:
+            tuple: (starts, n_patches, total_samples), with each song's first sample, its number of patches and the
+                   length of the concatenated waveform.
+        """
+        n_patches = np.array([cls.n_patches(len(waveform)) for waveform in waveforms], dtype=np.int64)
+        # A song's padded length is one patch window plus a hop per extra patch, rounded up to the next hop boundary
+        padded_samples = PATCH_WINDOW_SAMPLES + (n_patches - 1) * PATCH_HOP_SAMPLES
+        padded_hops = -(-padded_samples // PATCH_HOP_SAMPLES)
+        starts = np.concatenate([[0], np.cumsum(padded_hops)[:-1]]) * PATCH_HOP_SAMPLES
+        # Pad out the last song too: YAMNet pads the batch as a whole, which can fall short of the song's last patch
+        total_samples = int(starts[-1] + padded_samples[-1]) if len(waveforms) else 0
+        return starts, n_patches, total_samples
+
+    def embed(self, waveforms: list) -> list:
+        """
+        Extracts YAMNet embeddings for several waveforms with one model call.
+
+        Args:
+            waveforms (list): 16kHz mono float32 waveforms.
+
+        Returns:
+            list: One (n_patches, 1024) embedding array per waveform.
+        """
+        if not waveforms:
+            return []
+        starts, n_patches, total_samples = self.layout(waveforms)
+        batch = np.zeros(total_samples, dtype=np.float32)
+        for start, waveform in zip(starts, waveforms):
+            batch[start : start + len(waveform)] = waveform
+
+        embeddings = self.model(batch)["output_1"].numpy()
+        first_patches = starts // PATCH_HOP_SAMPLES
+        return [embeddings[first : first + n] for first, n in zip(first_patches, n_patches)]
+
+    def warm_up(self):
+        """Runs the model once on silence, so that graph tracing isn't counted against the first real batch"""
+        start = time.perf_counter()
+        self.embed([np.zeros(PATCH_WINDOW_SAMPLES, dtype=np.float32)])
+        logger.info(f"YAMNet warmed up in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,72 @@
+import time
+import numpy as np
+
+from selecta.logger import generate_logger
+from selecta.PlaylistGenerator import PlaylistGenerator
+from selecta.SimilarityEngine import SimilarityEngine, AGGREGATIONS, DEFAULT_MEMORY_BUDGET_MB
+
+logger = generate_logger()
+
+REFERENCE_AGGREGATION = "median"
+
+
+def compare_aggregations(
+    embeddings: list,
+    codec=None,
+    n_playlists: int = 100,
+    playlist_length: int = 30,
+    memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB,
+    precision: str = "float32",
+    seed: int = 0,
+):
+    """
+    Builds the similarity matrix of a set of songs with every aggregation, and compares each with the median.
+
+    Each matrix is compared through the playlists it generates: the same root songs, chosen at random, get a playlist
+    from every matrix, and the overlap is the mean fraction of the median's playlist songs which the other playlist
+    shares.
+
+    Args:
+        embeddings (list): Segment embeddings of each song, as passed to `SimilarityEngine`.
+        codec (EmbeddingCodec): Codec the embeddings are encoded with, if they come from a compressed store.
+        n_playlists (int): Number of root songs to generate playlists from.
+        playlist_length (int): Songs per playlist besides its root song.
+        memory_budget_mb (float): Memory budget of each `SimilarityEngine`.
+        precision (str): Precision of each `SimilarityEngine`.
+        seed (int): Seed for choosing the root songs.
+
+    Yields:
+        dict: For each aggregation, the median first: its name, the seconds taken to build the matrix, the speed-up
+              over the median and the playlist overlap with it.
+    """
+    rng = np.random.default_rng(seed)
+    analysed = np.flatnonzero([e is not None for e in embeddings])
+    roots = rng.choice(analysed, min(n_playlists, len(analysed)), replace=False)
+    no_deleted_songs = np.empty(0, dtype=np.int64)
+
+    reference_seconds, reference_playlists = None, None
+    for aggregation in [REFERENCE_AGGREGATION] + [a for a in AGGREGATIONS if a != REFERENCE_AGGREGATION]:
+        start = time.perf_counter()
+        engine = SimilarityEngine(
+            embeddings, memory_budget_mb=memory_budget_mb, precision=precision, codec=codec, aggregation=aggregation
+        )
+        matrix = engine.compute(out=np.full((len(embeddings), len(embeddings)), np.nan, dtype=np.float32))
+        seconds = time.perf_counter() - start
+
+        playlists = PlaylistGenerator.nearest_dense_batch(
+            matrix, [[root] for root in roots], playlist_length, "centroid", no_deleted_songs
+        )
+        if reference_playlists is None:
+            reference_seconds, reference_playlists = seconds, playlists
+        overlaps = [
+            len(set(playlist) & set(reference)) / len(reference)
+            for playlist, reference in zip(playlists, reference_playlists)
+            if len(reference)
+        ]
+        logger.info(f"Built the {aggregation} similarity matrix of {len(embeddings)} songs in {seconds:.2f}s")
+        yield {
+            "aggregation": aggregation,
+            "seconds": round(seconds, 3),
+            "speed_up": round(reference_seconds / seconds, 2),
+            "playlist_overlap": round(float(np.mean(overlaps)), 4) if overlaps else None,
+        }
@@ -0,0 +1,553 @@
+import json
+import time
+import signal
+import argparse
+import threading
+import multiprocessing
+import numpy as np
+
+from pathlib import Path
+from contextlib import contextmanager
+
+from selecta.logger import generate_logger
+from selecta.LibraryScanner import LibraryScanner
+from selecta.LibraryWatcher import LibraryWatcher, DEFAULT_WATCH_INTERVAL_S
+from selecta.AnalysisPipeline import CANCEL_POLL_INTERVAL_S
+from selecta.AnalysisShard import AnalysisShard
+from selecta.aggregation_report import compare_aggregations
+from selecta.EmbeddingCodec import COMPRESSION_MODES, DEFAULT_PCA_DIMS
+from selecta.NeighbourGraph import DEFAULT_NEIGHBOURS
+from selecta.PlaylistExporter import PlaylistExporter, EXPORT_FORMATS
+from selecta.PlaylistGenerator import PlaylistGenerator, SEED_COMBINE_MODES
+from selecta.ProgressBus import ProgressBus, log_progress
+from selecta.SimilarityEngine import DEFAULT_MEMORY_BUDGET_MB, PRECISIONS, AGGREGATIONS
+from selecta.Song import DECODE_MODES
+from selecta.SongProcessorDesktop import SongProcessorDesktop, SIMILARITY_STORAGE_MODES
+from selecta.utils import (
+    add_playlists_to_cache,
+    get_embedding_store,
+    get_library_scanner,
+    get_neighbour_graph_cache,
+    get_playlists_cache,
+    get_similarity_matrix_cache,
+    get_songs_cache,
+)
+from selecta.YamnetInference import DEFAULT_INFERENCE_BATCH_SIZE
+
+logger = generate_logger()
+
+# Exit codes, so that cron jobs and scripts can tell outcomes apart
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_USAGE = 2
+EXIT_PARTIAL = 3  # Finished, but some songs could not be analysed
+EXIT_INTERRUPTED = 130  # Cancelled with Ctrl+C; running again resumes where it stopped
+
+# Longest wait before analysing a batch again in watch mode, after its analysis failed several times in a row
+MAX_WATCH_BACKOFF_S = 600.0
+
+
+def write_event(event: str, **fields):
+    """Writes one progress event to stdout as a line of JSON"""
+    print(json.dumps({"event": event, "time": round(time.time(), 3), **fields}), flush=True)
+
+
+def write_progress_event(event):
+    if event.stage == "status":
+        write_event("status", message=event.message)
+    else:
+        write_event("progress", **event.as_dict())
+
+
+def find_songs(directories: list, scanner: LibraryScanner = None) -> list:
+    scanner = scanner or get_library_scanner()
+    song_paths = scanner.scan(directories)
+    scanner.save()
+    return song_paths
+
+
+def shard_spec(value: str) -> tuple:
+    """Parses a shard given as <number>/<count>, e.g. 2/4 for the second of four shards"""
+    try:
+        number, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected <number>/<count>, e.g. 2/4, got {value!r}")
+    if not 1 <= number <= count:
+        raise argparse.ArgumentTypeError(f"shard number must be between 1 and {count}, got {number}")
+    return number, count
+
+
+@contextmanager
+def cancel_on_interrupt():
+    """
+    The first Ctrl+C stops the run cleanly, keeping everything done so far; a second one stops it immediately.
+
+    Yields:
+        threading.Event: Set once the run should stop.
+    """
+    cancel_event = threading.Event()
+
+    def request_cancel(signum, frame):
+        write_event("status", message="Cancelling, press Ctrl+C again to stop immediately")
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        cancel_event.set()
+
+    previous_handler = signal.signal(signal.SIGINT, request_cancel)
+    try:
+        yield cancel_event
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m selecta", description="Selecta command line tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    analyse = subparsers.add_parser(
+        "analyse",
+        help="Analyse the songs in one or more directories and update the similarity data",
+        description="Analyses every .mp3 file under the given directories and updates the same caches as the app. "
+        "Progress is written to stdout as one JSON object per line.",
+    )
+    analyse.add_argument("directories", nargs="+", type=Path, help="Directories to scan for .mp3 files")
+    analyse.add_argument("--workers", type=int, default=None, help="Total worker processes (default: all cores)")
+    analyse.add_argument(
+        "--inference-workers", type=int, default=None, help="How many of the workers run YAMNet (default: a quarter)"
+    )
+    analyse.add_argument(
+        "--batch-size", type=int, default=DEFAULT_INFERENCE_BATCH_SIZE, help="Maximum songs per YAMNet call"
+    )
+    analyse.add_argument("--decode-mode", choices=list(DECODE_MODES), default="standard")
+    analyse.add_argument("--similarity-storage", choices=list(SIMILARITY_STORAGE_MODES), default="dense")
+    analyse.add_argument(
+        "--neighbours", type=int, default=DEFAULT_NEIGHBOURS, help="Neighbours kept per song with topk storage"
+    )
+    analyse.add_argument("--precision", choices=list(PRECISIONS), default="float32")
+    analyse.add_argument(
+        "--aggregation",
+        choices=list(AGGREGATIONS),
+        default=None,
+        help="How the distances between two songs' segments are combined: "
+        + ", ".join(f"{mode} uses the {description}" for mode, description in AGGREGATIONS.items())
+        + " (default: keep the current one, median at first)",
+    )
+    analyse.add_argument("--memory-budget-mb", type=float, default=DEFAULT_MEMORY_BUDGET_MB)
+    analyse.add_argument(
+        "--embedding-compression",
+        choices=list(COMPRESSION_MODES),
+        default=None,
+        help="Re-encode the stored embeddings, which is kept for later runs (default: keep the current encoding)",
+    )
+    analyse.add_argument(
+        "--pca-dims", type=int, default=DEFAULT_PCA_DIMS, help="Dimensions kept by the pca and pq compressions"
+    )
+    analyse.add_argument(
+        "--profile-songs",
+        type=int,
+        default=0,
+        help="Profile the decode and inference of this many songs with cProfile, saved alongside the run report",
+    )
+    analyse.add_argument(
+        "--full", action="store_true", help="Recompute every similarity instead of updating the cached data"
+    )
+    analyse.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running after the analysis, analysing new or changed songs as they appear, until Ctrl+C",
+    )
+    analyse.add_argument(
+        "--watch-interval",
+        type=float,
+        default=DEFAULT_WATCH_INTERVAL_S,
+        help="Seconds between scans in watch mode; songs are analysed once unchanged for one interval",
+    )
+    analyse.add_argument(
+        "--shard",
+        type=shard_spec,
+        default=None,
+        metavar="NUMBER/COUNT",
+        help="Only analyse this shard of the songs, e.g. 2/4, into its own directory of --shard-dir for merging later",
+    )
+    analyse.add_argument(
+        "--shard-dir", type=Path, default=None, help="Directory shared by every shard, e.g. on a NAS, with --shard"
+    )
+
+    merge = subparsers.add_parser(
+        "merge",
+        help="Merge shards analysed with analyse --shard into the app's caches",
+        description="Adds the songs of every shard in a shard directory to the same caches as the app, and computes "
+        "the similarities between songs of different shards. The similarities within each shard are taken from it. "
+        "Every shard must be complete. Progress is written to stdout as one JSON object per line.",
+    )
+    merge.add_argument("shard_dir", type=Path, help="Directory holding the shards")
+    merge.add_argument("--similarity-storage", choices=list(SIMILARITY_STORAGE_MODES), default="dense")
+    merge.add_argument(
+        "--neighbours", type=int, default=DEFAULT_NEIGHBOURS, help="Neighbours kept per song with topk storage"
+    )
+    merge.add_argument("--precision", choices=list(PRECISIONS), default="float32")
+    merge.add_argument(
+        "--aggregation",
+        choices=list(AGGREGATIONS),
+        default=None,
+        help="How the distances between two songs' segments are combined (default: that of the shards)",
+    )
+    merge.add_argument("--memory-budget-mb", type=float, default=DEFAULT_MEMORY_BUDGET_MB)
+    merge.add_argument(
+        "--embedding-compression",
+        choices=list(COMPRESSION_MODES),
+        default=None,
+        help="Re-encode the stored embeddings once merged, which recomputes every similarity",
+    )
+    merge.add_argument(
+        "--pca-dims", type=int, default=DEFAULT_PCA_DIMS, help="Dimensions kept by the pca and pq compressions"
+    )
+    merge.add_argument(
+        "--full", action="store_true", help="Recompute every similarity instead of reusing the cached and shard data"
+    )
+
+    playlists = subparsers.add_parser(
+        "playlists",
+        help="Generate playlists in bulk from the similarity data",
+        description="Generates one playlist per entry of a JSON file such as "
+        '[{"name": "Warm Up", "seeds": ["Song A.mp3", "/music/Song B.mp3"]}], where seed songs are given by name or '
+        "location. Each playlist is written to stdout as a line of JSON.",
+    )
+    playlists.add_argument("seeds_file", type=Path, help="JSON file listing the playlists and their seed songs")
+    playlists.add_argument("--songs", type=int, default=30, help="Songs per playlist besides its seeds")
+    playlists.add_argument(
+        "--combine",
+        choices=list(SEED_COMBINE_MODES),
+        default="centroid",
+        help="How the distances to several seed songs are combined: "
+        + ", ".join(f"{mode} uses the {description}" for mode, description in SEED_COMBINE_MODES.items()),
+    )
+    playlists.add_argument("--save", action="store_true", help="Add the playlists to the app")
+
+    export = subparsers.add_parser(
+        "export",
+        help="Export saved playlists",
+        description="Exports the app's playlists as "
+        + ", ".join(f"{description} ({export_format})" for export_format, description in EXPORT_FORMATS.items())
+        + ". Archives are stored uncompressed and the other formats copy no audio at all.",
+    )
+    export.add_argument(
+        "output",
+        type=Path,
+        help="Directory receiving one file per playlist, or with --format rekordbox the XML file holding them all",
+    )
+    export.add_argument("--format", dest="export_format", choices=list(EXPORT_FORMATS), default="m3u8")
+    export.add_argument("--playlists", nargs="+", metavar="NAME", help="Playlists to export (default: all of them)")
+
+    aggregations = subparsers.add_parser(
+        "aggregations",
+        help="Compare the similarity aggregations on the analysed songs",
+        description="Builds the similarity matrix of the analysed songs with every aggregation, and reports how long "
+        "each took and how much its playlists overlap with those of the median. Each aggregation is written to stdout "
+        "as a line of JSON.",
+    )
+    aggregations.add_argument(
+        "--songs", type=int, default=2000, help="Analysed songs to compare on, chosen at random (default: 2000)"
+    )
+    aggregations.add_argument("--playlists", type=int, default=100, help="Playlists compared per aggregation")
+    aggregations.add_argument("--length", type=int, default=30, help="Songs per playlist besides its root song")
+    aggregations.add_argument("--precision", choices=list(PRECISIONS), default="float32")
+    aggregations.add_argument("--memory-budget-mb", type=float, default=DEFAULT_MEMORY_BUDGET_MB)
+    aggregations.add_argument("--seed", type=int, default=0, help="Seed for choosing the songs and playlists")
+    return parser
+
+
+def report_aggregations(args) -> int:
+    start = time.perf_counter()
+    embedding_store = get_embedding_store()
+    embeddings = [e for e in embedding_store.all_embeddings() if e is not None]
+    if len(embeddings) < 2:
+        write_event("error", message="At least two analysed songs are needed, run analyse first")
+        return EXIT_ERROR
+    rng = np.random.default_rng(args.seed)
+    sample = np.sort(rng.choice(len(embeddings), min(args.songs, len(embeddings)), replace=False))
+
+    for result in compare_aggregations(
+        [embeddings[i] for i in sample],
+        codec=embedding_store.codec,
+        n_playlists=args.playlists,
+        playlist_length=args.length,
+        memory_budget_mb=args.memory_budget_mb,
+        precision=args.precision,
+        seed=args.seed,
+    ):
+        write_event("aggregation", songs=len(sample), **result)
+    write_event("done", elapsed_s=round(time.perf_counter() - start, 3))
+    return EXIT_OK
+
+
+def export_playlists(args) -> int:
+    playlists_df = get_playlists_cache()
+    if args.playlists:
+        unknown = sorted(set(args.playlists) - set(playlists_df["name"]))
+        if unknown:
+            write_event("error", message=f"Unknown playlists: {', '.join(unknown)}")
+            return EXIT_USAGE
+        playlists_df = playlists_df[playlists_df["name"].isin(args.playlists)]
+
+    start = time.perf_counter()
+    if args.export_format != "rekordbox":
+        args.output.mkdir(parents=True, exist_ok=True)
+    playlists = list(zip(playlists_df["name"], playlists_df["songs"]))
+    missing, failed = PlaylistExporter(get_songs_cache()).export(playlists, args.output, args.export_format)
+    for name in failed:
+        write_event("playlist_failed", name=name, message="None of its song files were found")
+    write_event(
+        "done",
+        playlists=len(playlists) - len(failed),
+        playlists_failed=len(failed),
+        songs_missing=len(missing),
+        missing=missing,
+        output=str(args.output),
+        elapsed_s=round(time.perf_counter() - start, 3),
+    )
+    return EXIT_PARTIAL if missing or failed else EXIT_OK
+
+
+def generate_playlists(args) -> int:
+    songs_df = get_songs_cache()
+    try:
+        specs = PlaylistGenerator.read_seeds_file(args.seeds_file, songs_df)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        write_event("error", message=f"Invalid seeds file {args.seeds_file}: {e}")
+        return EXIT_USAGE
+
+    start = time.perf_counter()
+    generator = PlaylistGenerator(get_similarity_matrix_cache(), get_neighbour_graph_cache())
+    generated = generator.generate([seed_keys for _, seed_keys, _ in specs], args.songs, combine=args.combine)
+
+    names = dict(zip(songs_df["key"], songs_df["name"]))
+    locations = dict(zip(songs_df["key"], songs_df["location"]))
+    saved, failed = [], 0
+    for (name, seed_keys, unknown), playlist_keys in zip(specs, generated):
+        if unknown or playlist_keys is None:
+            failed += 1
+            if unknown:
+                reason = f"Unknown seed songs: {', '.join(unknown)}"
+            else:
+                reason = "No similarity data for the seeds" if seed_keys else "No seed songs"
+            write_event("playlist_failed", name=name, message=reason)
+            continue
+        keys = seed_keys + playlist_keys
+        write_event(
+            "playlist", name=name, songs=[names[key] for key in keys], locations=[locations[key] for key in keys]
+        )
+        saved.append((name, [names[key] for key in keys]))
+
+    if args.save and saved:
+        add_playlists_to_cache(saved)
+    write_event(
+        "done",
+        playlists=len(saved),
+        playlists_failed=failed,
+        saved=args.save,
+        elapsed_s=round(time.perf_counter() - start, 3),
+    )
+    return EXIT_PARTIAL if failed else EXIT_OK
+
+
+def analyse(args) -> int:
+    missing = [str(directory) for directory in args.directories if not directory.is_dir()]
+    if missing:
+        write_event("error", message=f"Not a directory: {', '.join(missing)}")
+        return EXIT_USAGE
+
+    shard = None
+    if (args.shard is None) != (args.shard_dir is None):
+        write_event("error", message="--shard and --shard-dir must be given together")
+        return EXIT_USAGE
+    if args.shard is not None:
+        if args.watch or args.similarity_storage != "dense" or args.embedding_compression is not None:
+            write_event(
+                "error",
+                message="Shards are analysed once with dense, uncompressed similarities; choose the storage and "
+                "compression when merging",
+            )
+            return EXIT_USAGE
+        shard = AnalysisShard(args.shard_dir, *args.shard)
+
+    start = time.perf_counter()
+    scanner = get_library_scanner()
+    song_paths = find_songs(args.directories, scanner)
+    write_event("scan", songs_found=len(song_paths), elapsed_s=round(time.perf_counter() - start, 3))
+    if shard is not None:
+        song_paths = shard.select(song_paths, args.directories)
+        write_event(
+            "shard", number=shard.number, count=shard.count, songs=len(song_paths), directory=str(shard.directory)
+        )
+
+    progress = ProgressBus()
+    progress.subscribe(write_progress_event)
+    progress.subscribe(log_progress)
+
+    with cancel_on_interrupt() as cancel_event:
+        if not args.watch:
+            return run_analysis(args, song_paths, progress, cancel_event, start, shard=shard)
+        watcher = LibraryWatcher(scanner, args.directories, interval_s=args.watch_interval)
+        # Record the files there now, so that only songs which appear or change from here on are queued
+        watcher.poll(queue_changes=False)
+        exit_code = run_analysis(args, song_paths, progress, cancel_event, start)
+        if not cancel_event.is_set():
+            exit_code = watch(args, watcher, progress, cancel_event)
+        return exit_code
+
+
+def watch(args, watcher: LibraryWatcher, progress: ProgressBus, cancel_event: threading.Event) -> int:
+    """
+    Analyses new or changed songs in batches as the watcher queues them, until cancelled.
+
+    A batch whose analysis raises is analysed again, along with any songs queued meanwhile, after waiting one watch
+    interval, doubling with each failure in a row up to `MAX_WATCH_BACKOFF_S`.
+    """
+    write_event("watching", directories=[str(directory) for directory in args.directories])
+    watcher.start()
+    retry_paths = []
+    backoff_s = 0.0
+    try:
+        while not cancel_event.is_set():
+            song_paths = list(dict.fromkeys(retry_paths + watcher.next_batch(timeout=CANCEL_POLL_INTERVAL_S)))
+            if not song_paths:
+                continue
+            write_event("changes", songs_found=len(song_paths))
+            try:
+                # Only the initial analysis honours --full, later batches update the similarity data incrementally
+                exit_code = run_analysis(args, song_paths, progress, cancel_event, time.perf_counter(), full=False)
+            except Exception as e:
+                backoff_s = min(max(2 * backoff_s, args.watch_interval), MAX_WATCH_BACKOFF_S)
+                logger.exception(f"Error analysing {len(song_paths)} changed songs, retrying in {backoff_s:g}s: {e}")
+                write_event("error", message=str(e), retry_in_s=backoff_s)
+                retry_paths = song_paths
+                cancel_event.wait(backoff_s)
+                continue
+            retry_paths, backoff_s = [], 0.0
+            if exit_code not in (EXIT_OK, EXIT_INTERRUPTED):
+                # e.g. EXIT_PARTIAL, for songs which can't be decoded. They fail the same way every time, so aren't retried
+                logger.warning(f"Analysing {len(song_paths)} changed songs finished with exit code {exit_code}")
+    finally:
+        watcher.stop()
+    return EXIT_INTERRUPTED
+
+
+def run_analysis(
+    args,
+    song_paths: list,
+    progress: ProgressBus,
+    cancel_event: threading.Event,
+    start: float,
+    full: bool = None,
+    shard: AnalysisShard = None,
+) -> int:
+    song_processor = SongProcessorDesktop(
+        local_song_paths=song_paths,
+        memory_budget_mb=args.memory_budget_mb,
+        similarity_precision=args.precision,
+        incremental=not (args.full if full is None else full),
+        similarity_storage=args.similarity_storage,
+        neighbours_k=args.neighbours,
+        n_workers=args.workers,
+        n_inference_workers=args.inference_workers,
+        inference_batch_size=args.batch_size,
+        decode_mode=args.decode_mode,
+        progress=progress,
+        profile_songs=args.profile_songs,
+        cancel_event=cancel_event,
+        embedding_compression=args.embedding_compression,
+        pca_dims=args.pca_dims,
+        similarity_aggregation=args.aggregation,
+        shard=shard,
+    )
+    write_event(
+        "plan",
+        songs_to_analyse=len(song_processor.song_paths_to_process),
+        songs_moved=len(song_processor.moved_songs),
+        pairs_to_compute=song_processor.similarity_progress_bar_max,
+    )
+
+    new_songs = song_processor.run()
+
+    failed = [str(song.path) for song in new_songs if song.simplified_yamnet_embeddings is None]
+    elapsed_seconds = time.perf_counter() - start
+    write_event(
+        "cancelled" if cancel_event.is_set() else "done",
+        songs_analysed=len(new_songs) - len(failed),
+        songs_failed=len(failed),
+        failed=failed,
+        elapsed_s=round(elapsed_seconds, 3),
+        report=str(song_processor.report.path),
+    )
+    if cancel_event.is_set():
+        return EXIT_INTERRUPTED
+    return EXIT_PARTIAL if failed else EXIT_OK
+
+
+def merge_shards(args) -> int:
+    try:
+        shards = AnalysisShard.find(args.shard_dir)
+    except (OSError, ValueError) as e:
+        write_event("error", message=str(e))
+        return EXIT_ERROR
+
+    start = time.perf_counter()
+    progress = ProgressBus()
+    progress.subscribe(write_progress_event)
+    progress.subscribe(log_progress)
+
+    with cancel_on_interrupt() as cancel_event:
+        song_processor = SongProcessorDesktop(
+            local_song_paths=[],
+            memory_budget_mb=args.memory_budget_mb,
+            similarity_precision=args.precision,
+            incremental=not args.full,
+            similarity_storage=args.similarity_storage,
+            neighbours_k=args.neighbours,
+            progress=progress,
+            cancel_event=cancel_event,
+            embedding_compression=args.embedding_compression,
+            pca_dims=args.pca_dims,
+            similarity_aggregation=args.aggregation,
+            merged_shards=shards,
+        )
+        write_event(
+            "plan",
+            shards=len(shards),
+            songs_in_shards=sum(shard.manifest["songs"] for shard in shards),
+            pairs_to_compute=song_processor.similarity_progress_bar_max,
+        )
+        song_processor.run()
+
+    write_event(
+        "cancelled" if cancel_event.is_set() else "done",
+        songs=len(song_processor.embedding_store),
+        elapsed_s=round(time.perf_counter() - start, 3),
+        report=str(song_processor.report.path),
+    )
+    return EXIT_INTERRUPTED if cancel_event.is_set() else EXIT_OK
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+
+    # TensorFlow isn't fork-safe, so worker processes are always spawned, as in the app
+    multiprocessing.set_start_method("spawn", force=True)
+    try:
+        if args.command == "analyse":
+            return analyse(args)
+        if args.command == "playlists":
+            return generate_playlists(args)
+        if args.command == "export":
+            return export_playlists(args)
+        if args.command == "aggregations":
+            return report_aggregations(args)
+        if args.command == "merge":
+            return merge_shards(args)
+    except KeyboardInterrupt:
+        write_event("error", message="Interrupted")
+        return EXIT_INTERRUPTED
+    except Exception as e:
+        logger.exception(e)
+        write_event("error", message=str(e))
+        return EXIT_ERROR
@@ -1,8 +1,11 @@
 import os
+import json
 import sys
 import pickle
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from contextlib import contextmanager
 
 
 def get_local_app_data_dir():
@@ -34,6 +37,26 @@ def get_log_dir():
         return Path(xdg_data_home) / "Selecta" / "logs"
 
 
+@contextmanager
+def atomic_write(path: Path, mode: str = "wb", **open_kwargs):
+    """
+    Opens a temporary file next to `path` for writing, which is flushed to disk and atomically replaces `path` once the
+    block completes. On error it is removed and `path` is left as it was.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        with open(tmp_path, mode, **open_kwargs) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, path)
+
+
 def resource_path(relative_path: str) -> Path:
     """Get absolute path to resource, works for dev and for PyInstaller .app bundle"""
     if hasattr(sys, "_MEIPASS"):  # PyInstaller uses _MEIPASS
@@ -41,26 +64,107 @@ def resource_path(relative_path: str) -> Path:
     return Path(__file__).parent / relative_path
 
 
+def get_content_key_index():
+    # Imported here because ContentKeyIndex lives alongside modules which depend on this one
+    from selecta.ContentKeyIndex import ContentKeyIndex
+
+    return ContentKeyIndex(Path(f"{local_app_data_dir}/cache/content_keys.pickle"))
+
+
+def get_library_scanner():
+    # Imported here for the same reason as ContentKeyIndex
+    from selecta.LibraryScanner import LibraryScanner
+
+    return LibraryScanner(Path(f"{local_app_data_dir}/cache/scan_cache.pickle"))
+
+
+def get_embedding_store():
+    # Imported here because the store logs through selecta.logger, which itself depends on this module
+    from selecta.EmbeddingStore import EmbeddingStore
+
+    embedding_store = EmbeddingStore(Path(f"{local_app_data_dir}/cache/embeddings"))
+    legacy_songs_path = Path(f"{local_app_data_dir}/cache/songs.pickle")
+    if not embedding_store.exists() and legacy_songs_path.exists():
+        content_key_index = get_content_key_index()
+        embedding_store.import_songs_pickle(legacy_songs_path, content_key_index)
+        migrate_similarity_caches_to_content_keys(embedding_store)
+        content_key_index.save()
+    elif embedding_store.exists() and "key" not in embedding_store.metadata.columns:
+        content_key_index = get_content_key_index()
+        embedding_store.add_content_keys(content_key_index)
+        migrate_similarity_caches_to_content_keys(embedding_store)
+        content_key_index.save()
+    return embedding_store
+
+
+def migrate_similarity_caches_to_content_keys(embedding_store):
+    """Relabels similarity caches indexed by song name with the songs' content keys"""
+    name_to_key = dict(zip(embedding_store.metadata["name"][::-1], embedding_store.metadata["key"][::-1]))
+
+    header_path = Path(f"{local_app_data_dir}/cache/similarity_matrix.json")
+    if header_path.exists():
+        with open(header_path) as f:
+            header = json.load(f)
+        if "names" in header:
+            with atomic_write(header_path, "w") as f:
+                json.dump({"keys": [name_to_key.get(name, name) for name in header["names"]]}, f)
+
+    legacy_matrix_path = Path(f"{local_app_data_dir}/cache/similarity_matrix.pickle")
+    if legacy_matrix_path.exists():
+        with open(legacy_matrix_path, "rb") as f:
+            similarity_matrix_df = pickle.load(f)
+        keys = [name_to_key.get(name, name) for name in similarity_matrix_df.index]
+        similarity_matrix_df.index, similarity_matrix_df.columns = keys, keys
+        with atomic_write(legacy_matrix_path) as f:
+            pickle.dump(similarity_matrix_df, f)
+
+    graph_path = Path(f"{local_app_data_dir}/cache/neighbour_graph.npz")
+    if graph_path.exists():
+        with np.load(graph_path) as data:
+            graph_arrays = dict(data)
+        if "names" in graph_arrays:
+            names = graph_arrays.pop("names").tolist()
+            graph_arrays["keys"] = np.array([name_to_key.get(name, name) for name in names], dtype=str)
+            with atomic_write(graph_path) as f:
+                np.savez(f, **graph_arrays)
+
+
 def get_songs_cache():
-    local_path = Path(f"{local_app_data_dir}/cache/songs.pickle")
-    try:
-        with open(local_path, "rb") as f:
-            songs = pickle.load(f)
-        songs_df = pd.DataFrame([{"name": song.name, "location": song.path} for song in songs])
-    except FileNotFoundError:
-        songs = []
-        songs_df = pd.DataFrame(columns=["name", "location"])
-    return songs, songs_df
+    # Only the metadata is read, the embeddings stay on disk. Songs are identified by the "key" column
+    songs_df = get_embedding_store().songs_df
+    return songs_df
 
 
 def get_similarity_matrix_cache():
-    local_path = Path(f"{local_app_data_dir}/cache/similarity_matrix.pickle")
-    try:
-        with open(local_path, "rb") as f:
+    # Imported here for the same reason as EmbeddingStore
+    from selecta.SimilarityMatrix import SimilarityMatrix
+
+    # Make sure caches from before content keys were introduced have been migrated
+    get_embedding_store()
+    similarity_matrix = SimilarityMatrix(Path(f"{local_app_data_dir}/cache/similarity_matrix.f32"))
+    legacy_path = Path(f"{local_app_data_dir}/cache/similarity_matrix.pickle")
+    if similarity_matrix.empty and legacy_path.exists():
+        # Migrate the legacy pickled DataFrame to the packed matrix file, keeping the old file as a backup
+        with open(legacy_path, "rb") as f:
             similarity_matrix_df = pickle.load(f)
+        similarity_matrix = SimilarityMatrix.allocate(similarity_matrix.path, similarity_matrix_df.index.tolist())
+        similarity_matrix.data[:] = similarity_matrix_df.to_numpy(dtype=np.float32)
+        similarity_matrix.commit()
+        os.replace(legacy_path, legacy_path.with_suffix(".pickle.bak"))
+    return similarity_matrix
+
+
+def get_neighbour_graph_cache():
+    # Imported here for the same reason as EmbeddingStore
+    from selecta.NeighbourGraph import NeighbourGraph
+
+    get_embedding_store()
+    local_path = Path(f"{local_app_data_dir}/cache/neighbour_graph.npz")
+    try:
+        neighbour_graph = NeighbourGraph.load(local_path)
     except FileNotFoundError:
-        similarity_matrix_df = pd.DataFrame()
-    return similarity_matrix_df
+        neighbour_graph = None
+    return neighbour_graph
 
 
 def get_playlists_cache():
@@ -73,5 +177,19 @@ def get_playlists_cache():
     return playlists_df
 
 
+def save_playlists_cache(playlists_df: pd.DataFrame):
+    with atomic_write(Path(f"{local_app_data_dir}/cache/playlists.pickle")) as f:
+        pickle.dump(playlists_df, f)
+
+
+def add_playlists_to_cache(playlists: list):
+    """Appends playlists, given as (name, song names) pairs, to the playlists cache"""
+    playlists_df = get_playlists_cache()
+    new_playlists_df = pd.DataFrame(playlists, columns=["name", "songs"])
+    save_playlists_cache(
+        new_playlists_df if playlists_df.empty else pd.concat([playlists_df, new_playlists_df], ignore_index=True)
+    )
+
+
 local_app_data_dir = get_local_app_data_dir()
 log_dir = get_log_dir()
@@ -1,14 +1,27 @@
-from keras.layers import TFSMLayer
+import threading
 
 from selecta.logger import generate_logger
 from selecta.utils import resource_path
 
 logger = generate_logger()
 
-try:
-    yamnet_model_path = resource_path("yamnet-tensorflow2-yamnet-v1")
-    logger.info(f"Loading YAMNet model from: {yamnet_model_path}")
-    yamnet_model = TFSMLayer(str(yamnet_model_path), call_endpoint="serving_default")
-except Exception as e:
-    logger.error(f"Failed to load YAMNet model: {e}")
-    raise e
+# Loaded on first use by `load_yamnet_model`, as importing TensorFlow and loading the SavedModel takes seconds
+yamnet_model = None
+load_lock = threading.Lock()
+
+
+def load_yamnet_model():
+    """Returns the YAMNet model, loading it (and TensorFlow) the first time it is needed in this process"""
+    global yamnet_model
+    with load_lock:
+        if yamnet_model is None:
+            try:
+                from keras.layers import TFSMLayer
+
+                yamnet_model_path = resource_path("yamnet-tensorflow2-yamnet-v1")
+                logger.info(f"Loading YAMNet model from: {yamnet_model_path}")
+                yamnet_model = TFSMLayer(str(yamnet_model_path), call_endpoint="serving_default")
+            except Exception as e:
+                logger.error(f"Failed to load YAMNet model: {e}")
+                raise e
+    return yamnet_model
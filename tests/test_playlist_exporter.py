@@ -0,0 +1,37 @@
+import pandas as pd
+import pytest
+
+from zipfile import ZipFile
+
+from selecta.PlaylistExporter import PlaylistExporter
+
+
+@pytest.fixture
+def exporter(tmp_path):
+    (tmp_path / "found.mp3").write_bytes(b"audio")
+    songs_df = pd.DataFrame(
+        {"name": ["found.mp3", "gone.mp3"], "location": [str(tmp_path / "found.mp3"), str(tmp_path / "gone.mp3")]}
+    )
+    return PlaylistExporter(songs_df)
+
+
+@pytest.mark.parametrize("export_format", ["zip", "m3u8", "rekordbox"])
+def test_empty_playlist_is_exported(exporter, tmp_path, export_format):
+    output = tmp_path / f"empty.{export_format}"
+    assert exporter.export([("Empty", [])], output, export_format) == ([], [])
+    assert output.exists()
+    if export_format == "zip":
+        assert ZipFile(output).namelist() == []
+
+
+@pytest.mark.parametrize("export_format", ["zip", "m3u8", "rekordbox"])
+def test_playlist_without_found_files_fails(exporter, tmp_path, export_format):
+    output = tmp_path / f"missing.{export_format}"
+    playlists = [("Missing", ["gone.mp3"]), ("Partial", ["found.mp3", "gone.mp3"])]
+    if export_format != "rekordbox":
+        output.mkdir()
+    assert exporter.export(playlists, output, export_format) == (["gone.mp3", "gone.mp3"], ["Missing"])
+    if export_format == "rekordbox":
+        assert output.exists()
+    else:
+        assert [path.name for path in output.iterdir()] == [f"Partial{output.suffix}"]
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from pathlib import Path
+
+import selecta.utils
+import selecta.SongProcessorDesktop
+from selecta.ContentKeyIndex import ContentKeyIndex
+from selecta.ProgressBus import ProgressBus
+from selecta.SongProcessorDesktop import SongProcessorDesktop
+from selecta.utils import (
+    get_embedding_store,
+    get_similarity_matrix_cache,
+    get_neighbour_graph_cache,
+    get_content_key_index,
+)
+
+N_SONGS = 40
+
+
+@pytest.fixture
+def analysed_library(tmp_path, monkeypatch):
+    """Song files whose embeddings are already stored, so that a run only computes their similarities"""
+    monkeypatch.setattr(selecta.utils, "local_app_data_dir", tmp_path / "app")
+    monkeypatch.setattr(selecta.SongProcessorDesktop, "local_app_data_dir", tmp_path / "app")
+    rng = np.random.default_rng(0)
+    entries = []
+    for i in range(N_SONGS):
+        path = tmp_path / f"song{i}.mp3"
+        path.write_bytes(rng.bytes(64))
+        embeddings = rng.standard_normal((int(rng.integers(2, 6)), 16)).astype(np.float32)
+        entries.append((ContentKeyIndex.audio_stream_hash(path), path.stem, str(path), embeddings))
+    get_embedding_store().append_entries(entries)
+    return [str(tmp_path / f"song{i}.mp3") for i in range(N_SONGS)]
+
+
+@pytest.mark.parametrize("similarity_storage", ["dense", "topk"])
+def test_cancel_after_final_tile_keeps_similarities(analysed_library, similarity_storage):
+    progress = ProgressBus(min_interval_s=0, min_percentage_step=0)
+    processor = SongProcessorDesktop(
+        analysed_library, similarity_storage=similarity_storage, memory_budget_mb=0.01, progress=progress
+    )
+    statuses = []
+
+    def on_progress(event):
+        if event.stage == "similarity" and event.total and event.done >= event.total:
+            processor.cancel()
+        elif event.stage == "status":
+            statuses.append(event.message)
+
+    progress.subscribe(on_progress)
+    processor.run()
+
+    assert processor.cancelled
+    assert statuses[-1] == "Done"
+    keys = get_embedding_store().keys
+    if similarity_storage == "dense":
+        assert get_similarity_matrix_cache().keys == keys
+    else:
+        assert get_neighbour_graph_cache().keys == keys
+    assert not processor.similarity_checkpoint.path.exists()
+
+
+def test_content_key_index_drops_deleted_and_moved_songs(analysed_library, tmp_path):
+    content_key_index = get_content_key_index()
+    for location in analysed_library:
+        content_key_index.key(location)
+    content_key_index.save()
+    moved = tmp_path / "moved.mp3"
+    Path(analysed_library[0]).rename(moved)
+    get_embedding_store().delete([content_key_index.key(analysed_library[1])])
+
+    # A run over part of the library keeps the entries of the songs it didn't cover
+    SongProcessorDesktop([str(moved), analysed_library[2]]).run()
+
+    assert set(get_content_key_index().entries) == {str(moved), *analysed_library[2:]}